@@ -0,0 +1,261 @@
+import logging
+import asyncio
+import io
+import os
+import struct
+import zlib
+import shutil
+import tempfile
+import threading
+import urllib.parse
+from collections import namedtuple
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from .configure import config
+from . import codec
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
+
+ArchivedRequestInfo = namedtuple('ArchivedRequestInfo', ('url', 'method', 'headers', 'real_url'));
+
+class ArchiveMissError(LookupError):
+    pass
+
+class ArchivedContent():
+    # the part of aiohttp.StreamReader used by the fetch functions
+    def __init__(self, bData):
+        self.stream = io.BytesIO(bData);
+    async def read(self, n=-1):
+        return self.stream.read(n);
+    async def readany(self):
+        return self.stream.read();
+
+class ArchivedResponse():
+    # stands in for aiohttp.ClientResponse when a response is served from the archive
+    def __init__(self, sMethod, sUrl, nStatus, sReason, sLastUrl, aHeaders, bData):
+        self.method = sMethod;
+        self.url = sLastUrl or sUrl;
+        self.status = nStatus;
+        self.reason = sReason;
+        self.headers = CIMultiDictProxy(CIMultiDict(aHeaders));
+        self.history = ();
+        self.request_info = ArchivedRequestInfo(sUrl, sMethod, CIMultiDictProxy(CIMultiDict()), sUrl);
+        self.content = ArchivedContent(bData);
+        self._bData = bData;
+        sType, _, sParams = self.headers.get('Content-Type', 'application/octet-stream').partition(';');
+        self.content_type = sType.strip().lower();
+        self.charset = None;
+        for sParam in sParams.split(';'):
+            sKey, _, sValue = sParam.strip().partition('=');
+            if (sKey.lower() == 'charset'):
+                self.charset = sValue.strip('"\' ') or None;
+    async def __aenter__(self):
+        return self;
+    async def __aexit__(self, *arg, **karg):
+        self.release();
+    def raise_for_status(self):
+        if (self.status >= 400):
+            raise aiohttp.ClientResponseError(self.request_info, self.history, status=self.status, message=self.reason, headers=self.headers);
+    async def read(self):
+        return self._bData;
+    def release(self):
+        pass
+    def close(self):
+        pass
+
+class RecordingContent():
+    # passes the body of a response through, keeping a copy for the archive in memory up to config.nSpillSize and on disk beyond
+    def __init__(self, content):
+        self.content = content;
+        self.file = tempfile.SpooledTemporaryFile(max_size=config.nSpillSize or 8*1024*1024, dir=config.sSpillDir);
+        self.nRead = 0;
+        self.isComplete = False;
+    def _keep(self, bData, isAll=False):
+        if (bData):
+            self.file.write(bData);
+            self.nRead += len(bData);
+        if (isAll or not bData or getattr(self.content, 'at_eof', lambda: False)()):
+            self.isComplete = True;
+        return bData;
+    async def read(self, n=-1):
+        return self._keep(await self.content.read(n), n < 0);
+    async def readany(self):
+        return self._keep(await self.content.readany());
+
+class RecordingResponse():
+    # stands in for a response being recorded: whatever reads it reads the network, and the archive gets the body
+    # in an executor thread once the response is released after it was read to the end
+    # bodies read only in part, such as pages left early or downloads broken off, and answers to ranges or validators are not recorded
+    def __init__(self, res, archive, sMethod, sUrl):
+        self.res = res;
+        self.archive = archive;
+        self.sMethod = sMethod;
+        self.sUrl = sUrl;
+        self.content = RecordingContent(res.content);
+        self.isReleased = False;
+    def __getattr__(self, sName):
+        return getattr(self.res, sName);
+    async def __aenter__(self):
+        return self;
+    async def __aexit__(self, *arg, **karg):
+        self.release();
+    async def read(self):
+        return await self.content.read();
+    def _finish(self):
+        if (self.isReleased):
+            return False;
+        self.isReleased = True;
+        content = self.content;
+        isWhole = content.isComplete or not content.nRead and (self.sMethod == 'HEAD' or self.res.status >= 400);
+        if (isWhole and self.res.status not in (206, 304) and self.archive.file):
+            self.archive.recordLater(self.sMethod, self.sUrl, self.res, content.file);
+        else:
+            content.file.close();
+        return True;
+    def release(self):
+        self._finish();
+        self.res.release();
+    def close(self):
+        self._finish();
+        self.res.close();
+
+class ResponseArchive():
+    # append-only file of records, each a pair of lengths, the JSON meta data and the zlib compressed body
+    # the index of the latest record per request is rebuilt on opening by skipping over the bodies
+    sMagic = b'ECAR1\n';
+    header = struct.Struct('>II');
+    def __init__(self, sPath, sMode='replay'):
+        assert sMode in ('record', 'replay');
+        self.sPath = sPath;
+        self.sMode = sMode;
+        self.mIndex = {};
+        self.nRecords = 0;
+        self.nServed = 0;
+        self.nMissed = 0;
+        self.file = None;
+        self.lock = threading.Lock(); # records are written from executor threads
+        self.aWrites = set(); # writes still running
+        self.open();
+    @property
+    def isReplay(self):
+        return self.sMode == 'replay';
+    def makeKey(self, sMethod, sUrl):
+        # volatile query parameters such as cache busting timestamps do not tell requests apart
+        aParts = urllib.parse.urlsplit(sUrl);
+        aQuery = [(key, value) for key, value in urllib.parse.parse_qsl(aParts.query, keep_blank_values=True) if key not in config.aArchiveIgnoreQuery];
+        sQuery = urllib.parse.urlencode(aQuery);
+        return '{} {}'.format(sMethod.upper(), urllib.parse.urlunsplit(aParts._replace(query=sQuery, fragment='')));
+    def open(self):
+        if (self.sMode == 'record'):
+            os.makedirs(os.path.dirname(os.path.abspath(self.sPath)), exist_ok=True);
+            self.file = open(self.sPath, 'a+b');
+            if (self.file.tell() == 0):
+                self.file.write(self.sMagic);
+        else:
+            self.file = open(self.sPath, 'rb');
+        self._buildIndex();
+    def _buildIndex(self):
+        self.file.seek(0);
+        if (self.file.read(len(self.sMagic)) != self.sMagic):
+            raise ValueError('"{}" is not a response archive'.format(self.sPath));
+        while True:
+            nOffset = self.file.tell();
+            bHeader = self.file.read(self.header.size);
+            if (len(bHeader) < self.header.size):
+                break;
+            nMeta, nBody = self.header.unpack(bHeader);
+            bMeta = self.file.read(nMeta);
+            if (len(bMeta) < nMeta):
+                log.warning('truncated record at {} of "{}"'.format(nOffset, self.sPath));
+                break;
+            mMeta = codec.loads(bMeta);
+            self.mIndex[mMeta['key']] = nOffset;
+            self.nRecords += 1;
+            self.file.seek(nBody, io.SEEK_CUR);
+        self.file.seek(0, io.SEEK_END);
+        log.debug('{} records indexed in "{}"'.format(self.nRecords, self.sPath));
+    def _readAt(self, nOffset):
+        self.file.seek(nOffset);
+        nMeta, nBody = self.header.unpack(self.file.read(self.header.size));
+        mMeta = codec.loads(self.file.read(nMeta));
+        bData = zlib.decompress(self.file.read(nBody));
+        return mMeta, bData;
+    def makeMeta(self, sMethod, sUrl, res):
+        return {
+                'key': self.makeKey(sMethod, sUrl),
+                'method': sMethod,
+                'url': sUrl,
+                'status': res.status,
+                'reason': res.reason,
+                'lasturl': str(res.url),
+                'headers': list(res.headers.items())
+        };
+    def record(self, mMeta, file, nBuffer=1024*1024):
+        # appends the record of mMeta with the body in file, which is closed afterwards; compressed in chunks, so large bodies never sit in memory
+        assert self.sMode == 'record';
+        try:
+            file.seek(0);
+            compressor = zlib.compressobj();
+            with tempfile.SpooledTemporaryFile(max_size=config.nSpillSize or 8*1024*1024, dir=config.sSpillDir) as body:
+                for bData in iter(lambda: file.read(nBuffer), b''):
+                    body.write(compressor.compress(bData));
+                body.write(compressor.flush());
+                nBody = body.tell();
+                body.seek(0);
+                bMeta = codec.dumps(mMeta).encode('utf-8');
+                with self.lock:
+                    self.file.seek(0, io.SEEK_END);
+                    nOffset = self.file.tell();
+                    self.file.write(self.header.pack(len(bMeta), nBody));
+                    self.file.write(bMeta);
+                    shutil.copyfileobj(body, self.file, nBuffer);
+                    self.mIndex[mMeta['key']] = nOffset;
+                    self.nRecords += 1;
+        finally:
+            file.close();
+    def recordLater(self, sMethod, sUrl, res, file):
+        # records in an executor thread, off the event loop
+        fut = asyncio.get_event_loop().run_in_executor(None, self.record, self.makeMeta(sMethod, sUrl, res), file);
+        self.aWrites.add(fut);
+        fut.add_done_callback(self._written);
+        return fut;
+    def _written(self, fut):
+        self.aWrites.discard(fut);
+        if (not fut.cancelled() and fut.exception()):
+            log.error('failed to archive a response in "{}": {}'.format(self.sPath, fut.exception()));
+    async def join(self):
+        # waits for the records still being written
+        if (self.aWrites):
+            await asyncio.wait(tuple(self.aWrites));
+    def replay(self, sMethod, sUrl):
+        nOffset = self.mIndex.get(self.makeKey(sMethod, sUrl));
+        if (nOffset is None):
+            self.nMissed += 1;
+            raise ArchiveMissError('{} {} is not archived in "{}"'.format(sMethod, sUrl, self.sPath));
+        self.nServed += 1;
+        return self._makeResponse(*self._readAt(nOffset));
+    def _makeResponse(self, mMeta, bData):
+        return ArchivedResponse(mMeta['method'], mMeta['url'], mMeta['status'], mMeta['reason'], mMeta['lasturl'], mMeta['headers'], bData);
+    def items(self):
+        # (meta, body) of the latest record of every archived request
+        for nOffset in sorted(self.mIndex.values()):
+            yield self._readAt(nOffset);
+    def flush(self):
+        if (self.file and self.sMode == 'record'):
+            with self.lock:
+                self.file.flush();
+    def close(self):
+        # records not written yet are lost, await join() first
+        if (self.file):
+            with self.lock:
+                self.file.close();
+                self.file = None;
+    def getStats(self):
+        return {'records': self.nRecords, 'requests': len(self.mIndex), 'served': self.nServed, 'missed': self.nMissed};
@@ -3,23 +3,47 @@ import asyncio
 import os
 import re
 import socket
+import ssl
 import urllib.parse
 from concurrent.futures import CancelledError
 import time
 import json
 from functools import wraps
 import html
+import codecs
+import heapq
+import random
+import email.utils
+import hashlib
+import base64
+import binascii
+import mmap
+import tempfile
+import threading
+import contextvars
+from collections import deque, OrderedDict
 from traceback import extract_stack, format_list
 
 import lxml.html
 from lxml.html.clean import Cleaner
 import aiohttp
+import yarl
 
 from .configure import config
+from .archive import ResponseArchive, RecordingResponse, ArchiveMissError
+from .store import MediaStore
+from .transport import Http2Session
+from . import codec
+from . import worker
 
 UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/46.0.2486.0 Safari/537.36 Edge/13.10586';
 
 aiohttpSession = None
+aiohttpConnector = None
+responseArchive = None
+mediaStore = None
+sslContext = None
+http2SslContext = None
 
 log = logging.getLogger(__name__);
 
@@ -110,7 +134,7 @@ class TaskArranger():
         for task in self.aliveTask:
             task.cancel();
         if (self.aliveTask):
-            await asyncio.wait(tuple(self.aliveTask), loop=self.loop, timeout=nTimeout);
+            await asyncio.wait(tuple(self.aliveTask), timeout=nTimeout);
         for task in self.aliveTask:
             if (not task.done()):
                 task.set_exception(DeadArrangerError(arranger=self));
@@ -121,7 +145,7 @@ class TaskArranger():
         log.info('task arranger closed');
     async def join(self, nTimeout=None, isGather=False):
         if (self.aliveTask):
-            await asyncio.wait_for(self.doneFuture, timeout=nTimeout, loop=self.loop);
+            await asyncio.wait_for(self.doneFuture, timeout=nTimeout);
         if (isGather and self.exceptionTask):
             return await asyncio.gather(*self.exceptionTask);
 
@@ -150,46 +174,402 @@ def mergeQuery(sUrl, mQuery, sFragment=None):
     query = urllib.parse.urlencode(mQueryNew, doseq=True);
     return urllib.parse.urlunsplit((scheme, netloc, path, query, fragment));
 
+class TtlCache():
+    # LRU cache whose entries also expire after nTtl seconds; it can be saved to and loaded from a JSON file when keys are strings
+    def __init__(self, nSize=None, nTtl=None):
+        self.nSize = nSize or float('inf');
+        self.nTtl = nTtl or None;
+        self.mData = OrderedDict(); # key: (value, expiring timestamp)
+        self.sPath = None;
+        self.nHit = 0;
+        self.nMiss = 0;
+    def __len__(self):
+        return len(self.mData);
+    def get(self, key, default=None):
+        aItem = self.mData.get(key);
+        if (aItem is not None and aItem[1] is not None and aItem[1] < time.time()):
+            del self.mData[key];
+            aItem = None;
+        if (aItem is None):
+            self.nMiss += 1;
+            return default;
+        self.nHit += 1;
+        self.mData.move_to_end(key);
+        return aItem[0];
+    def set(self, key, value, nTtl=None):
+        nTtl = nTtl or self.nTtl;
+        self.mData[key] = (value, time.time() + nTtl if nTtl else None);
+        self.mData.move_to_end(key);
+        while len(self.mData) > self.nSize:
+            self.mData.popitem(last=False);
+    def discard(self, key):
+        self.mData.pop(key, None);
+    def load(self, sPath):
+        self.sPath = sPath;
+        try:
+            with open(sPath, 'rb') as f:
+                aItems = codec.loads(f.read());
+        except FileNotFoundError:
+            return 0;
+        except ValueError as e:
+            log.warning('ignore broken cache file "{}": {}'.format(sPath, e));
+            return 0;
+        nNow = time.time();
+        for key, value, nExpire in aItems:
+            if (nExpire is None or nExpire > nNow):
+                self.mData[key] = (value, nExpire);
+        while len(self.mData) > self.nSize:
+            self.mData.popitem(last=False);
+        log.debug('{} entries loaded from "{}"'.format(len(self.mData), sPath));
+        return len(self.mData);
+    def save(self, sPath=None):
+        sPath = sPath or self.sPath;
+        assert sPath;
+        nNow = time.time();
+        aItems = [[key, value, nExpire] for key, (value, nExpire) in self.mData.items() if nExpire is None or nExpire > nNow];
+        os.makedirs(os.path.dirname(os.path.abspath(sPath)), exist_ok=True);
+        sTemp = '{}.{}.tmp'.format(sPath, os.getpid());
+        with open(sTemp, 'w', encoding='utf-8') as f:
+            f.write(codec.dumps(aItems));
+        os.replace(sTemp, sPath);
+        return len(aItems);
+
+class HttpCache():
+    # bodies and their validators on disk, revalidated with If-None-Match / If-Modified-Since and evicted least recently used first
+    # entries are keyed by the url without its cache busting parameters and by what else the body may vary with: the headers and the cookies sent
+    # the disk is only touched in executor threads
+    def __init__(self, sDir=None, nSize=None):
+        self.sDir = sDir or config.sHttpCacheDir;
+        self.nSize = nSize or config.nHttpCacheSize;
+        self.mIndex = None; # key: body size, in order of use
+        self.lock = threading.Lock(); # the index is used from executor threads
+        self.nTotal = 0;
+        self.nHit = 0;
+        self.nMiss = 0;
+        self.nSaved = 0;
+    def normalizeUrl(self, sUrl):
+        aParts = urllib.parse.urlsplit(sUrl);
+        if (not aParts.query):
+            return urllib.parse.urlunsplit(aParts._replace(fragment=''));
+        aQuery = [(key, value) for key, value in urllib.parse.parse_qsl(aParts.query, keep_blank_values=True) if key not in config.aCacheIgnoreQuery];
+        return urllib.parse.urlunsplit(aParts._replace(query=urllib.parse.urlencode(aQuery), fragment=''));
+    def makeKey(self, sUrl, session=None, mHeaders=None):
+        aVary = [self.normalizeUrl(sUrl)];
+        if (session is not None):
+            aVary.extend('{}: {}'.format(key.lower(), value) for key, value in sorted(getSessionHeaders(session).items()));
+            aVary.append('cookie: ' + getSessionCookies(session, sUrl));
+        aVary.extend('{}: {}'.format(str(key).lower(), value) for key, value in sorted((mHeaders or {}).items()));
+        return hashlib.sha1('\n'.join(aVary).encode('utf-8')).hexdigest();
+    def _getPath(self, sKey, sExt):
+        return os.path.join(self.sDir, sKey[:2], sKey + sExt);
+    def _loadIndex(self):
+        # with self.lock held
+        if (self.mIndex is not None):
+            return;
+        aEntries = [];
+        if (os.path.isdir(self.sDir)):
+            for sSub in os.listdir(self.sDir):
+                sSubDir = os.path.join(self.sDir, sSub);
+                if (not os.path.isdir(sSubDir)):
+                    continue;
+                for entry in os.scandir(sSubDir):
+                    if (entry.name.endswith('.body')):
+                        stat = entry.stat();
+                        aEntries.append((stat.st_mtime, entry.name[:-5], stat.st_size));
+        self.mIndex = OrderedDict((sKey, nSize) for nTime, sKey, nSize in sorted(aEntries));
+        self.nTotal = sum(self.mIndex.values());
+    def _remove(self, sKey):
+        # with self.lock held
+        self.nTotal -= self.mIndex.pop(sKey, 0);
+        for sExt in ('.meta', '.body'):
+            try:
+                os.remove(self._getPath(sKey, sExt));
+            except FileNotFoundError:
+                pass
+    def _lookup(self, sKey):
+        with self.lock:
+            self._loadIndex();
+            if (sKey not in self.mIndex):
+                return None;
+            try:
+                with open(self._getPath(sKey, '.meta'), 'rb') as f:
+                    mMeta = codec.loads(f.read());
+            except (OSError, ValueError):
+                self._remove(sKey);
+                return None;
+        if (mMeta.get('key') != sKey):
+            return None;
+        return mMeta;
+    async def lookup(self, sKey):
+        # meta data of the entry of sKey, None if there is none
+        return await asyncio.get_event_loop().run_in_executor(None, self._lookup, sKey);
+    def getValidators(self, mMeta):
+        mHeaders = {};
+        if (mMeta.get('etag')):
+            mHeaders['If-None-Match'] = mMeta['etag'];
+        if (mMeta.get('modified')):
+            mHeaders['If-Modified-Since'] = mMeta['modified'];
+        return mHeaders;
+    def _hit(self, sUrl, sKey):
+        sPath = self._getPath(sKey, '.body');
+        with self.lock:
+            try:
+                with open(sPath, 'rb') as f:
+                    bData = f.read();
+                os.utime(sPath);
+            except OSError:
+                self._remove(sKey);
+                raise aiohttp.ClientPayloadError('cached body of {} is lost'.format(sUrl));
+            self.mIndex.move_to_end(sKey);
+            self.nHit += 1;
+            self.nSaved += len(bData);
+        return bData;
+    async def hit(self, sUrl, mMeta):
+        # the cached body of a response found not modified
+        return await asyncio.get_event_loop().run_in_executor(None, self._hit, sUrl, mMeta['key']);
+    def _store(self, sKey, sUrl, mHeaders, sType, sCharset, bData):
+        mMeta = {'key': sKey, 'url': sUrl, 'etag': mHeaders.get('ETag'), 'modified': mHeaders.get('Last-Modified'), 'type': sType, 'charset': sCharset, 'size': len(bData)};
+        with self.lock:
+            self._loadIndex();
+            self._remove(sKey);
+            os.makedirs(os.path.dirname(self._getPath(sKey, '')), exist_ok=True);
+            with open(self._getPath(sKey, '.body'), 'wb') as f:
+                f.write(bData);
+            with open(self._getPath(sKey, '.meta'), 'w', encoding='utf-8') as f:
+                f.write(codec.dumps(mMeta));
+            self.mIndex[sKey] = len(bData);
+            self.nTotal += len(bData);
+            while self.nTotal > self.nSize and self.mIndex:
+                self._remove(next(iter(self.mIndex)));
+    async def store(self, sKey, sUrl, res, bData):
+        self.nMiss += 1;
+        sETag = res.headers.get('ETag');
+        sModified = res.headers.get('Last-Modified');
+        if (not (sETag or sModified) or 'no-store' in res.headers.get('Cache-Control', '') or len(bData) > self.nSize):
+            return False;
+        mHeaders = {'ETag': sETag, 'Last-Modified': sModified};
+        await asyncio.get_event_loop().run_in_executor(None, self._store, sKey, sUrl, mHeaders, res.content_type, res.charset, bData);
+        return True;
+    def getStats(self):
+        return {'hit': self.nHit, 'miss': self.nMiss, 'bytes saved': self.nSaved, 'bytes stored': self.nTotal};
+httpCache = HttpCache();
+
+class SinglePassCleaner(Cleaner):
+    # lxml's Cleaner walks the tree once per kind of cleaning, about ten times; for the settings the crawler cleans with,
+    # the same elements and attributes are dropped here in one walk, and then the elements in the order lxml drops them
+    # other settings, or an outermost element lxml would have to rewrite, are left to lxml
+    aKillTags = ('script', 'style', 'link', 'meta', 'applet', 'base') + tuple(lxml.html.defs.frame_tags);
+    aRemoveTags = ('head', 'html', 'title', 'iframe', 'embed', 'layer', 'object', 'param', 'blink', 'marquee');
+    aFormTags = ('button', 'input', 'select', 'textarea');
+    def __init__(self, **karg):
+        super().__init__(**karg);
+        self.killTags = set(self.aKillTags + (self.aFormTags if self.forms else ()));
+        self.removeTags = set(self.aRemoveTags + (('form',) if self.forms else ()));
+        self.knownTags = set(lxml.html.defs.tags);
+        self.safeAttrs = set(self.safe_attrs) - {'style'};
+        self.linkAttrs = lxml.html.defs.link_attrs;
+    def isSupported(self, doc):
+        return (
+                self.scripts and self.javascript and self.comments and self.processing_instructions
+                and self.style and self.inline_style and self.links and self.meta and self.page_structure
+                and self.embedded and self.frames and self.annoying_tags and self.remove_unknown_tags
+                and self.safe_attrs_only and not self.add_nofollow and not self.host_whitelist
+                and not (self.kill_tags or self.remove_tags or self.allow_tags)
+                and lxml.etree.iselement(doc) and isinstance(doc.tag, str) and doc.tag != 'image'
+                and doc.tag in self.knownTags and doc.tag not in self.killTags and doc.tag not in self.removeTags
+        );
+    def __call__(self, doc):
+        if (not self.isSupported(doc)):
+            return super().__call__(doc);
+        lxml.html.xhtml_to_html(doc);
+        aKill = [];
+        aRemove = [];
+        aUnknown = [];
+        for ele in doc.iter():
+            sTag = ele.tag;
+            if (not isinstance(sTag, str)):
+                if (sTag is lxml.etree.Comment or sTag is lxml.etree.ProcessingInstruction):
+                    aKill.append(ele);
+                else:
+                    aUnknown.append(ele);
+                continue;
+            if (sTag == 'image'):
+                ele.tag = sTag = 'img';
+            attrib = ele.attrib;
+            for sName in attrib.keys():
+                if (sName not in self.safeAttrs):
+                    del attrib[sName];
+                elif (sName in self.linkAttrs):
+                    sLink = attrib[sName];
+                    sNew = self._remove_javascript_link(sLink.strip());
+                    if (sNew != sLink):
+                        attrib[sName] = sNew;
+            if (sTag in self.killTags):
+                aKill.append(ele);
+            elif (sTag in self.removeTags):
+                if (sTag == 'param' and not any(parent.tag in ('applet', 'object') for parent in ele.iterancestors())):
+                    aKill.append(ele); # lxml drops the params out of any applet or object entirely
+                else:
+                    aRemove.append(ele);
+            elif (sTag not in self.knownTags):
+                aUnknown.append(ele);
+        for ele in aKill:
+            ele.drop_tree();
+        for ele in reversed(aRemove):
+            ele.drop_tag();
+        for ele in aUnknown:
+            ele.drop_tag();
+
 utf8Parser = lxml.html.HTMLParser(encoding='utf-8');
-defaultCleaner = Cleaner(style=True, forms=False);
+defaultCleaner = SinglePassCleaner(style=True, forms=False);
+
+def _parseFragment(data, isAggregate):
+    if (isinstance(data, bytes)):
+        data = html2Unicode(data);
+    assert isinstance(data, str);
+    return lxml.html.fragment_fromstring(data, create_parent=isAggregate, parser=worker.getParser()); # fragments are also cleaned in parse workers
+
+def _serializeInner(ele):
+    # text of ele escaped like html.escape does, then its children as XML, serialized in one go with ele instead of child by child
+    try:
+        sText = ele.text;
+    except UnicodeDecodeError as e:
+        log.warning(e);
+        ele = lxml.html.fromstring(lxml.etree.tostring(ele, method='xml', encoding='utf-8').decode(errors='replace'))
+        sText = ele.text;
+    if (not len(ele)):
+        return html.escape(sText or '');
+    ele.text = None;
+    try:
+        # if the method argument of tostring is 'html', tostring might escape Chinese character to hexadecimal numeric character reference, which for human is hard to discern -- see https://www.w3.org/TR/html5/syntax.html#character-references
+        sData = lxml.etree.tostring(ele, method='xml', encoding='unicode', with_tail=False);
+    finally:
+        ele.text = sText;
+    # no '>' is left unescaped in attribute values, so the first one closes the start tag
+    return html.escape(sText or '') + sData[sData.index('>')+1:-len(ele.tag)-3];
 
-def innerHtml(data, isAggregate=False, cleaner=None):
+def innerHtml(data, isAggregate=False, cleaner=None, isOwned=False):
+    # isOwned: data is an element the caller has no more use of as it is, so it is cleaned in place rather than copied first
+    # fragments parsed here from text are always cleaned in place
     if (cleaner is None):
         cleaner = defaultCleaner;
     if (lxml.etree.iselement(data)):
         ele = data 
     else:
-        if (isinstance(data, bytes)):
-            data = html2Unicode(data);
-        assert isinstance(data, str);
-        ele = lxml.html.fragment_fromstring(data, create_parent=isAggregate, parser=utf8Parser);
+        ele = _parseFragment(data, isAggregate);
+        isOwned = True;
     if (cleaner):
-        ele = cleaner.clean_html(ele);
-    try:
-        sData = html.escape(ele.text or '');
-    except UnicodeDecodeError as e:
-        log.warning(e);
-        ele = lxml.html.fromstring(lxml.etree.tostring(ele, method='xml', encoding='utf-8').decode(errors='replace'))
-        sData = html.escape(ele.text or '');
-    sData += ''.join(lxml.etree.tostring(child, method='xml', encoding='utf-8').decode(errors='replace') for child in ele);
-    # if the method argument of tostring is 'html', tostring might escape Chinese character to hexadecimal numeric character reference, which for human is hard to discern -- see https://www.w3.org/TR/html5/syntax.html#character-references
-    return sData;
+        if (isOwned):
+            cleaner(ele);
+        else:
+            ele = cleaner.clean_html(ele);
+    return _serializeInner(ele);
 
-def html2Unicode(bData):
-    try:
-        import cchardet as chardet
-    except ImportError:
+def innerHtmls(aData, isAggregate=True, cleaner=None):
+    # innerHtml of each fragment of text in aData; the fragments are parsed apart but cleaned together in one pass of the cleaner
+    if (cleaner is None):
+        cleaner = defaultCleaner;
+    if (not isAggregate):
+        return [innerHtml(data, cleaner=cleaner) for data in aData];
+    aEle = [_parseFragment(data, True) for data in aData];
+    if (cleaner and aEle):
+        # the parents made by fragment_fromstring are plain div, which the cleaner never drops nor rewrites as the outermost element
+        batch = lxml.html.Element('div');
+        batch.extend(aEle);
+        cleaner(batch);
+    return [_serializeInner(ele) for ele in aEle];
+
+class EncodingDetector():
+    # tiers from the cheapest: charset of the transport, byte order mark, <meta> charset near the start, the former decision for the endpoint,
+    # and statistical detection over a sample of the start
+    aBom = (
+            (codecs.BOM_UTF8, 'utf-8'),
+            (codecs.BOM_UTF32_LE, 'utf-32'),
+            (codecs.BOM_UTF32_BE, 'utf-32'),
+            (codecs.BOM_UTF16_LE, 'utf-16'),
+            (codecs.BOM_UTF16_BE, 'utf-16')
+    );
+    metaPattern = re.compile(rb'''<meta[^>]+?charset\s*=\s*["']?\s*([-\w.:]+)''', re.I);
+    mAlias = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'ascii': 'utf-8'}; # pages declaring them use characters of the superset all the time
+    nSniff = 4096;
+    nSample = 64*1024;
+    nCacheSize = 1000;
+    def __init__(self):
+        self.detector = False; # chardet module, None if neither cchardet nor chardet is installed
+        self.mCache = OrderedDict(); # endpoint -> encoding
+        self.mTier = {};
+    def _getDetector(self):
+        if (self.detector is False):
+            try:
+                import cchardet as detector
+            except ImportError:
+                try:
+                    import chardet as detector
+                except ImportError:
+                    detector = None;
+            self.detector = detector;
+        return self.detector;
+    def _normalize(self, sEnc):
         try:
-            import chardet
-        except ImportError:
-            return bData.decode('utf-8');
-    mResult = chardet.detect(bData);
-    if (mResult['confidence'] > 0.5):
-        sEnc = mResult['encoding'];
-        sData = bData.decode(sEnc, 'replace');
-        return sData;
-    else:
-        raise UnicodeError('can not identify the encoding');
+            sEnc = codecs.lookup(sEnc.strip().strip('"\'')).name;
+        except (LookupError, ValueError):
+            return None;
+        return self.mAlias.get(sEnc, sEnc);
+    def _decide(self, sEnc, sTier, sUrl=None):
+        self.mTier[sTier] = self.mTier.get(sTier, 0) + 1;
+        if (sUrl and sTier in ('meta', 'sample')):
+            sEndpoint = getEndpoint(sUrl);
+            self.mCache[sEndpoint] = sEnc;
+            self.mCache.move_to_end(sEndpoint);
+            if (len(self.mCache) > self.nCacheSize):
+                self.mCache.popitem(last=False);
+        return sEnc, sTier;
+    def detect(self, bData, sCharset=None, sUrl=None):
+        # (encoding, tier deciding it); (None, None) if nothing can tell, UnicodeError if the statistics are too unsure
+        if (sCharset):
+            sEnc = self._normalize(sCharset);
+            if (sEnc):
+                return self._decide(sEnc, 'transport');
+        if (not bData):
+            return None, None;
+        bHead = bytes(bData[:self.nSniff]);
+        for bBom, sEnc in self.aBom:
+            if (bHead.startswith(bBom)):
+                return self._decide(sEnc, 'bom');
+        match = self.metaPattern.search(bHead);
+        if (match):
+            sEnc = self._normalize(match.group(1).decode('ascii', 'replace'));
+            if (sEnc):
+                return self._decide(sEnc, 'meta', sUrl);
+        if (sUrl):
+            sEnc = self.mCache.get(getEndpoint(sUrl));
+            if (sEnc):
+                return self._decide(sEnc, 'cache');
+        detector = self._getDetector();
+        if (detector is None):
+            return None, None;
+        mResult = detector.detect(bytes(bData[:self.nSample]));
+        if (not mResult['encoding'] or (mResult['confidence'] or 0) <= 0.5):
+            raise UnicodeError('can not identify the encoding');
+        if (mResult['encoding'].lower() in ('ascii', 'us-ascii')):
+            # a sample of ASCII only tells nothing of the rest of the page, utf-8 reads both, and the endpoint stays undecided
+            return self._decide('utf-8', 'sample');
+        return self._decide(self._normalize(mResult['encoding']) or mResult['encoding'], 'sample', sUrl);
+    def getStats(self):
+        return dict(self.mTier, cached=len(self.mCache));
+encodingDetector = EncodingDetector();
+
+def detectEncoding(bData, sCharset=None, sUrl=None):
+    # None if nothing can tell
+    return encodingDetector.detect(bData, sCharset, sUrl)[0];
+
+def html2Unicode(bData, sCharset=None, sUrl=None):
+    sEnc = detectEncoding(bData, sCharset, sUrl);
+    if (sEnc is None):
+        return bData.decode('utf-8');
+    # utf-8-sig drops a byte order mark, and is utf-8 otherwise
+    sData = bData.decode('utf-8-sig' if sEnc == 'utf-8' else sEnc, 'replace');
+    return sData;
 
 def prettyHtml(bData, sMethod='html'):
     try:
@@ -200,44 +580,506 @@ def prettyHtml(bData, sMethod='html'):
     sMethod = sMethod or 'html';
     return lxml.etree.tostring(ele, encoding='utf-8', method='html', pretty_print=True).decode();
 
+class _LockWaiter():
+    __slots__ = ('nSeq', 'fut', 'sHost', 'isReserved');
+    def __init__(self, nSeq, fut, sHost):
+        self.nSeq = nSeq;
+        self.fut = fut;
+        self.sHost = sHost;
+        self.isReserved = False; # whether a slot of its host is already held for it
+    def __lt__(self, other):
+        return self.nSeq < other.nSeq;
+
 class PerHostLock():
-    def __init__(self, loop=None):
+    # waiters blocked by the limit of their host queue up per host; once they hold a host slot they queue globally in arrival order
+    # a release hands the freed slot to exactly one waiter instead of waking all of them
+    def __init__(self, loop=None, nTotalLimit=None, nPerHostLimit=None):
         self.loop = loop or asyncio.get_event_loop();
-        self.fut = self.loop.create_future();
-        self.nTotalLimit = config.nFetchLimit or float('inf');
+        self.nTotalLimit = nTotalLimit or config.nFetchLimit or float('inf');
         assert self.nTotalLimit > 0;
-        self.nPerHostLimit = config.nLimitPerHost or float('inf');
+        self.nPerHostLimit = nPerHostLimit or config.nLimitPerHost or float('inf');
         assert self.nPerHostLimit > 0;
         self.mHost = {};
         self.nFree = self.nTotalLimit;
+        self.mHostQueue = {};
+        self.aGlobalQueue = [];
+        self.nSeq = 0;
     def _getHost(self, sUrl):
         sHost = urllib.parse.urlsplit(sUrl).netloc;
         assert sHost;
         return sHost;
+    def _enqueueGlobal(self, waiter):
+        if (self.nFree > 0):
+            self.nFree -= 1;
+            waiter.fut.set_result(None);
+        else:
+            heapq.heappush(self.aGlobalQueue, waiter);
+    def _freeHost(self, sHost):
+        queue = self.mHostQueue.get(sHost);
+        while queue:
+            waiter = queue.popleft();
+            if (not waiter.fut.done()):
+                # the host slot is passed on directly
+                waiter.isReserved = True;
+                self._enqueueGlobal(waiter);
+                return;
+        if (queue is not None):
+            del self.mHostQueue[sHost];
+        self.mHost[sHost] += 1;
+        if (self.mHost[sHost] > self.nPerHostLimit):
+            log.error('excessive release regarding "{}"!'.format(sHost));
+    def _freeGlobal(self):
+        while self.aGlobalQueue:
+            waiter = heapq.heappop(self.aGlobalQueue);
+            if (not waiter.fut.done()):
+                waiter.fut.set_result(None);
+                return;
+        self.nFree += 1;
+        if (self.nFree > self.nTotalLimit):
+            log.error('excessive release regarding total limit!');
     async def acquire(self, sUrl=None):
-        if (sUrl):
-            sHost = self._getHost(sUrl);
-        while True:
+        sHost = self._getHost(sUrl) if sUrl else None;
+        if (sHost is None or self.mHost.setdefault(sHost, self.nPerHostLimit) > 0 and not self.mHostQueue.get(sHost)):
+            if (sHost is not None):
+                self.mHost[sHost] -= 1;
             if (self.nFree > 0):
-                if (not sUrl or self.mHost.setdefault(sHost, self.nPerHostLimit) > 0):
-                    break;
-            await self.fut;
-        if (sUrl):
+                self.nFree -= 1;
+                return;
+            self.nSeq += 1;
+            waiter = _LockWaiter(self.nSeq, self.loop.create_future(), sHost);
+            waiter.isReserved = sHost is not None;
+            heapq.heappush(self.aGlobalQueue, waiter);
+        else:
+            self.nSeq += 1;
+            waiter = _LockWaiter(self.nSeq, self.loop.create_future(), sHost);
+            self.mHostQueue.setdefault(sHost, deque()).append(waiter);
+        try:
+            await waiter.fut;
+        except asyncio.CancelledError:
+            if (waiter.fut.done() and not waiter.fut.cancelled()):
+                # granted right before being cancelled
+                self.release(sUrl);
+            elif (waiter.isReserved):
+                self._freeHost(sHost);
+            raise;
+    def tryAcquire(self, sUrl=None):
+        # takes a slot only if one is free right now and nobody is waiting for it
+        sHost = self._getHost(sUrl) if sUrl else None;
+        if (self.nFree <= 0 or sHost is not None and (self.mHost.setdefault(sHost, self.nPerHostLimit) <= 0 or self.mHostQueue.get(sHost))):
+            return False;
+        if (sHost is not None):
             self.mHost[sHost] -= 1;
         self.nFree -= 1;
+        return True;
     def release(self, sUrl=None):
-        self.nFree += 1;
-        if (self.nFree > self.nTotalLimit):
-            log.error('excessive release regarding total limit!');
         if (sUrl):
-            sHost = self._getHost(sUrl);
-            self.mHost[sHost] += 1;
-            if (self.mHost[sHost] > self.nPerHostLimit):
-                log.error('excessive release regarding "{}"!'.format(sHost));
-        self.fut.set_result(None);
-        self.fut = self.loop.create_future();
+            self._freeHost(self._getHost(sUrl));
+        self._freeGlobal();
 perHostLock = PerHostLock();
 
+def getEndpoint(sUrl):
+    # host and path with numbers folded, so that pages of the same kind share statistics
+    aParts = urllib.parse.urlsplit(sUrl);
+    return aParts.netloc + re.sub(r'\d+', '#', aParts.path);
+
+class ByteReservation():
+    def __init__(self, budget, sUrl, nSize):
+        self.budget = budget;
+        self.sUrl = sUrl;
+        self.nSize = nSize; # bytes counted against the budget
+        self.nRead = 0;
+    def update(self, nRead):
+        # grows without blocking, so a read already admitted never stalls halfway
+        self.nRead = nRead;
+        if (nRead > self.nSize):
+            self.budget.nUsed += nRead - self.nSize;
+            self.nSize = nRead;
+    async def __aenter__(self):
+        return self;
+    async def __aexit__(self, *arg, **karg):
+        self.budget.learn(self.sUrl, self.nRead);
+        self.budget.release(self.nSize);
+
+class ByteBudget():
+    # admission by bytes: a body is read only once its estimated size fits into the budget, in arrival order
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop();
+        self.nTotal = config.nByteBudget or float('inf');
+        self.nUsed = 0;
+        self.aWaiter = deque(); # [size, future]
+        self.mHistory = {};
+    def estimate(self, sUrl, res=None):
+        sLength = res.headers.get('Content-Length') if res is not None else None;
+        if (sLength and sLength.isdigit()):
+            return int(sLength);
+        return self.mHistory.get(getEndpoint(sUrl)) or config.nByteEstimate;
+    def learn(self, sUrl, nSize):
+        if (not nSize):
+            return;
+        sEndpoint = getEndpoint(sUrl);
+        # decaying maximum, so estimates lean towards the large pages of an endpoint
+        self.mHistory[sEndpoint] = max(nSize, int(self.mHistory.get(sEndpoint, 0) * 0.9));
+    async def reserve(self, sUrl, res=None):
+        nSize = min(self.estimate(sUrl, res), self.nTotal);
+        if (not self.aWaiter and self.nUsed + nSize <= self.nTotal):
+            self.nUsed += nSize;
+        else:
+            aWaiter = [nSize, self.loop.create_future()];
+            self.aWaiter.append(aWaiter);
+            try:
+                await aWaiter[1];
+            except asyncio.CancelledError:
+                if (aWaiter[1].done() and not aWaiter[1].cancelled()):
+                    self.release(nSize);
+                else:
+                    self._wake();
+                raise;
+        return ByteReservation(self, sUrl, nSize);
+    def release(self, nSize):
+        self.nUsed -= nSize;
+        self._wake();
+    def _wake(self):
+        while self.aWaiter:
+            nSize, fut = self.aWaiter[0];
+            if (fut.done()):
+                self.aWaiter.popleft();
+            elif (self.nUsed + nSize <= self.nTotal or self.nUsed <= 0):
+                self.aWaiter.popleft();
+                self.nUsed += nSize;
+                fut.set_result(None);
+            else:
+                break;
+    def getStats(self):
+        return {'used': self.nUsed, 'total': self.nTotal, 'waiting': len(self.aWaiter)};
+byteBudget = ByteBudget();
+
+class TokenBucket():
+    # tokens are reserved in advance so a caller only sleeps for its own turn and nobody is woken in vain
+    def __init__(self, nFloor, nCeiling, loop=None):
+        self.loop = loop or asyncio.get_event_loop();
+        assert 0 < nFloor <= nCeiling;
+        self.nFloor = nFloor;
+        self.nCeiling = nCeiling;
+        self.nRate = max(nFloor, nCeiling / 2);
+        self.nBurst = 1;
+        self.nTokens = self.nBurst;
+        self.nUpdated = self.loop.time();
+        self.nDecreased = 0;
+        self.nLatency = None;
+    def _refill(self):
+        nNow = self.loop.time();
+        self.nTokens = min(self.nBurst, self.nTokens + (nNow - self.nUpdated) * self.nRate);
+        self.nUpdated = nNow;
+    async def take(self):
+        self._refill();
+        self.nTokens -= 1;
+        if (self.nTokens < 0):
+            await asyncio.sleep(-self.nTokens / self.nRate);
+    def increase(self):
+        self._refill();
+        self.nRate = min(self.nCeiling, self.nRate + config.nRateIncrease / self.nRate);
+    def getWait(self):
+        # seconds until a token taken now would be due
+        self._refill();
+        return max(0, (1 - self.nTokens) / self.nRate);
+    def decrease(self):
+        # only once per interval between two requests at the reduced rate, so a burst of failures already in flight counts once
+        nNow = self.loop.time();
+        if (nNow - self.nDecreased < 1 / self.nRate):
+            return False;
+        self._refill();
+        self.nRate = max(self.nFloor, self.nRate * config.nRateDecrease);
+        self.nDecreased = nNow;
+        return True;
+
+class RateLimiter():
+    aThrottleStatus = (418, 429);
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop();
+        self.mBucket = {};
+    def _getHost(self, sUrl):
+        return urllib.parse.urlsplit(sUrl).netloc;
+    def getBucket(self, sUrl, sProxy=None):
+        # the limits of a host hold per egress address, so every proxy has buckets of its own
+        sHost = self._getHost(sUrl);
+        key = (sHost, sProxy) if sProxy else sHost;
+        if (key not in self.mBucket):
+            aLimit = config.mRateLimit.get(sHost) or config.aDefaultRateLimit;
+            self.mBucket[key] = TokenBucket(*aLimit, loop=self.loop) if aLimit else None;
+        return self.mBucket[key];
+    async def acquire(self, sUrl, sProxy=None):
+        bucket = self.getBucket(sUrl, sProxy);
+        if (bucket):
+            await bucket.take();
+    def feedback(self, sUrl, nStatus=None, nLatency=None, isFailed=False, sProxy=None):
+        bucket = self.getBucket(sUrl, sProxy);
+        if (not bucket):
+            return;
+        if (isFailed or nStatus in self.aThrottleStatus or nStatus and nStatus >= 500):
+            if (bucket.decrease()):
+                log.debug('request rate of "{}"{} decreased to {:.2f}/s (status {})'.format(self._getHost(sUrl), ' via ' + sProxy if sProxy else '', bucket.nRate, nStatus));
+        elif (nLatency is not None):
+            if (bucket.nLatency and nLatency > bucket.nLatency * config.nSlowFactor):
+                bucket.decrease();
+            else:
+                bucket.increase();
+            bucket.nLatency = nLatency if bucket.nLatency is None else bucket.nLatency * 0.9 + nLatency * 0.1;
+rateLimiter = RateLimiter();
+
+class ProxyState():
+    def __init__(self, sProxy):
+        self.sProxy = sProxy;
+        self.aOutcome = deque(); # (time, isOk) within config.nProxyWindow
+        self.nLatency = None; # moving average of seconds to the response headers
+        self.nActive = 0;
+        self.nDownUntil = 0;
+        self.nRequests = 0;
+        self.nErrors = 0;
+    def _trim(self, nNow):
+        while self.aOutcome and nNow - self.aOutcome[0][0] > config.nProxyWindow:
+            self.aOutcome.popleft();
+    def getErrorRate(self):
+        self._trim(time.time());
+        if (not self.aOutcome):
+            return 0;
+        return sum(1 for nTime, isOk in self.aOutcome if not isOk) / len(self.aOutcome);
+
+class ProxyPool():
+    # spreads requests over egress proxies by the expected time to a response: the wait for a token of the proxy for that host,
+    # plus its latency with the requests it already carries, inflated by its error rate
+    # a proxy failing too often is left out for config.nProxyCooldown; hosts of config.aStickyHosts keep their proxy while it is up, for their cookies
+    def __init__(self, aProxies=None):
+        self.mProxy = {sProxy: ProxyState(sProxy) for sProxy in (aProxies if aProxies is not None else config.aProxies)};
+        self.mSticky = {}; # host -> proxy
+    def _isUp(self, state, nNow):
+        if (state.nDownUntil and nNow >= state.nDownUntil):
+            state.nDownUntil = 0;
+            state.aOutcome.clear();
+            log.info('proxy {} back after cool-down'.format(state.sProxy));
+        return not state.nDownUntil;
+    def _getCost(self, state, sUrl):
+        bucket = rateLimiter.getBucket(sUrl, state.sProxy);
+        nWait = bucket.getWait() if bucket else 0;
+        nLatency = state.nLatency or 1;
+        return (nWait + nLatency * (1 + state.nActive)) / max(0.05, 1 - state.getErrorRate());
+    def pick(self, sUrl):
+        # None when there is no proxy to use
+        if (not self.mProxy):
+            return None;
+        nNow = time.time();
+        sHost = urllib.parse.urlsplit(sUrl).netloc;
+        isSticky = sHost in config.aStickyHosts;
+        if (isSticky):
+            state = self.mProxy.get(self.mSticky.get(sHost));
+            if (state and self._isUp(state, nNow)):
+                state.nActive += 1;
+                return state.sProxy;
+        aUp = [state for state in self.mProxy.values() if self._isUp(state, nNow)];
+        if (aUp):
+            state = min(aUp, key=lambda state: (self._getCost(state, sUrl), random.random()));
+        else:
+            state = min(self.mProxy.values(), key=lambda state: state.nDownUntil);
+            log.warning('every proxy is cooling down, using {} anyway'.format(state.sProxy));
+        if (isSticky):
+            if (self.mSticky.get(sHost) not in (None, state.sProxy)):
+                log.info('"{}" moved from proxy {} to {}'.format(sHost, self.mSticky[sHost], state.sProxy));
+            self.mSticky[sHost] = state.sProxy;
+        state.nActive += 1;
+        return state.sProxy;
+    def done(self, sProxy):
+        state = self.mProxy.get(sProxy);
+        if (state):
+            state.nActive -= 1;
+    def record(self, sProxy, nStatus=None, nLatency=None, error=None):
+        state = self.mProxy.get(sProxy);
+        if (not state):
+            return;
+        nNow = time.time();
+        # bad gateways and dropped connections are blamed on the proxy, other statuses on the host
+        isOk = error is None and nStatus not in (407, 502, 503, 504);
+        state.nRequests += 1;
+        state.aOutcome.append((nNow, isOk));
+        if (nLatency is not None):
+            state.nLatency = nLatency if state.nLatency is None else state.nLatency * 0.8 + nLatency * 0.2;
+        if (isOk):
+            return;
+        state.nErrors += 1;
+        state._trim(nNow);
+        if (not state.nDownUntil and len(state.aOutcome) >= config.nProxyMinRequests and state.getErrorRate() >= config.nProxyThreshold):
+            state.nDownUntil = nNow + config.nProxyCooldown;
+            log.warning('proxy {} taken out for {}s, error rate {:.0%}'.format(sProxy, config.nProxyCooldown, state.getErrorRate()));
+    def getStats(self):
+        nNow = time.time();
+        return {
+                sProxy: {
+                    'up': self._isUp(state, nNow),
+                    'active': state.nActive,
+                    'error rate': state.getErrorRate(),
+                    'latency': state.nLatency,
+                    'requests': state.nRequests,
+                    'errors': state.nErrors
+                }
+                for sProxy, state in self.mProxy.items()
+        };
+proxyPool = ProxyPool();
+
+class CircuitOpenError(Exception):
+    def __init__(self, *arg, sHost=None, **karg):
+        super().__init__(*arg, **karg);
+        self.sHost = sHost;
+
+class HostHealth():
+    def __init__(self, sHost):
+        self.sHost = sHost;
+        self.sState = 'closed';
+        self.aOutcome = deque(); # (time, isOk) within the window
+        self.aLatency = deque(maxlen=1000);
+        self.nOpened = 0;
+        self.nProbe = 0; # start time of the probe in flight when half-open
+        self.nRequests = 0;
+        self.nErrors = 0;
+    def _trim(self, nNow):
+        while self.aOutcome and nNow - self.aOutcome[0][0] > config.nBreakerWindow:
+            self.aOutcome.popleft();
+    def getErrorRate(self):
+        self._trim(time.time());
+        if (not self.aOutcome):
+            return 0;
+        return sum(1 for nTime, isOk in self.aOutcome if not isOk) / len(self.aOutcome);
+    def getPercentile(self, nPercent):
+        if (not self.aLatency):
+            return None;
+        aSorted = sorted(self.aLatency);
+        return aSorted[min(len(aSorted)-1, int(len(aSorted) * nPercent / 100))];
+
+class CircuitBreaker():
+    # closed: requests pass; open: requests fail fast; half-open: a single probe decides whether to close again
+    def __init__(self):
+        self.mHost = {};
+    def _getHealth(self, sUrl):
+        sHost = urllib.parse.urlsplit(sUrl).netloc;
+        health = self.mHost.get(sHost);
+        if (health is None):
+            health = self.mHost[sHost] = HostHealth(sHost);
+        return health;
+    def check(self, sUrl, isProbe=True):
+        # raise CircuitOpenError if the host should not be contacted now; with isProbe an expired open circuit turns half-open and lets this request through as probe
+        health = self._getHealth(sUrl);
+        nNow = time.time();
+        if (health.sState == 'closed'):
+            return;
+        elif (health.sState == 'open' and nNow - health.nOpened < config.nBreakerCooldown):
+            raise CircuitOpenError('circuit of "{}" is open'.format(health.sHost), sHost=health.sHost);
+        elif (health.sState == 'half-open' and nNow - health.nProbe < config.nReadTimeout):
+            raise CircuitOpenError('circuit of "{}" is half-open and probing'.format(health.sHost), sHost=health.sHost);
+        elif (isProbe):
+            health.sState = 'half-open';
+            health.nProbe = nNow;
+            log.info('circuit of "{}" half-open, probing'.format(health.sHost));
+    def record(self, sUrl, isOk, nLatency=None):
+        health = self._getHealth(sUrl);
+        nNow = time.time();
+        health.nRequests += 1;
+        if (not isOk):
+            health.nErrors += 1;
+        if (nLatency is not None):
+            health.aLatency.append(nLatency);
+        if (health.sState == 'half-open'):
+            if (isOk):
+                health.sState = 'closed';
+                health.aOutcome.clear();
+                log.info('circuit of "{}" closed'.format(health.sHost));
+            else:
+                health.sState = 'open';
+                health.nOpened = nNow;
+                log.warning('probe failed, circuit of "{}" open again'.format(health.sHost));
+            return;
+        health.aOutcome.append((nNow, isOk));
+        if (health.sState == 'closed' and not isOk):
+            health._trim(nNow);
+            if (len(health.aOutcome) >= config.nBreakerMinRequests and health.getErrorRate() >= config.nBreakerThreshold):
+                health.sState = 'open';
+                health.nOpened = nNow;
+                log.warning('circuit of "{}" open, error rate {:.0%}'.format(health.sHost, health.getErrorRate()));
+    def getHealth(self):
+        return {
+                sHost: {
+                    'state': health.sState,
+                    'error rate': health.getErrorRate(),
+                    'p50': health.getPercentile(50),
+                    'p99': health.getPercentile(99),
+                    'requests': health.nRequests,
+                    'errors': health.nErrors
+                }
+                for sHost, health in self.mHost.items()
+        };
+circuitBreaker = CircuitBreaker();
+
+def getSslContext():
+    # one context for every connection so that certificates are loaded once and the context is shared by the whole pool
+    global sslContext;
+    if (sslContext is None):
+        sslContext = ssl.create_default_context();
+    return sslContext;
+
+def getHttp2SslContext():
+    # the context of the http2 sessions, apart from the one of aiohttp: httpx offers h2 by ALPN on the context it is given,
+    # which would have hosts speaking HTTP/2 on the HTTP/1.1 connections of aiohttp too
+    global http2SslContext;
+    if (http2SslContext is None):
+        http2SslContext = ssl.create_default_context();
+    return http2SslContext;
+
+def newConnector(nLimit=None, nLimitPerHost=None):
+    return aiohttp.TCPConnector(
+            limit=nLimit or 0,
+            limit_per_host=nLimitPerHost or 0,
+            keepalive_timeout=config.nKeepAlive,
+            use_dns_cache=True,
+            ttl_dns_cache=config.nDnsCacheTtl,
+            ssl=getSslContext(),
+            enable_cleanup_closed=True
+    );
+
+def getConnector():
+    global aiohttpConnector;
+    if (aiohttpConnector is None or aiohttpConnector.closed):
+        aiohttpConnector = newConnector(config.nFetchLimit, config.nLimitPerHost);
+    return aiohttpConnector;
+
+def newAiohttpSession(mHeaders, connector=None):
+    # sessions only carry headers and cookies, connections are borrowed from the process-wide pool unless another one is given
+    return aiohttp.ClientSession(connector=connector or getConnector(), connector_owner=False, headers=mHeaders, trust_env=True, read_timeout=config.nReadTimeout);
+
+def newHttp2Session(mHeaders, connector=None):
+    # every session keeps its own HTTP/2 connections, a connection per host carries all its requests
+    return Http2Session(mHeaders, nLimit=config.nFetchLimit, nTimeout=config.nReadTimeout, ssl=getHttp2SslContext());
+
+# name -> factory(mHeaders, connector) of sessions the fetch functions take
+mTransport = {
+        'aiohttp': newAiohttpSession,
+        'http2': newHttp2Session
+};
+
+def newSession(mHeaders=None, connector=None, sTransport=None):
+    mHeaders = mHeaders or {'User-Agent': UA};
+    return mTransport[sTransport or config.sTransport](mHeaders, connector);
+
+def getSessionHeaders(session):
+    # default headers a session sends with every request
+    headers = getattr(session, 'headers', None);
+    if (headers is None):
+        headers = getattr(session, 'mClientArg', {}).get('headers');
+    return dict(headers or {});
+
+def getSessionCookies(session, sUrl):
+    # the Cookie header a session would send to sUrl
+    if (hasattr(session, 'cookie_jar')):
+        return '; '.join('{}={}'.format(key, morsel.value) for key, morsel in sorted(session.cookie_jar.filter_cookies(yarl.URL(sUrl)).items()));
+    elif (hasattr(session, 'getCookies')):
+        return session.getCookies(sUrl);
+    return '';
+
 def getDefaultSession():
     global aiohttpSession;
     if (aiohttpSession is None or aiohttpSession.closed):
@@ -250,20 +1092,257 @@ def initSession():
         log.warning('aiohttp session is already alive.');
         return False;
     else:
-        mHeaders = {'User-Agent': UA};
-        connector = aiohttp.TCPConnector(force_close=True, enable_cleanup_closed=True);
-        aiohttpSession = aiohttp.ClientSession(connector=connector, headers=mHeaders, trust_env=True, read_timeout=config.nReadTimeout);
+        aiohttpSession = newSession({'User-Agent': UA});
+
+def openArchive(sPath=None, sMode=None):
+    # from now on every response is recorded to the archive, or served from it without network in replay mode
+    global responseArchive;
+    closeArchive();
+    responseArchive = ResponseArchive(sPath or config.sArchiveFile, sMode or config.sArchiveMode);
+    log.info('response archive "{}" opened for {}'.format(responseArchive.sPath, responseArchive.sMode));
+    return responseArchive;
+
+def closeArchive():
+    global responseArchive;
+    if (responseArchive):
+        responseArchive.close();
+        responseArchive = None;
+
+def getArchive():
+    if (responseArchive is None and config.sArchiveFile):
+        openArchive();
+    return responseArchive;
+
+def getMediaStore():
+    global mediaStore;
+    if (mediaStore is None and config.sStoreDir):
+        mediaStore = MediaStore(config.sStoreDir);
+    return mediaStore;
 
 async def cleanup():
-    global aiohttpSession;
+    global aiohttpSession, mediaStore;
+    if (responseArchive):
+        await responseArchive.join();
+    closeArchive();
+    worker.cleanup();
+    if (mediaStore):
+        mediaStore.close();
+        mediaStore = None;
     if (aiohttpSession):
         await aiohttpSession.close();
+    if (aiohttpConnector and not aiohttpConnector.closed):
+        await aiohttpConnector.close();
+
+class InvalidJsonError(ValueError):
+    pass
+
+jsonTypePattern = re.compile(r'application/(?:[\w.+-]+?\+)?json'); # the types aiohttp's ClientResponse.json accepts as JSON
+
+aTransferError = (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError);
+pendingOutcome = contextvars.ContextVar('pendingOutcome', default=None); # [(url, ok, latency)] the breaker gets once the attempt being run has read its body
+
+def _observe(sUrl, nStatus=None, nLatency=None, error=None, sProxy=None):
+    # feed outcomes of single requests to the adaptive parts of the fetch layer; errors carrying a response are reported by _send already
+    if (error is None):
+        rateLimiter.feedback(sUrl, nStatus, nLatency, sProxy=sProxy);
+        proxyPool.record(sProxy, nStatus, nLatency);
+        aPending = pendingOutcome.get();
+        if (aPending is None):
+            circuitBreaker.record(sUrl, nStatus < 500, nLatency);
+        else:
+            aPending.append((sUrl, nStatus < 500, nLatency));
+    elif (isinstance(error, aTransferError)):
+        if (not getattr(error, 'sProxy', None)):
+            # a request failing through a proxy has slowed down the bucket of the host via that proxy in _send already
+            rateLimiter.feedback(sUrl, isFailed=True);
+        circuitBreaker.record(sUrl, False);
+
+def _settle(aPending, error=None):
+    # a body failing to arrive after its headers makes the request a single failure, which _observe records, instead of a success and a failure
+    isBroken = isinstance(error, aTransferError);
+    for sUrl, isOk, nLatency in aPending:
+        if (not (isOk and isBroken)):
+            circuitBreaker.record(sUrl, isOk, nLatency);
+
+class RetryPolicy():
+    aDefaultRetryOn = ('timeout', 'connection', 'throttle', 'server', 'json', 'assertion', 'checksum', 'resume');
+    aThrottleStatus = (418, 429);
+    def __init__(self, nCount=None, nBase=2, nCap=60, aRetryOn=None, nBudgetRatio=0.2, nBudgetMin=3, nBudgetWindow=10, nMaxRetryAfter=300):
+        self.nCount = nCount or None; # falls back to config.nRetryCount at run time
+        self.nBase = nBase;
+        self.nCap = nCap;
+        self.aRetryOn = tuple(aRetryOn) if aRetryOn is not None else self.aDefaultRetryOn;
+        self.nBudgetRatio = nBudgetRatio;
+        self.nBudgetMin = nBudgetMin;
+        self.nBudgetWindow = nBudgetWindow;
+        self.nMaxRetryAfter = nMaxRetryAfter;
+        self.mBudget = {};
+    def classify(self, e):
+        if (isinstance(e, CircuitOpenError)):
+            return 'circuit';
+        elif (isinstance(e, asyncio.TimeoutError)):
+            return 'timeout';
+        elif (isinstance(e, (json.JSONDecodeError, InvalidJsonError, aiohttp.ContentTypeError))):
+            return 'json';
+        elif (isinstance(e, ResponseClosedError)):
+            return 'closed';
+        elif (isinstance(e, AssertionError)):
+            return 'assertion';
+        elif (isinstance(e, ChecksumError)):
+            return 'checksum';
+        elif (isinstance(e, ResumeError)):
+            return 'resume';
+        elif (isinstance(e, aiohttp.ClientResponseError)):
+            if (e.status in self.aThrottleStatus):
+                return 'throttle';
+            elif (e.status >= 500):
+                return 'server';
+            else:
+                return 'client';
+        elif (isinstance(e, aiohttp.ClientError)):
+            return 'connection';
+        else:
+            return None;
+    def getRetryAfter(self, e):
+        sValue = (getattr(e, 'headers', None) or {}).get('Retry-After');
+        if (not sValue):
+            return None;
+        try:
+            return max(0, float(sValue));
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(sValue);
+        except (TypeError, ValueError):
+            return None;
+        return max(0, date.timestamp() - time.time());
+    def getDelay(self, nRetry, e=None):
+        # full jitter: uniform between 0 and the exponentially growing cap
+        nDelay = random.uniform(0, min(self.nCap, self.nBase * 2 ** (nRetry-1)));
+        nAfter = self.getRetryAfter(e) if e is not None else None;
+        if (nAfter is not None):
+            nDelay = max(nDelay, min(nAfter, self.nMaxRetryAfter));
+        return nDelay;
+    def _getBudget(self, sUrl):
+        sHost = urllib.parse.urlsplit(sUrl).netloc;
+        nNow = time.time();
+        aBudget = self.mBudget.get(sHost);
+        if (not aBudget or nNow - aBudget[0] > self.nBudgetWindow):
+            # [window start, requests, retries]
+            aBudget = self.mBudget[sHost] = [nNow, 0, 0];
+        return aBudget;
+    def allowRetry(self, sUrl):
+        aBudget = self._getBudget(sUrl);
+        if (aBudget[2] >= self.nBudgetMin + self.nBudgetRatio * aBudget[1]):
+            return False;
+        aBudget[2] += 1;
+        return True;
+    async def run(self, sUrl, attempt):
+        nCount = self.nCount or config.nRetryCount;
+        nRetry = 0;
+        while True:
+            self._getBudget(sUrl)[1] += 1;
+            aPending = [];
+            token = pendingOutcome.set(aPending);
+            try:
+                try:
+                    result = await attempt();
+                finally:
+                    pendingOutcome.reset(token);
+            except Exception as e:
+                _settle(aPending, e);
+                _observe(sUrl, error=e);
+                sKind = self.classify(e);
+                if (sKind not in self.aRetryOn):
+                    raise;
+                nRetry += 1;
+                if (nRetry >= nCount):
+                    log.warning('{} error when getting {}, giving up after {} attempts: {}'.format(sKind, sUrl, nRetry, e));
+                    raise;
+                if (not self.allowRetry(sUrl)):
+                    log.warning('{} error when getting {}, retry budget of the host exhausted: {}'.format(sKind, sUrl, e));
+                    raise;
+                nDelay = self.getDelay(nRetry, e);
+                log.warning('{} error when getting {}, retry in {:.1f}s: {}'.format(sKind, sUrl, nDelay, e));
+                await asyncio.sleep(nDelay);
+            else:
+                _settle(aPending);
+                return result;
+defaultRetry = RetryPolicy();
+
+class Coalescer():
+    # concurrent identical requests share one in-flight fetch and its parsed result, so callers must not mutate what they get
+    def __init__(self):
+        self.mFlight = {};
+        self.nHit = 0;
+        self.nMiss = 0;
+    def makeKey(self, sMethod, sUrl, mHeaders=None, session=None, *aExtra):
+        # the session carries default headers and cookies, so requests of different sessions are never merged
+        aHeaders = tuple(sorted((str(key).lower(), str(value)) for key, value in (mHeaders or {}).items()));
+        return (sMethod, sUrl, aHeaders, id(session)) + aExtra;
+    async def run(self, key, fetch):
+        aFlight = self.mFlight.get(key);
+        if (aFlight):
+            self.nHit += 1;
+        else:
+            self.nMiss += 1;
+            task = asyncio.ensure_future(fetch());
+            # [task, number of waiters]
+            aFlight = self.mFlight[key] = [task, 0];
+            task.add_done_callback(lambda task: self.mFlight.pop(key, None) if self.mFlight.get(key) is aFlight else None);
+        task = aFlight[0];
+        aFlight[1] += 1;
+        try:
+            return await asyncio.shield(task);
+        except asyncio.CancelledError:
+            if (not task.done() and aFlight[1] == 1):
+                task.cancel();
+            raise;
+        finally:
+            aFlight[1] -= 1;
+    def getStats(self):
+        return {'hit': self.nHit, 'miss': self.nMiss, 'in flight': len(self.mFlight)};
+coalescer = Coalescer();
+
+async def _send(session, sUrl, mHeaders=None, sMethod='GET'):
+    archive = getArchive();
+    if (archive and archive.isReplay):
+        return archive.replay(sMethod, sUrl);
+    circuitBreaker.check(sUrl);
+    sProxy = proxyPool.pick(sUrl);
+    try:
+        await rateLimiter.acquire(sUrl, sProxy);
+        nStart = time.time();
+        try:
+            if (sProxy):
+                res = await session.request(sMethod, sUrl, headers=mHeaders, proxy=sProxy);
+            else:
+                res = await session.request(sMethod, sUrl, headers=mHeaders);
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            if (sProxy):
+                e.sProxy = sProxy;
+                rateLimiter.feedback(sUrl, isFailed=True, sProxy=sProxy);
+                proxyPool.record(sProxy, error=e);
+            raise;
+    finally:
+        proxyPool.done(sProxy);
+    _observe(sUrl, res.status, time.time() - nStart, sProxy=sProxy);
+    if (archive):
+        # recorded as it is read by the caller, through the same size caps and byte budget
+        return RecordingResponse(res, archive, sMethod, sUrl);
+    return res;
+
+class ResponseClosedError(RuntimeError):
+    # the Response was closed while its request was being retried, attempting it again would be pointless
+    pass
 
 class Response():
-    def __init__(self, sUrl, mHeaders=None, session=None):
+    def __init__(self, sUrl, mHeaders=None, session=None, retry=None, sMethod='GET'):
         self.sUrl = sUrl;
         self.mHeaders = mHeaders;
+        self.sMethod = sMethod or 'GET';
         self.session = session or getDefaultSession();
+        self.retry = retry or defaultRetry;
         self.res = None;
         self._closed = False;
         self._started = False;
@@ -287,148 +1366,622 @@ class Response():
         if (self._started or self._closed):
             raise RuntimeError;
         self._started = True;
+        try:
+            circuitBreaker.check(self.sUrl, isProbe=False);
+        except CircuitOpenError:
+            self._closed = True;
+            raise;
         await perHostLock.acquire(self.sUrl);
-        nCount = 0;
-        while nCount < config.nRetryCount:
+        async def attempt():
+            if (self._closed):
+                raise ResponseClosedError('{} was closed before it was fetched'.format(self.sUrl));
+            res = await _send(self.session, self.sUrl, self.mHeaders, self.sMethod);
             try:
-                assert self._closed is False;
-                self.res = await self.session.get(self.sUrl, headers=self.mHeaders)
-                self.res.raise_for_status();
-                return self.res;
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                info = self.res.request_info if self.res else self.sUrl;
-                log.warning('failed to get response from {}: {}'.format(info, e));
-                if (nCount+1 >= config.nRetryCount):
-                    self.close();
-                    raise;
+                res.raise_for_status();
             except:
-                self.close();
+                res.release();
                 raise;
-            nCount += 1
-            asyncio.sleep(3*nCount);
-        
-async def fetchBytes(sUrl, mHeaders=None, session=None):
+            self.res = res;
+            return res;
+        try:
+            return await self.retry.run(self.sUrl, attempt);
+        except:
+            self.close();
+            raise;
+
+class Hedger():
+    # for idempotent requests: once a fetch outlives the usual latency of its host, a duplicate is sent and the first response wins
+    def __init__(self):
+        self.mHost = {}; # host: [recent durations, requests, hedges]
+        self.nHedge = 0;
+        self.nWin = 0;
+    def _getHost(self, sUrl):
+        sHost = urllib.parse.urlsplit(sUrl).netloc;
+        aHost = self.mHost.get(sHost);
+        if (aHost is None):
+            aHost = self.mHost[sHost] = [deque(maxlen=500), 0, 0];
+        return aHost;
+    def getDelay(self, sUrl):
+        aDuration = self._getHost(sUrl)[0];
+        if (len(aDuration) < config.nHedgeMinSamples):
+            return None;
+        aSorted = sorted(aDuration);
+        return aSorted[min(len(aSorted)-1, int(len(aSorted) * config.nHedgeQuantile / 100))];
+    def _allow(self, sUrl):
+        aHost = self._getHost(sUrl);
+        if (aHost[2] + 1 > aHost[1] * config.nHedgeRatio):
+            return False;
+        aHost[2] += 1;
+        return True;
+    async def run(self, sUrl, fetch):
+        aHost = self._getHost(sUrl);
+        aHost[1] += 1;
+        nDelay = self.getDelay(sUrl);
+        nStart = time.time();
+        first = asyncio.ensure_future(fetch());
+        aPending = {first};
+        try:
+            if (nDelay is not None):
+                await asyncio.wait(aPending, timeout=nDelay);
+                if (not first.done() and self._allow(sUrl)):
+                    self.nHedge += 1;
+                    log.debug('hedging {} after {:.2f}s'.format(sUrl, nDelay));
+                    aPending.add(asyncio.ensure_future(fetch()));
+            error = None;
+            while aPending:
+                aDone, aPending = await asyncio.wait(aPending, return_when=asyncio.FIRST_COMPLETED);
+                for task in aDone:
+                    if (task.exception() is None):
+                        if (task is not first):
+                            self.nWin += 1;
+                        aHost[0].append(time.time() - nStart);
+                        return task.result();
+                    error = error or task.exception();
+            raise error;
+        finally:
+            for task in aPending:
+                task.cancel();
+    def getStats(self):
+        return {'requests': sum(aHost[1] for aHost in self.mHost.values()), 'hedged': self.nHedge, 'won by hedge': self.nWin};
+hedger = Hedger();
+
+class ResponseTooLargeError(Exception):
+    def __init__(self, *arg, nSize=None, **karg):
+        super().__init__(*arg, **karg);
+        self.nSize = nSize;
+
+class Body(bytes):
+    # a body with what decoding it takes from its response: the charset of the transport, and the URL the encoding is cached for
+    def __new__(cls, bData, sCharset=None, sUrl=None):
+        body = super().__new__(cls, bData);
+        body.sCharset = sCharset;
+        body.sUrl = sUrl;
+        return body;
+    def __reduce__(self):
+        return Body, (bytes(self), self.sCharset, self.sUrl);
+
+class SpilledBody(mmap.mmap):
+    # a read-only mapping of the temporary file a body was spilled to, which stays open as long as a mapping of it does
+    sCharset = None;
+    sUrl = None;
+    def remap(self):
+        # a mapping of its own, with its own position, for another reader of the same body
+        body = SpilledBody(self.file.fileno(), 0, access=mmap.ACCESS_READ);
+        body.file = self.file;
+        body.sCharset = self.sCharset;
+        body.sUrl = self.sUrl;
+        return body;
+    def toBody(self):
+        # a copy of it as a Body, for what mappings do not go to, such as a worker process
+        return Body(self[:], self.sCharset, self.sUrl);
+
+class BodyReader():
+    # reads bodies up to a cap; only if asked for with a spill size, a body growing over it goes to a temporary file
+    # and comes back as a read-only SpilledBody, an mmap.mmap which the regex matchers and Source.parse take as they take bytes
+    nBuffer = 256*1024;
+    def __init__(self):
+        self.nAborted = 0;
+        self.nSpilled = 0;
+    async def read(self, res, nMaxSize=None, nSpillSize=None):
+        nMaxSize = nMaxSize or config.nMaxBodySize or float('inf');
+        nSpillSize = nSpillSize or float('inf');
+        sLength = res.headers.get('Content-Length');
+        if (sLength and sLength.isdigit() and int(sLength) > nMaxSize):
+            self.nAborted += 1;
+            raise ResponseTooLargeError('response of {} announces {} bytes, over the cap of {}'.format(res.url, sLength, nMaxSize), nSize=int(sLength));
+        aChunks = [];
+        nSize = 0;
+        file = None;
+        try:
+            async with await byteBudget.reserve(str(res.url), res) as reservation:
+                while True:
+                    bChunk = await res.content.read(self.nBuffer);
+                    if (not bChunk):
+                        break;
+                    nSize += len(bChunk);
+                    if (nSize > nMaxSize):
+                        self.nAborted += 1;
+                        raise ResponseTooLargeError('response of {} exceeds the cap of {} bytes'.format(res.url, nMaxSize), nSize=nSize);
+                    reservation.update(min(nSize, nSpillSize));
+                    if (file is None and nSize > nSpillSize):
+                        file = tempfile.TemporaryFile(dir=config.sSpillDir);
+                        for bData in aChunks:
+                            file.write(bData);
+                        aChunks = None;
+                    if (file):
+                        file.write(bChunk);
+                    else:
+                        aChunks.append(bChunk);
+            if (file is None):
+                return b''.join(aChunks);
+            file.flush();
+            self.nSpilled += 1;
+            log.debug('{} bytes of {} spilled to disk'.format(nSize, res.url));
+            body = SpilledBody(file.fileno(), 0, access=mmap.ACCESS_READ);
+            body.file = file;
+            file = None;
+            return body;
+        finally:
+            if (file):
+                file.close();
+    def getStats(self):
+        return {'aborted': self.nAborted, 'spilled': self.nSpilled};
+bodyReader = BodyReader();
+
+async def _readBody(session, sUrl, mHeaders=None, cache=None, nMaxSize=None, nSpillSize=None):
+    # returns (body, content type, charset) of a successful response, sending validators and serving 304 from the cache when one is given
+    sKey = cache.makeKey(sUrl, session, mHeaders) if cache else None;
+    mMeta = await cache.lookup(sKey) if cache else None;
+    mSend = dict(mHeaders or {}, **cache.getValidators(mMeta)) if mMeta else mHeaders;
+    async with await _send(session, sUrl, mSend) as res:
+        if (mMeta and res.status == 304):
+            return await cache.hit(sUrl, mMeta), mMeta.get('type'), mMeta.get('charset');
+        res.raise_for_status();
+        bData = await bodyReader.read(res, nMaxSize, nSpillSize);
+        if (cache):
+            await cache.store(sKey, sUrl, res, bData);
+        return bData, res.content_type, res.charset;
+
+async def fetchBytes(sUrl, mHeaders=None, session=None, retry=None, isCoalesce=False, cache=None, isHedge=False, nMaxSize=None, nSpillSize=None, isBody=False):
+    # nSpillSize: bodies larger than this come back as SpilledBody instead of bytes
+    # isBody: a body in bytes comes back as a Body, and a SpilledBody as well carries the charset of the response and sUrl
+    if (isCoalesce):
+        session = session or getDefaultSession();
+        key = coalescer.makeKey('GET', sUrl, mHeaders, session);
+        data = await coalescer.run(key, lambda: fetchBytes(sUrl, mHeaders=mHeaders, session=session, retry=retry, cache=cache, isHedge=isHedge, nMaxSize=nMaxSize, nSpillSize=nSpillSize, isBody=isBody));
+        # every waiter reads a spilled body through a mapping of its own
+        return data.remap() if isinstance(data, SpilledBody) else data;
+    circuitBreaker.check(sUrl, isProbe=False);
     await perHostLock.acquire(sUrl);
     session = session or getDefaultSession();
+    retry = retry or defaultRetry;
+    async def attempt():
+        if (isHedge):
+            bData, sType, sCharset = await hedger.run(sUrl, lambda: _readBody(session, sUrl, mHeaders, cache, nMaxSize, nSpillSize));
+        else:
+            bData, sType, sCharset = await _readBody(session, sUrl, mHeaders, cache, nMaxSize, nSpillSize);
+        if (not isBody):
+            return bData;
+        elif (isinstance(bData, SpilledBody)):
+            bData.sCharset = sCharset;
+            bData.sUrl = sUrl;
+            return bData;
+        return Body(bData, sCharset, sUrl);
     try:
-        nCount = 0;
-        while nCount < config.nRetryCount:
-            try:
-                async with session.get(sUrl, headers=mHeaders) as res:
-                    res.raise_for_status();
-                    return await res.read();
-            except aiohttp.ClientError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                log.warning('failed to read response {}: {}'.format(res.request_info, e));
-                error = e;
-            except asyncio.TimeoutError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                log.warning('timeout when getting {}: {}'.format(info, e));
-                error = e;
-            #except CancelledError as e:
-            #    log.warning('unexpected CancelledError when getting {}: {}'.format(sUrl, e));
-            #    error = e;
-            nCount += 1;
-            asyncio.sleep(3*nCount);
-        raise error;
+        return await retry.run(sUrl, attempt);
     finally:
         perHostLock.release(sUrl);
 
-async def fetchJson(sUrl, mHeaders=None, session=None, mAssert=None, isTypeCheck=True):
+async def fetchJson(sUrl, mHeaders=None, session=None, mAssert=None, isTypeCheck=True, retry=None, isCoalesce=False, cache=None, isHedge=False, nMaxSize=None):
     if (mAssert):
         assert isinstance(mAssert, dict);
+    if (isCoalesce):
+        session = session or getDefaultSession();
+        key = coalescer.makeKey('GET', sUrl, mHeaders, session, 'json', repr(sorted((mAssert or {}).items())), isTypeCheck);
+        return await coalescer.run(key, lambda: fetchJson(sUrl, mHeaders=mHeaders, session=session, mAssert=mAssert, isTypeCheck=isTypeCheck, retry=retry, cache=cache, isHedge=isHedge, nMaxSize=nMaxSize));
+    circuitBreaker.check(sUrl, isProbe=False);
     await perHostLock.acquire(sUrl);
     session = session or getDefaultSession();
+    retry = retry or defaultRetry;
+    async def attempt():
+        if (isHedge):
+            bData, sType, sCharset = await hedger.run(sUrl, lambda: _readBody(session, sUrl, mHeaders, cache, nMaxSize, float('inf')));
+        else:
+            bData, sType, sCharset = await _readBody(session, sUrl, mHeaders, cache, nMaxSize, float('inf'));
+        if (isTypeCheck and not jsonTypePattern.match(sType or '')):
+            raise InvalidJsonError('unexpected content type "{}" of JSON response {}'.format(sType, sUrl));
+        mData = codec.loads(bData, sCharset) if bData and not bData.isspace() else None;
+        if (mData is None):
+            raise InvalidJsonError('got empty JSON response {}'.format(sUrl));
+        if (mAssert):
+            for key, value in mAssert.items():
+                if (mData.get(key) != value):
+                    raise AssertionError('assertion about JSON not satisfied: "{}" = "{}" (got "{}") - {}'.format(key, value, mData.get(key), sUrl));
+        return mData;
     try:
-        nCount = 0;
-        while nCount < config.nRetryCount:
-            try:
-                async with session.get(sUrl, headers=mHeaders) as res:
-                    res.raise_for_status();
-                    typeCheck = 'application/json' if isTypeCheck else None;
-                    mData = await res.json(content_type=typeCheck);
-                    if (mData is None):
-                        raise TypeError;
-                    if (mAssert):
-                        for key, value in mAssert.items():
-                            assert mData.get(key) == value;
-                    return mData;
-            except TypeError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                log.warning('got empty JSON response {}: {}'.format(info, e));
-                error = e;
-            except AssertionError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                sMsg = 'assertion about JSON not satisfied: "{}" = "{}" (got "{}") - {}'.format(key, value, mData.get(key), info);
-                log.warning(sMsg);
-                error = AssertionError(sMsg)
-            except aiohttp.ClientError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                log.warning('failed to get JSON response {}: {}'.format(info, e));
-                error = e;
-            except asyncio.TimeoutError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                log.warning('timeout when getting JSON response {}: {}'.format(info, e));
-                error = e;
-            except json.JSONDecodeError as e:
-                info = res.request_info if locals().get('res') else sUrl;
-                log.warning('invalid JSON response {}: {}'.format(info, e));
-                error = e;
-            #except CancelledError as e:
-            #    log.warning('unexpected CancelledError when getting {}: {}'.format(sUrl, e));
-            #    error = e;
-            nCount += 1;
-            asyncio.sleep(3*nCount);
-        raise error;
+        return await retry.run(sUrl, attempt);
     finally:
         perHostLock.release(sUrl);
 
-async def fetchStream(sUrl, sDir=None, sFile=None, mHeaders=None, isDuplicate=True, session=None):
+class StreamRewriter():
+    # applies byte regex substitutions to a stream, holding back the last nHold bytes so that matches across chunk borders are not missed
+    def __init__(self, aRewrite, nHold=256):
+        self.aRewrite = aRewrite;
+        self.nHold = nHold;
+        self.bTail = b'';
+    def feed(self, bData, isFinal=False):
+        bData = self.bTail + bData;
+        for pattern, repl in self.aRewrite:
+            bData = pattern.sub(repl, bData);
+        if (isFinal):
+            self.bTail = b'';
+            return bData;
+        self.bTail = bData[-self.nHold:];
+        return bData[:-self.nHold];
+
+def parseTree(bData, sUrl=None, sCharset=None, aRewrite=None):
+    # the root element of a whole HTML document in bytes
+    for pattern, repl in aRewrite or ():
+        bData = pattern.sub(repl, bData);
+    parser = lxml.etree.HTMLParser(encoding=detectEncoding(bData, sCharset, sUrl) or 'utf-8');
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup());
+    parser.feed(bData);
+    root = parser.close();
+    if (root is None):
+        raise lxml.etree.ParserError('document of {} is empty'.format(sUrl));
+    return root;
+
+async def fetchTree(sUrl, mHeaders=None, session=None, retry=None, aRewrite=None, sStopTag=None, sStopId=None, nBuffer=64*1024, nMaxSize=None, isCoalesce=False, cache=None, isHedge=False):
+    # parse the HTML page while it is being downloaded and return the root element
+    # aRewrite: (bytes pattern, replacement) pairs applied to the stream before parsing
+    # sStopTag, sStopId: stop downloading once such an element is complete, leaving the rest of the document out of the tree
+    # isCoalesce, cache, isHedge: as of fetchBytes, whose whole body is parsed then, the stop element does not cut it short
+    if (isCoalesce or cache or isHedge):
+        bData = await fetchBytes(sUrl, mHeaders=mHeaders, session=session, retry=retry, isCoalesce=isCoalesce, cache=cache, isHedge=isHedge, nMaxSize=nMaxSize, isBody=True);
+        return parseTree(bData, sUrl, bData.sCharset, aRewrite=aRewrite);
+    circuitBreaker.check(sUrl, isProbe=False);
     await perHostLock.acquire(sUrl);
     session = session or getDefaultSession();
+    retry = retry or defaultRetry;
+    nMaxSize = nMaxSize or config.nMaxBodySize or float('inf');
+    async def attempt():
+        async with await _send(session, sUrl, mHeaders) as res:
+            res.raise_for_status();
+            rewriter = StreamRewriter(aRewrite) if aRewrite else None;
+            parser = None;
+            nSize = 0;
+            async with await byteBudget.reserve(sUrl, res) as reservation:
+                while True:
+                    bChunk = await res.content.read(nBuffer);
+                    nSize += len(bChunk);
+                    if (nSize > nMaxSize):
+                        bodyReader.nAborted += 1;
+                        raise ResponseTooLargeError('response of {} exceeds the cap of {} bytes'.format(sUrl, nMaxSize), nSize=nSize);
+                    reservation.update(nSize);
+                    bData = rewriter.feed(bChunk, not bChunk) if rewriter else bChunk;
+                    if (parser is None and (bData or not bChunk)):
+                        sEnc = detectEncoding(bData, res.charset, sUrl) or 'utf-8';
+                        if (sStopTag):
+                            parser = lxml.etree.HTMLPullParser(events=('end',), tag=sStopTag, encoding=sEnc);
+                        else:
+                            parser = lxml.etree.HTMLParser(encoding=sEnc);
+                        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup());
+                    if (bData):
+                        parser.feed(bData);
+                    if (not bChunk):
+                        break;
+                    if (sStopTag and any(sStopId is None or element.get('id') == sStopId for event, element in parser.read_events())):
+                        log.debug('stop reading {} early'.format(sUrl));
+                        await _discard(res, nSize, nBuffer);
+                        break;
+            root = parser.close();
+            if (root is None):
+                raise lxml.etree.ParserError('document of {} is empty'.format(sUrl));
+            return root;
+    try:
+        return await retry.run(sUrl, attempt);
+    finally:
+        perHostLock.release(sUrl);
+
+async def _discard(res, nRead, nBuffer):
+    # a response left unread: the rest is read and dropped when it fits in one more buffer, keeping the connection alive,
+    # otherwise the connection is closed instead of going back to the pool with the body pending
+    nLength = res.headers.get('Content-Length');
+    if (nLength and nLength.isdigit() and int(nLength) - nRead <= nBuffer and 'Content-Encoding' not in res.headers):
+        while (await res.content.read(nBuffer)):
+            pass
+    else:
+        res.close();
+
+class IncompleteDownloadError(aiohttp.ClientPayloadError):
+    pass
+
+class ResumeError(ValueError):
+    # ranges refused or answered with other ranges: the partial download is reset, nothing tells that the host is failing
+    pass
+
+class ChecksumError(ValueError):
+    pass
+
+def _writeAt(nFd, bData, nOffset):
+    view = memoryview(bData);
+    while view:
+        nWritten = os.pwrite(nFd, view, nOffset);
+        view = view[nWritten:];
+        nOffset += nWritten;
+
+def hashFile(sPath, sAlgorithm, nBuffer=1024*1024):
+    digest = hashlib.new(sAlgorithm);
+    with open(sPath, 'rb') as file:
+        for bData in iter(lambda: file.read(nBuffer), b''):
+            digest.update(bData);
+    return digest.hexdigest();
+
+class PartialDownload():
+    # a download into "<path>.part", the byte ranges already written are kept in "<path>.part.json" so that later attempts or runs resume it
+    nBuffer = 1024*1024;
+    def __init__(self, sUrl, sPath, lock=None):
+        self.sUrl = sUrl;
+        self.sPath = sPath;
+        self.lock = lock or perHostLock; # where extra host slots for parallel segments are taken from
+        self.sPart = sPath + '.part';
+        self.sState = self.sPart + '.json';
+        self.nSize = None;
+        self.sValidator = None; # strong ETag or Last-Modified sent as If-Range
+        self.sDigest = None; # Content-MD5 announced by the server
+        self.aSegments = []; # [start, end or None while unknown, bytes written]
+        self.file = None;
+        self.aWrites = set(); # writes still running in executor threads
+        self.load();
+    def load(self):
+        try:
+            with open(self.sState, 'rb') as file:
+                mState = codec.loads(file.read());
+        except (OSError, ValueError):
+            mState = None;
+        if (not mState or mState.get('url') != self.sUrl or not os.path.exists(self.sPart)):
+            self.reset();
+            return;
+        self.nSize = mState['size'];
+        self.sValidator = mState['validator'];
+        self.sDigest = mState['digest'];
+        self.aSegments = mState['segments'];
+        if (len(self.aSegments) == 1):
+            # a single stream is written in order, what reached the disk is what is done
+            self.aSegments[0][2] = os.path.getsize(self.sPart);
+        log.debug('resuming "{}" from {} bytes'.format(self.sPart, self.getDone()));
+    def save(self):
+        # replaces the state at once, a run killed while saving leaves the former one
+        sTmp = self.sState + '.tmp';
+        with open(sTmp, 'w', encoding='utf-8') as file:
+            file.write(codec.dumps({
+                    'url': self.sUrl,
+                    'size': self.nSize,
+                    'validator': self.sValidator,
+                    'digest': self.sDigest,
+                    'segments': self.aSegments
+            }));
+        os.replace(sTmp, self.sState);
+    def reset(self):
+        self.close();
+        for sPath in (self.sPart, self.sState):
+            try:
+                os.remove(sPath);
+            except FileNotFoundError:
+                pass
+        self.nSize = None;
+        self.sValidator = None;
+        self.sDigest = None;
+        self.aSegments = [];
+    def open(self):
+        if (not self.file):
+            self.file = open(self.sPart, 'r+b' if os.path.exists(self.sPart) else 'w+b', buffering=0);
+    def close(self):
+        if (self.file):
+            file, self.file = self.file, None;
+            if (self.aWrites):
+                # the descriptor must outlive the writes still using it
+                asyncio.gather(*self.aWrites, return_exceptions=True).add_done_callback(lambda fut: file.close());
+            else:
+                file.close();
+    async def write(self, bData, nOffset):
+        # positioned writes run off the event loop, and segments writing at the same time never share a file position
+        if (not hasattr(os, 'pwrite')):
+            self.file.seek(nOffset);
+            self.file.write(bData);
+            return;
+        fut = asyncio.get_event_loop().run_in_executor(None, _writeAt, self.file.fileno(), bData, nOffset);
+        self.aWrites.add(fut);
+        fut.add_done_callback(self.aWrites.discard);
+        await asyncio.shield(fut);
+    async def flush(self):
+        if (self.aWrites):
+            await asyncio.wait(self.aWrites);
+    def getDone(self):
+        return sum(aSegment[2] for aSegment in self.aSegments);
+    def getPending(self):
+        return [aSegment for aSegment in self.aSegments if aSegment[1] is None or aSegment[0] + aSegment[2] < aSegment[1]];
+    def begin(self, res, isSegment=True):
+        # lays the download out from a complete response
+        sLength = res.headers.get('Content-Length');
+        self.nSize = int(sLength) if sLength and sLength.isdigit() and not res.headers.get('Content-Encoding') else None;
+        sETag = res.headers.get('ETag');
+        if (sETag and sETag.startswith('W/')):
+            # If-Range takes strong validators only, a server compares a weak ETag as changed and answers ranges with the whole file
+            sETag = None;
+        self.sValidator = sETag or res.headers.get('Last-Modified');
+        self.sDigest = res.headers.get('Content-MD5');
+        nSegments = 1;
+        if (isSegment and self.nSize and self.sValidator and res.headers.get('Accept-Ranges', '').lower() == 'bytes'):
+            nSegments = max(1, min(config.nSegments, self.nSize // config.nSegmentSize));
+        if (self.nSize is None):
+            self.aSegments = [[0, None, 0]];
+        else:
+            nStep = max(1, -(-self.nSize // nSegments));
+            self.aSegments = [[nStart, min(self.nSize, nStart + nStep), 0] for nStart in range(0, self.nSize, nStep)] or [[0, 0, 0]];
+        self.open();
+        self.file.truncate(self.nSize if len(self.aSegments) > 1 else 0);
+        self.save();
+        log.debug('downloading {} to "{}" in {} segments'.format(self.sUrl, self.sPath, len(self.aSegments)));
+    async def readSegment(self, res, aSegment):
+        # writes the body of res from the current position of the segment up to its end
+        while aSegment[1] is None or aSegment[0] + aSegment[2] < aSegment[1]:
+            bData = await res.content.read(self.nBuffer);
+            if (not bData):
+                break;
+            if (aSegment[1] is not None):
+                bData = bData[:aSegment[1] - aSegment[0] - aSegment[2]];
+            await self.write(bData, aSegment[0] + aSegment[2]);
+            aSegment[2] += len(bData);
+        if (aSegment[1] is None):
+            aSegment[1] = self.nSize = aSegment[2];
+        elif (aSegment[0] + aSegment[2] < aSegment[1]):
+            raise IncompleteDownloadError('download of {} broke off at {} of bytes {}-{}'.format(self.sUrl, aSegment[0] + aSegment[2], aSegment[0], aSegment[1] - 1));
+        # every completed segment is on record, even if the run is killed before it ends
+        self.save();
+    async def fetchSegment(self, session, mHeaders, aSegment):
+        nStart = aSegment[0] + aSegment[2];
+        mRange = dict(mHeaders or {});
+        mRange['Range'] = 'bytes={}-{}'.format(nStart, '' if aSegment[1] is None else aSegment[1] - 1);
+        if (self.sValidator):
+            mRange['If-Range'] = self.sValidator;
+        async with await _send(session, self.sUrl, mRange) as res:
+            if (res.status == 416):
+                self.reset();
+                raise ResumeError('{} refused to resume from {}'.format(self.sUrl, nStart));
+            res.raise_for_status();
+            if (res.status == 200):
+                # the range was ignored or the file has changed since
+                if (len(self.aSegments) > 1):
+                    self.reset();
+                    raise ResumeError('{} no longer serves the requested ranges'.format(self.sUrl));
+                log.debug('{} can not be resumed, starting over'.format(self.sUrl));
+                self.begin(res, isSegment=False);
+                aSegment = self.aSegments[0];
+            elif (not res.headers.get('Content-Range', '').startswith('bytes {}-'.format(nStart))):
+                self.reset();
+                raise ResumeError('{} answered range {} with "{}"'.format(self.sUrl, mRange['Range'], res.headers.get('Content-Range')));
+            await self.readSegment(res, aSegment);
+    async def _work(self, session, mHeaders, aQueue):
+        while aQueue:
+            await self.fetchSegment(session, mHeaders, aQueue.popleft());
+    async def _gather(self, aCoros):
+        # like asyncio.gather, but the rest is cancelled once one fails, as they all write the same file
+        aTasks = [asyncio.ensure_future(coro) for coro in aCoros];
+        if (not aTasks):
+            return;
+        try:
+            await asyncio.wait(aTasks, return_when=asyncio.FIRST_EXCEPTION);
+        finally:
+            for task in aTasks:
+                task.cancel();
+            await asyncio.wait(aTasks);
+        for task in aTasks:
+            if (not task.cancelled() and task.exception()):
+                raise task.exception();
+    async def run(self, session, mHeaders=None):
+        # extra connections are only taken from host slots nobody else is waiting for
+        nExtra = 0;
+        try:
+            self.open();
+            if (not self.aSegments):
+                async with await _send(session, self.sUrl, mHeaders) as res:
+                    res.raise_for_status();
+                    # an archived response can not be split into ranges
+                    self.begin(res, isSegment=responseArchive is None);
+                    aQueue = deque(self.aSegments[1:]);
+                    while nExtra < len(aQueue) and self.lock.tryAcquire(self.sUrl):
+                        nExtra += 1;
+                    await self._gather([self.readSegment(res, self.aSegments[0])] + [self._work(session, mHeaders, aQueue) for n in range(nExtra)]);
+            aQueue = deque(self.getPending());
+            while nExtra + 1 < len(aQueue) and self.lock.tryAcquire(self.sUrl):
+                nExtra += 1;
+            await self._gather([self._work(session, mHeaders, aQueue) for n in range(min(nExtra + 1, len(aQueue)))]);
+        finally:
+            for n in range(nExtra):
+                self.lock.release(self.sUrl);
+            await self.flush();
+            if (self.aSegments):
+                self.save();
+            self.close();
+    async def finish(self, sChecksum=None):
+        # verifies size and checksums of the completed file before giving it its name
+        nSize = os.path.getsize(self.sPart);
+        if (self.getPending() or self.nSize is not None and nSize != self.nSize):
+            self.reset();
+            raise IncompleteDownloadError('download of {} has {} bytes instead of {}'.format(self.sUrl, nSize, self.nSize));
+        aCheck = [];
+        if (sChecksum):
+            sAlgorithm, _, sHex = sChecksum.partition(':');
+            aCheck.append((sAlgorithm.lower(), sHex.lower()));
+        if (self.sDigest):
+            try:
+                aCheck.append(('md5', base64.b64decode(self.sDigest, validate=True).hex()));
+            except (binascii.Error, ValueError):
+                log.warning('invalid Content-MD5 of {}: {}'.format(self.sUrl, self.sDigest));
+        loop = asyncio.get_event_loop();
+        for sAlgorithm, sExpected in aCheck:
+            sActual = await loop.run_in_executor(None, hashFile, self.sPart, sAlgorithm);
+            if (sActual != sExpected):
+                self.reset();
+                raise ChecksumError('{} of {} is {} instead of {}'.format(sAlgorithm, self.sUrl, sActual, sExpected));
+        os.replace(self.sPart, self.sPath);
+        os.remove(self.sState);
+
+async def fetchStream(sUrl, sDir=None, sFile=None, mHeaders=None, isDuplicate=True, session=None, retry=None, sChecksum=None, store=None, lock=None):
+    # downloads into "<file>.part", resuming it by byte ranges and splitting large files into parallel segments
+    # sChecksum: "<algorithm>:<hex digest>" the file is verified against before it is renamed
+    # store: MediaStore the file is put into instead of sDir, by default the one of config.sStoreDir if set
+    # lock: PerHostLock to take host slots from instead of the one shared by all fetches
+    lock = lock or perHostLock;
+    circuitBreaker.check(sUrl, isProbe=False);
+    await lock.acquire(sUrl);
+    session = session or getDefaultSession();
+    retry = retry or defaultRetry;
+    store = store or getMediaStore();
+    sTmpPath = None;
     try:
-        sDir = sDir or config.sFileDir or '.';
-        os.makedirs(sDir, exist_ok=True);
         if (not sFile):
             aUrl = sUrl.split('/');
             sFile = aUrl[-1] or aUrl[-2] or 'untitled';
         sFile = re.sub(r'[\\/:*?<>"|\t]', '_', sFile);
-        sPath = os.path.join(sDir, sFile);
-        if (os.path.exists(sPath)):
-            if (not isDuplicate):
-                log.debug('{} already existed, noop'.format(sPath));
-                return (False, sPath);
-            else:
-                while (os.path.exists(sPath)):
-                    sPath = re.sub(r'(\.\w+)?$', r'_\1', sPath);
-                log.warning('file already existed, renaming new one to {}.'.format(sPath));
-        try:
-            res = await session.get(sUrl, headers=mHeaders);
-            res.raise_for_status();
-            file = open(sPath, 'wb');
-            nBuffer = 1024*1024;
-            nSize = 0;
-            log.debug('downloading from {} to "{}"'.format(sUrl, sPath));
-            bData = await res.content.read(nBuffer);
-            while bData:
-                nSize += file.write(bData);
-                bData = await res.content.read(nBuffer);
-        except Exception as e:
-            log.warning('failed to download file {}: {}'.format(res.request_info, e));
-            if (locals().get('file')):
-                file.close();
-                try:
-                    os.remove(sPath);
-                except FileNotFoundError:
-                    pass
-                file = None;
-            raise;
+        if (store):
+            # names are links of the store, they never collide with files
+            sName = os.path.join(sDir, sFile) if sDir else sFile;
+            sLinked = await store.lookup(sUrl, sName);
+            if (sLinked and not isDuplicate):
+                log.debug('{} already stored as {}, noop'.format(sUrl, sLinked));
+                return (False, sLinked);
+            sPath = sTmpPath = store.claimTmpPath(sUrl);
         else:
+            sDir = sDir or config.sFileDir or '.';
+            os.makedirs(sDir, exist_ok=True);
+            sPath = os.path.join(sDir, sFile);
+            if (os.path.exists(sPath)):
+                if (not isDuplicate):
+                    log.debug('{} already existed, noop'.format(sPath));
+                    return (False, sPath);
+                else:
+                    while (os.path.exists(sPath)):
+                        sPath = re.sub(r'(\.\w+)?$', r'_\1', sPath);
+                    log.warning('file already existed, renaming new one to {}.'.format(sPath));
+        # media do not compress much, and compressed bodies can not be resumed by byte ranges
+        mHeaders = dict(mHeaders or {});
+        mHeaders.setdefault('Accept-Encoding', 'identity');
+        download = PartialDownload(sUrl, sPath, lock);
+        async def attempt():
+            try:
+                await download.run(session, mHeaders);
+                await download.finish(sChecksum);
+            except Exception as e:
+                log.warning('failed to download file {} at {} bytes: {}'.format(sUrl, download.getDone(), e));
+                raise;
+            if (store):
+                return True, await store.put(sPath, sUrl, sName);
             log.debug('downloaded: "{}"'.format(sPath));
             return True, sPath;
-        finally:
-            if (locals().get('file')):
-                file.close();
+        return await retry.run(sUrl, attempt);
     finally:
-        perHostLock.release(sUrl);
-
+        if (sTmpPath):
+            store.releaseTmpPath(sTmpPath);
+        lock.release(sUrl);
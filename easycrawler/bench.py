@@ -0,0 +1,406 @@
+#! /usr/bin/env python3
+
+import asyncio
+import socket
+import time
+import random
+import json
+import re
+import html
+
+import lxml.html, lxml.etree
+from lxml.html.clean import Cleaner
+
+from . import asset
+from . import transport
+from . import codec
+from . import source
+from . import worker
+from .archive import ResponseArchive
+from .configure import config
+
+class BroadcastLock():
+    # the former PerHostLock, every release wakes every waiter; kept only as the baseline of benchLock
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop();
+        self.fut = self.loop.create_future();
+        self.nTotalLimit = config.nFetchLimit or float('inf');
+        self.nPerHostLimit = config.nLimitPerHost or float('inf');
+        self.mHost = {};
+        self.nFree = self.nTotalLimit;
+    async def acquire(self, sUrl=None):
+        if (sUrl):
+            sHost = asset.PerHostLock._getHost(self, sUrl);
+        while True:
+            if (self.nFree > 0):
+                if (not sUrl or self.mHost.setdefault(sHost, self.nPerHostLimit) > 0):
+                    break;
+            await self.fut;
+        if (sUrl):
+            self.mHost[sHost] -= 1;
+        self.nFree -= 1;
+    def release(self, sUrl=None):
+        self.nFree += 1;
+        if (sUrl):
+            self.mHost[asset.PerHostLock._getHost(self, sUrl)] += 1;
+        self.fut.set_result(None);
+        self.fut = self.loop.create_future();
+
+def benchLock(nWaiters=10000, nHosts=50):
+    print('benchLock');
+    nFetchLimit, nLimitPerHost = config.nFetchLimit, config.nLimitPerHost;
+    config.nFetchLimit = 20;
+    config.nLimitPerHost = 4;
+    loop = asyncio.get_event_loop();
+    random.seed(0);
+    aUrls = ['http://host{}.test/{}'.format(random.randrange(nHosts), n) for n in range(nWaiters)];
+    try:
+        for lockClass in (BroadcastLock, asset.PerHostLock):
+            lock = lockClass(loop=loop);
+            aOrder = [];
+            async def run(n, sUrl):
+                await lock.acquire(sUrl);
+                aOrder.append(n);
+                await asyncio.sleep(0);
+                lock.release(sUrl);
+            nStart = time.perf_counter();
+            loop.run_until_complete(asyncio.gather(*(run(n, sUrl) for n, sUrl in enumerate(aUrls))));
+            nTime = time.perf_counter() - nStart;
+            nSkew = max(abs(nServed - nArrived) for nServed, nArrived in enumerate(aOrder));
+            print('{:<14} {} waiters on {} hosts: {:.3f}s ({:.0f} acquisitions/s), max distance from arrival order {}'.format(
+                    lockClass.__name__, nWaiters, nHosts, nTime, nWaiters/nTime, nSkew
+            ));
+    finally:
+        config.nFetchLimit, config.nLimitPerHost = nFetchLimit, nLimitPerHost;
+    print('benchLock benched');
+
+def benchTransport(nRequests=5000, nConcurrency=200, nDelay=0.05):
+    # the same API-like load through each transport against a local server speaking HTTP/1.1 and cleartext HTTP/2
+    # nDelay stands for the latency of the server; connections of aiohttp are capped by config.nFetchLimit while HTTP/2 multiplexes
+    print('benchTransport');
+    try:
+        import hypercorn.asyncio
+        import hypercorn.config
+    except ImportError:
+        print('hypercorn is required to serve HTTP/2 locally, skipped');
+        return;
+    if (transport.httpx is None):
+        print('httpx[http2] is required by the http2 transport, skipped');
+        return;
+    mSeen = {};
+    async def app(scope, receive, send):
+        if (scope['type'] == 'lifespan'):
+            while True:
+                message = await receive();
+                await send({'type': message['type'] + '.complete'});
+                if (message['type'] == 'lifespan.shutdown'):
+                    return;
+        mSeen.setdefault(scope['http_version'], set()).add(tuple(scope['client']));
+        await asyncio.sleep(nDelay);
+        bData = json.dumps({'ok': 1, 'data': list(range(100))}).encode();
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(bData)).encode())]});
+        await send({'type': 'http.response.body', 'body': bData});
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0));
+        nPort = sock.getsockname()[1];
+    sUrl = 'http://127.0.0.1:{}/api'.format(nPort);
+    serverConfig = hypercorn.config.Config();
+    serverConfig.bind = ['127.0.0.1:{}'.format(nPort)];
+    serverConfig.accesslog = None;
+    serverConfig.errorlog = None;
+    serverConfig.keep_alive_max_requests = nRequests * 2;
+    serverConfig.h2_max_concurrent_streams = nConcurrency;
+    aSessions = (
+            ('aiohttp', lambda: asset.newAiohttpSession({'User-Agent': asset.UA}, asset.newConnector(config.nFetchLimit, config.nLimitPerHost))),
+            ('http2', lambda: transport.Http2Session({'User-Agent': asset.UA}, nLimit=config.nFetchLimit, isPriorKnowledge=True))
+    );
+    async def run():
+        shutdown = asyncio.Event();
+        server = asyncio.ensure_future(hypercorn.asyncio.serve(app, serverConfig, shutdown_trigger=shutdown.wait));
+        await asyncio.sleep(0.5);
+        try:
+            for sName, newSession in aSessions:
+                mSeen.clear();
+                session = newSession();
+                semaphore = asyncio.Semaphore(nConcurrency);
+                async def get():
+                    async with semaphore:
+                        res = await session.request('GET', sUrl);
+                        async with res:
+                            await res.read();
+                nStart = time.perf_counter();
+                await asyncio.gather(*(get() for n in range(nRequests)));
+                nTime = time.perf_counter() - nStart;
+                connector = getattr(session, 'connector', None);
+                await session.close();
+                if (connector):
+                    await connector.close();
+                print('{:<8} {} requests, {} at a time: {:.3f}s ({:.0f} requests/s) over {}'.format(
+                        sName, nRequests, nConcurrency, nTime, nRequests/nTime,
+                        ', '.join('{} connections of HTTP/{}'.format(len(aClients), sVersion) for sVersion, aClients in mSeen.items())
+                ));
+        finally:
+            shutdown.set();
+            await server;
+    asyncio.get_event_loop().run_until_complete(run());
+    print('benchTransport benched');
+
+def makeJsonPayloads(nPayloads=50):
+    # stand-ins shaped like Weibo timelines when there is no recorded response at hand
+    random.seed(0);
+    aPayloads = [];
+    for n in range(nPayloads):
+        aCards = [{
+                'card_type': 9,
+                'scheme': 'https://m.weibo.cn/status/{:x}?mblogid={:x}'.format(n, i),
+                'mblog': {
+                    'id': str(4000000000000000 + random.randrange(10**12)),
+                    'bid': '{:x}'.format(random.getrandbits(36)),
+                    'created_at': 'Tue Oct 16 10:00:00 +0800 2018',
+                    'text': '微博正文 <a href="/n/someone">@someone</a> ' * random.randint(1, 10),
+                    'reposts_count': random.randrange(1000),
+                    'comments_count': random.randrange(1000),
+                    'attitudes_count': random.randrange(10000),
+                    'user': {'id': random.randrange(10**10), 'screen_name': '用户{}'.format(n), 'profile_image_url': 'https://tvax1.sinaimg.cn/crop.0.0.180.180.180/x.jpg', 'verified': False, 'followers_count': random.randrange(10**6)},
+                    'pics': [{'pid': '{:032x}'.format(random.getrandbits(128)), 'url': 'https://wx1.sinaimg.cn/orj360/x.jpg', 'large': {'url': 'https://wx1.sinaimg.cn/large/x.jpg'}} for i in range(random.randrange(10))]
+                }
+        } for i in range(20)];
+        aPayloads.append(json.dumps({'ok': 1, 'data': {'cards': aCards, 'cardlistInfo': {'page': n}}}, ensure_ascii=False).encode('utf-8'));
+    return aPayloads;
+
+def benchJson(sArchive=None, nRepeat=20):
+    # decoding the JSON bodies of a response archive, or of stand-ins, the former way against each codec installed
+    print('benchJson');
+    aPayloads = [];
+    sArchive = sArchive or config.sArchiveFile;
+    if (sArchive):
+        archive = ResponseArchive(sArchive, 'replay');
+        try:
+            for mMeta, bData in archive.items():
+                if ('json' in dict((sKey.lower(), sValue) for sKey, sValue in mMeta['headers']).get('content-type', '')):
+                    aPayloads.append(bData);
+        finally:
+            archive.close();
+    sSource = 'from "{}"'.format(sArchive) if aPayloads else 'made up';
+    aPayloads = aPayloads or makeJsonPayloads();
+    nBytes = sum(len(bData) for bData in aPayloads) * nRepeat;
+    aObjects = [json.loads(bData) for bData in aPayloads];
+    aRuns = [('former', lambda bData: json.loads(bData.decode('utf-8')), lambda obj: json.dumps(obj))];
+    for sName, codecClass in codec.mCodec.items():
+        try:
+            aRuns.append((sName, codecClass().loads, codecClass().dumps));
+        except ImportError as e:
+            print('{}: {}'.format(sName, e));
+    for sName, loads, dumps in aRuns:
+        nStart = time.perf_counter();
+        for n in range(nRepeat):
+            for bData in aPayloads:
+                loads(bData);
+        nLoads = time.perf_counter() - nStart;
+        nStart = time.perf_counter();
+        for n in range(nRepeat):
+            for obj in aObjects:
+                dumps(obj);
+        nDumps = time.perf_counter() - nStart;
+        print('{:<7} {} payloads {}, {:.1f}MB: loads {:.3f}s ({:.0f}MB/s), dumps {:.3f}s'.format(
+                sName, len(aPayloads), sSource, nBytes / 1e6, nLoads, nBytes / 1e6 / nLoads, nDumps
+        ));
+    print('benchJson benched');
+
+# the former regex path, kept only as the baseline of benchExtract
+statusPattern = re.compile(rb'<script>[^<>]+?var \$render_data = (\[\{[\s\S]+?\}\])\[0\] \|\| \{\};\s*</script>');
+threadPattern = re.compile(r'PageData\.thread\s*=\s*\{\s*author\s*:\s*"(.+?)"\s*,\s*thread_id\s*:\s*(\d+?)\s*,\s*title\s*:\s*"(.+?)"s*,\s*reply_num\s*:\s*(\d+?)\s*,');
+forumPattern = re.compile(r'PageData\.forum\s*=\s*(\{[\s\S]+?\})\s*;');
+pagerPattern = re.compile(r'PageData\.pager\s*=\s*(\{[\s\S]+?\})\s*;');
+quotePattern = re.compile(r'(?<!\\)\'');
+
+def extractWeibo(bData):
+    return codec.loads(statusPattern.search(bData).group(1));
+
+def extractTieba(sData):
+    sAuthor, sPostId, sTitle, nComments = threadPattern.search(sData).groups();
+    mData = codec.loads(quotePattern.sub('"', forumPattern.search(sData).group(1)));
+    sForumId = str(mData.get('true_forum_id') or mData['forum_id']);
+    sForum = mData['forum_name'];
+    nMaxPage = codec.loads(quotePattern.sub('"', pagerPattern.search(sData).group(1)))['total_page'];
+    return sTitle, nComments, sForumId, sForum, nMaxPage;
+
+def loadsTieba(sData):
+    # what source.Tieba.parsePageData reads off a page
+    mData = codec.loadsFields(sData, 'PageData.thread', ('title', 'reply_num'), isRaw=True);
+    sTitle, nComments = mData['title'], mData['reply_num'];
+    mData = codec.loadsFields(sData, 'PageData.forum', ('true_forum_id', 'forum_id', 'forum_name'));
+    sForumId = str(mData.get('true_forum_id') or mData['forum_id']);
+    sForum = mData['forum_name'];
+    nMaxPage = codec.loadsFields(sData, 'PageData.pager', ('total_page',))['total_page'];
+    return sTitle, nComments, sForumId, sForum, nMaxPage;
+
+def makePages(nPages=50):
+    # stand-ins shaped like a Weibo status page and a Tieba post page when there is no recorded page at hand
+    aWeibo = [];
+    for bData in makeJsonPayloads(nPages):
+        mData = json.loads(bData)['data']['cards'][0]['mblog'];
+        sData = json.dumps({'status': mData, 'hotScheme': 'sinaweibo://detail?mblogid={}'.format(mData['id']), 'appScheme': ''}, ensure_ascii=False, indent=4);
+        aWeibo.append((
+                '<!DOCTYPE html><html><head><meta charset="utf-8"><title>微博</title><script>var config = {env: "prod", st: ""};</script></head>'
+                '<body><div id="app"></div><script>\n    var $render_data = [' + sData + '][0] || {};\n</script>'
+                '<script src="https://h5.sinaimg.cn/m/weibo-lite/js/app.js"></script></body></html>'
+        ).encode('utf-8'));
+    aTieba = [];
+    for n in range(nPages):
+        aTieba.append((
+                '<div class="wrap1"><script>var PageData = PageData || {{}}; PageData.tbs = "{:032x}";\n'.format(random.getrandbits(128)) +
+                'PageData.thread = {{ author: "用户{0}", thread_id: {1}, title: "帖子 {0}: 标题", reply_num: {2}, thread_type: "0", topic: {{is_lpost: 0, topic_type: false}}, is_ad: 0 }};\n'.format(n, 5000000000 + n, random.randrange(10000)) +
+                "PageData.forum = {{ 'id': {0}, 'forum_id': {0}, 'true_forum_id': {0}, 'name': \"吧{1}\", 'forum_name': \"吧{1}\", 'first_class': '娱乐明星', 'avatar': 'https://imgsrc.baidu.com/forum/pic/item/{2:032x}.jpg', 'is_like': 0, 'user_level': 1 }};\n".format(random.randrange(10**7), n, random.getrandbits(128)) +
+                "PageData.pager = {{ 'cur_page': 1, 'total_page': {0}, 'total_num': {1} }};\n".format(random.randrange(1, 50), random.randrange(10000)) +
+                'PageData.user = {{ is_login: 0, name: "", portrait: "" }};</script>{}</div>'.format('<div class="l_post"></div>' * 100)
+        ));
+    return aWeibo, aTieba;
+
+def benchExtract(sArchive=None, nRepeat=20):
+    # locating and decoding the JS objects embedded in pages of a response archive, or of stand-ins, by the former regexes against codec.loadsObject
+    # for Weibo and codec.loadsFields for Tieba
+    print('benchExtract');
+    aWeibo = [];
+    aTieba = [];
+    sArchive = sArchive or config.sArchiveFile;
+    if (sArchive):
+        archive = ResponseArchive(sArchive, 'replay');
+        try:
+            for mMeta, bData in archive.items():
+                if (b'var $render_data = [{' in bData):
+                    aWeibo.append(bData);
+                elif (b'PageData.thread' in bData and b'PageData.forum' in bData):
+                    aTieba.append(asset.html2Unicode(bData));
+        finally:
+            archive.close();
+    sSource = 'from "{}"'.format(sArchive) if aWeibo or aTieba else 'made up';
+    if (not (aWeibo or aTieba)):
+        aWeibo, aTieba = makePages();
+    aRuns = [
+            ('weibo', aWeibo, extractWeibo, lambda bData: codec.loadsObject(bData, b'var $render_data')),
+            ('tieba', aTieba, extractTieba, loadsTieba)
+    ];
+    for sName, aPages, former, latter in aRuns:
+        if (not aPages):
+            continue;
+        for page in aPages:
+            assert former(page) == latter(page), 'differ on a page of {}'.format(sName);
+        # the best of nRepeat passes taken in turn, so that a busy moment of the machine weighs on neither side alone
+        aTimes = [float('inf'), float('inf')];
+        for n in range(nRepeat):
+            for nIndex, extract in enumerate((former, latter)):
+                nStart = time.perf_counter();
+                for page in aPages:
+                    extract(page);
+                aTimes[nIndex] = min(aTimes[nIndex], time.perf_counter() - nStart);
+        nPages = len(aPages);
+        print('{} {} pages {}: regex {:.1f}us/page, codec {:.1f}us/page, x{:.2f}'.format(
+                sName, nPages, sSource, aTimes[0] / nPages * 1e6, aTimes[1] / nPages * 1e6, aTimes[0] / aTimes[1]
+        ));
+    print('benchExtract benched');
+
+def formerInnerHtml(data, isAggregate=False, cleaner=Cleaner(style=True, forms=False)):
+    # the former asset.innerHtml: a cleaned copy, serialized child by child; kept only as the baseline of benchInnerHtml
+    ele = lxml.html.fragment_fromstring(data, create_parent=isAggregate, parser=asset.utf8Parser);
+    ele = cleaner.clean_html(ele);
+    sData = html.escape(ele.text or '');
+    sData += ''.join(lxml.etree.tostring(child, method='xml', encoding='utf-8').decode(errors='replace') for child in ele);
+    return sData;
+
+def findFragments(obj, aFragments):
+    # html in the text and content fields of a JSON body
+    if (isinstance(obj, dict)):
+        for sKey, value in obj.items():
+            if (sKey in ('text', 'content') and isinstance(value, str) and '<' in value):
+                aFragments.append(value);
+            else:
+                findFragments(value, aFragments);
+    elif (isinstance(obj, list)):
+        for value in obj:
+            findFragments(value, aFragments);
+    return aFragments;
+
+def benchInnerHtml(sArchive=None, nRepeat=5):
+    # asset.innerHtml and asset.innerHtmls against the former innerHtml on the fragments of a response archive, or on stand-ins;
+    # any output differing from the former one is reported
+    print('benchInnerHtml');
+    aFragments = [];
+    sArchive = sArchive or config.sArchiveFile;
+    if (sArchive):
+        archive = ResponseArchive(sArchive, 'replay');
+        try:
+            for mMeta, bData in archive.items():
+                try:
+                    findFragments(codec.loads(bData), aFragments);
+                except ValueError:
+                    pass;
+        finally:
+            archive.close();
+    sSource = 'from "{}"'.format(sArchive) if aFragments else 'made up';
+    if (not aFragments):
+        aExtra = ['<script>alert(1)</script>', '<a href=" javascript:alert(1)">x</a>', '<img src="x.png" onerror="x()" style="width:1em">', '<!-- c -->', '<iframe src="x"></iframe>', '<foo>?</foo>', '"\'&amp;'];
+        for bData in makeJsonPayloads():
+            findFragments(codec.loads(bData), aFragments);
+        aFragments = [sFragment + random.choice(aExtra) for sFragment in aFragments];
+    nDiffer = sum(1 for sFragment, sData in zip(aFragments, asset.innerHtmls(aFragments)) if sData != formerInnerHtml(sFragment, True));
+    nDiffer += sum(1 for sFragment in aFragments if asset.innerHtml(sFragment, True) != formerInnerHtml(sFragment, True));
+    aRuns = (
+            ('former', lambda: [formerInnerHtml(sFragment, True) for sFragment in aFragments]),
+            ('innerHtml', lambda: [asset.innerHtml(sFragment, True) for sFragment in aFragments]),
+            ('innerHtmls', lambda: asset.innerHtmls(aFragments))
+    );
+    for sName, run in aRuns:
+        nStart = time.perf_counter();
+        for n in range(nRepeat):
+            run();
+        print('{:<10} {} fragments {}: {:.1f}us/fragment'.format(sName, len(aFragments), sSource, (time.perf_counter() - nStart) / nRepeat / len(aFragments) * 1e6));
+    print('benchInnerHtml benched, {} outputs differ from the former ones'.format(nDiffer));
+
+def benchParse(nWorkers=None, nRepeat=4):
+    # timelines parsed by WeiboSource inline, in a thread pool and in a process pool, with the longest the event loop went unanswered meanwhile;
+    # the pools give throughput only with cores to spare, the loop answers in time whatever the cores
+    print('benchParse');
+    aPayloads = [codec.loads(bData) for bData in makeJsonPayloads()] * nRepeat;
+    async def run(sMode):
+        loop = asyncio.get_event_loop();
+        pool = worker.ParsePool(sMode, nWorkers) if sMode != 'inline' else False;
+        weibo = source.WeiboSource(parsePool=pool);
+        aLags = [0];
+        isDone = False;
+        async def tick():
+            while not isDone:
+                nStart = loop.time();
+                await asyncio.sleep(0.001);
+                aLags.append(loop.time() - nStart - 0.001);
+        ticker = asyncio.ensure_future(tick());
+        async def parse(mData):
+            await asyncio.sleep(0); # pages arrive one by one from fetches in flight
+            return await weibo.runParse('parseWeibo', mData);
+        nStart = time.perf_counter();
+        aResults = await asyncio.gather(*(parse(mData) for mData in aPayloads));
+        nTime = time.perf_counter() - nStart;
+        isDone = True;
+        await ticker;
+        await weibo.cleanup();
+        if (pool):
+            pool.close();
+        print('{:<8} {} timelines, {} posts: {:.3f}s ({:.0f} timelines/s), loop unanswered for {:.1f}ms at most'.format(
+                sMode, len(aPayloads), sum(len(aPosts) for aPosts in aResults), nTime, len(aPayloads)/nTime, max(aLags)*1000
+        ));
+    for sMode in ('inline', 'thread', 'process'):
+        asyncio.get_event_loop().run_until_complete(run(sMode));
+    print('benchParse benched');
+
+def bench():
+    print('bench start');
+    benchLock();
+    benchTransport();
+    benchJson();
+    benchExtract();
+    benchInnerHtml();
+    benchParse();
+    print('bench end');
+
+if __name__ == '__main__':
+    bench();
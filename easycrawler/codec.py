@@ -0,0 +1,359 @@
+import logging
+import codecs
+import json
+import re
+
+from .configure import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None;
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
+
+def isUtf8(sCharset):
+    # whether bytes in this charset can be handed to a decoder reading UTF-8
+    if (not sCharset):
+        return True;
+    try:
+        return codecs.lookup(sCharset).name in ('utf-8', 'ascii');
+    except LookupError:
+        return True;
+
+class JsonCodec():
+    # the standard library; reads str and bytes, and writes str without escaping non-ASCII characters
+    sName = 'json';
+    def loads(self, data, sCharset=None):
+        if (not isinstance(data, str) and not isUtf8(sCharset)):
+            data = bytes(data).decode(sCharset);
+        return json.loads(data);
+    def dumps(self, obj):
+        return json.dumps(obj, ensure_ascii=False);
+
+class OrjsonCodec(JsonCodec):
+    # orjson reads bytes as they came from the network without decoding them first
+    # whatever it refuses but the standard library takes, such as NaN or UTF-16, still goes through the standard library
+    sName = 'orjson';
+    def __init__(self):
+        if (orjson is None):
+            raise ImportError('the orjson codec requires orjson: pip install orjson');
+    def loads(self, data, sCharset=None):
+        if (not isinstance(data, str) and not isUtf8(sCharset)):
+            return super().loads(data, sCharset);
+        try:
+            return orjson.loads(data);
+        except orjson.JSONDecodeError:
+            return super().loads(data, sCharset);
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8');
+        except TypeError:
+            return super().dumps(obj);
+
+mCodec = {
+        'json': JsonCodec,
+        'orjson': OrjsonCodec
+};
+
+def getCodec(sName=None):
+    # 'auto' takes the fastest codec installed
+    sName = sName or config.sJsonCodec;
+    if (sName == 'auto'):
+        sName = 'orjson' if orjson else 'json';
+    return mCodec[sName]();
+
+codec = getCodec();
+
+def use(sName):
+    global codec;
+    codec = getCodec(sName);
+    log.debug('JSON codec {} in use'.format(codec.sName));
+    return codec;
+
+def loads(data, sCharset=None):
+    # data: str, or bytes in sCharset which is UTF-8 by default
+    return codec.loads(data, sCharset);
+
+def dumps(obj):
+    return codec.dumps(obj);
+
+# JS object literals embedded in pages, e.g. `var $render_data = [{...}][0] || {};` or `PageData.forum = {'id': 1, ...};`
+# a JSON literal is located by a regex consuming whole nested groups, strings included, looping only where nesting goes deeper than it reaches,
+# and goes to the codec as it is; one written in JS is decoded by scanObject in a single pass, an item at a time,
+# or by loadsFields only for the few fields a page is read for
+def makeBodyPattern(nDepth):
+    # a run of literal body holding groups nested up to nDepth, stopping at the first bracket it cannot close or at a stray quote
+    sString = r"""'[^'\\]*(?:\\.[^'\\]*)*'|""" + r'''"[^"\\]*(?:\\.[^"\\]*)*"''';
+    sOther = r'''[^"'{}\[\]]*''';
+    sBody = '{0}(?:(?:{1}){0})*'.format(sOther, sString);
+    for n in range(nDepth):
+        sBody = '{0}(?:(?:{1}|[{{\\[]{2}[}}\\]]){0})*'.format(sOther, sString, sBody);
+    return sBody;
+sBodyPattern = makeBodyPattern(8);
+mBodyPattern = {
+        str: re.compile(sBodyPattern, re.S),
+        bytes: re.compile(sBodyPattern.encode('ascii'), re.S)
+};
+mGapPattern = {
+        str: re.compile(r'[\s=]*[{\[]'),
+        bytes: re.compile(rb'[\s=]*[{\[]')
+}; # what may stand between a marker and its literal
+mBracket = {str: ('{[', '}]'), bytes: (b'{[', b'}]')};
+mJsPattern = {
+        str: re.compile(r"[{\[]\s*[A-Za-z_$']"),
+        bytes: re.compile(rb"[{\[]\s*[A-Za-z_$']")
+}; # a literal written in JS rather than JSON mostly shows it from its first key or item on
+
+# an item of an object or array with the separator after it, or the bracket closing the group after a trailing comma; the groups are
+# close, double quoted key, single quoted key, bare key, opening bracket, function,
+# double quoted string, single quoted string, number, word, any other expression, separator
+itemPattern = re.compile(
+        r'''\s*(?:([}\]])|(?:(?:"([^"\\]*(?:\\.[^"\\]*)*)"|'([^'\\]*(?:\\.[^'\\]*)*)'|([\w$]+))\s*:\s*)?'''
+        r'''(?:([{\[])|(function\b[^{]*\{)|(?:"([^"\\]*(?:\\.[^"\\]*)*)"|'([^'\\]*(?:\\.[^'\\]*)*)'|'''
+        r'''(-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)(?![\w$.])|(true|false|null|undefined)(?![\w$.])|([^\s"'{}\[\],][^"'{}\[\],]*))\s*([,}\]])?))''',
+        re.S
+);
+sepPattern = re.compile(r'\s*([,}\]])');
+mWord = {'true': True, 'false': False, 'null': None, 'undefined': None};
+jsEscapePattern = re.compile(r'\\(?:u([0-9a-fA-F]{4})|x([0-9a-fA-F]{2})|u\{([0-9a-fA-F]+)\}|\r\n|(.))', re.S);
+mJsEscape = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0', '\n': '', '\r': '', '\u2028': '', '\u2029': ''};
+
+def _unescape(match):
+    sHex = match.group(1) or match.group(2) or match.group(3);
+    if (sHex):
+        return chr(int(sHex, 16));
+    sChar = match.group(4);
+    return mJsEscape.get(sChar, sChar) if sChar is not None else '';
+
+def decodeString(sString):
+    # the value of the text between the quotes of a JS string
+    if ('\\' not in sString):
+        return sString;
+    sString = jsEscapePattern.sub(_unescape, sString);
+    if (re.search('[\ud800-\udfff]', sString)):
+        # surrogate pairs escaped one half at a time
+        sString = sString.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace');
+    return sString;
+
+def _skipGroup(data, nBegin):
+    # the end of the group opening at data[nBegin]
+    nEnd = nBegin + 1;
+    nDepth = 1;
+    bodyMatch = mBodyPattern[str].match;
+    while True:
+        nEnd = bodyMatch(data, nEnd).end();
+        bracket = data[nEnd:nEnd+1];
+        if (not bracket or bracket not in '{}[]'):
+            raise ValueError('unterminated group at {}'.format(nBegin));
+        nDepth += 1 if bracket in '{[' else -1;
+        nEnd += 1;
+        if (nDepth == 0):
+            return nEnd;
+
+def scanObject(data, nBegin=0, isRaw=False):
+    # (value, end) of the JS object or array literal at data[nBegin] in a str, trailing commas allowed
+    # strings come back decoded, numbers, true, false, null and undefined as their values, functions as None and other expressions as their text;
+    # with isRaw strings are left as written between their quotes, and every other scalar as its text
+    value = {} if data[nBegin] == '{' else [];
+    aStack = []; # (parent, key in it) of the groups value is nested in
+    nPos = nBegin + 1;
+    itemMatch = itemPattern.match;
+    while True:
+        match = itemMatch(data, nPos);
+        if (match is None):
+            raise ValueError('invalid JS literal at {}'.format(nPos));
+        sClose, sDKey, sSKey, sKey, sOpen, sFunction, sDString, sSString, sNumber, sWord, sExpr, sSep = match.groups();
+        nPos = match.end();
+        if (sClose is None):
+            if (sDKey is not None):
+                sKey = sDKey if isRaw else decodeString(sDKey);
+            elif (sSKey is not None):
+                sKey = sSKey if isRaw else decodeString(sSKey);
+            if (sOpen):
+                aStack.append((value, sKey));
+                value = {} if sOpen == '{' else [];
+                continue;
+            if (sDString is not None):
+                item = sDString if isRaw else decodeString(sDString);
+            elif (sSString is not None):
+                item = sSString if isRaw else decodeString(sSString);
+            elif (sNumber):
+                item = sNumber if isRaw else (int(sNumber) if sNumber.lstrip('-').isdigit() else float(sNumber));
+            elif (sWord):
+                item = sWord if isRaw else mWord[sWord];
+            elif (sFunction):
+                nPos = _skipGroup(data, nPos - 1);
+                item = data[match.start(6):nPos] if isRaw else None;
+                match = sepPattern.match(data, nPos);
+                sSep = match and match.group(1);
+                nPos = match.end() if match else nPos;
+            else:
+                item = sExpr.rstrip();
+            if (sKey is None):
+                value.append(item);
+            else:
+                value[sKey] = item;
+            if (sSep == ','):
+                continue;
+            elif (sSep is None):
+                raise ValueError('invalid JS literal at {}'.format(nPos));
+        # the group of value is closed, by sClose or by sSep
+        while True:
+            if (not aStack):
+                return value, nPos;
+            parent, sKey = aStack.pop();
+            if (sKey is None):
+                parent.append(value);
+            else:
+                parent[sKey] = value;
+            value = parent;
+            match = sepPattern.match(data, nPos);
+            if (match is None):
+                raise ValueError('invalid JS literal at {}'.format(nPos));
+            nPos = match.end();
+            if (match.group(1) == ','):
+                break;
+
+# fields at the top level of an object literal, for the few a page is read for when decoding all of it would cost more:
+# a regex skips whole items to the next key asked for, and only the values of those keys are decoded
+def makeRunPattern(sStop=''):
+    # a run of whole items, strings and groups nested up to the depth of sBodyPattern included, up to a comma, closing bracket or stray quote;
+    # with sStop going on past the commas it does not follow
+    sRun = r"""[^"'{{}}\[\],]*(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*'|[{{\[]{}[}}\]]{})[^"'{{}}\[\],]*)*""";
+    return sRun.format(sBodyPattern, r'|,(?!\s*{})'.format(sStop) if sStop else '');
+sValuePattern = makeRunPattern();
+mFieldsPattern = {};
+
+def getFieldsPattern(aKeys):
+    # from the start of an item or the end of one, the run to the next key of aKeys and its value; the groups:
+    # the closing brace if there is no such key left; the key if double quoted, if single quoted, if bare;
+    # its value if a double quoted string, if a single quoted one, otherwise
+    pattern = mFieldsPattern.get(aKeys);
+    if (pattern is None):
+        sKeys = '|'.join(re.escape(sKey) for sKey in aKeys);
+        sKey = r"""(?:"(?:{0})"|'(?:{0})'|(?:{0})(?![\w$]))\s*:""".format(sKeys);
+        sString = r"""(?:"([^"\\]*(?:\\.[^"\\]*)*)"|'([^'\\]*(?:\\.[^'\\]*)*)')\s*(?=[,}])""";
+        pattern = mFieldsPattern[aKeys] = re.compile(
+                r"""(?:(?=\s*{0})|{1}(?=,\s*{0}|\s*(\}})))""".format(sKey, makeRunPattern(sKey)) +
+                r"""(?(1)|\s*,?\s*(?:"({0})"|'({0})'|({0}))\s*:\s*(?:{1}|({2})(?=[,}}])))""".format(sKeys, sString, sValuePattern),
+                re.S
+        );
+    return pattern;
+
+stringPattern = re.compile(r"""'[^'\\]*(?:\\.[^'\\]*)*'|""" + r'''"[^"\\]*(?:\\.[^"\\]*)*"''', re.S);
+
+def decodeValue(sValue, isRaw=False):
+    # a value written in JS as of scanObject
+    sValue = sValue.strip();
+    sFirst = sValue[:1];
+    if (sFirst in ('"', "'") and stringPattern.fullmatch(sValue)):
+        return sValue[1:-1] if isRaw else decodeString(sValue[1:-1]);
+    elif (sFirst in ('{', '[')):
+        return scanObject(sValue, 0, isRaw)[0];
+    elif (isRaw):
+        return sValue;
+    elif (sValue in mWord):
+        return mWord[sValue];
+    elif (sValue.startswith('function')):
+        return None;
+    try:
+        return int(sValue);
+    except ValueError:
+        pass;
+    try:
+        return float(sValue);
+    except ValueError:
+        return sValue;
+
+def loadsFields(data, marker, aKeys, isRaw=False):
+    # {key: value} of the keys of aKeys at the top level of the object literal after marker in a str, decoded as of scanObject; None if there is none
+    nBegin = findLiteral(data, marker);
+    if (nBegin is None):
+        return None;
+    aKeys = tuple(aKeys);
+    fieldMatch = getFieldsPattern(aKeys).match;
+    mData = {};
+    nPos = nBegin + 1;
+    while (len(mData) < len(aKeys)):
+        match = fieldMatch(data, nPos);
+        if (match is None):
+            # an item the regex does not take, such as a stray quote or nesting deeper than it reaches
+            mAll = scanObject(data, nBegin, isRaw)[0];
+            return {sKey: mAll[sKey] for sKey in aKeys if sKey in mAll};
+        sClose, sDKey, sSKey, sKey, sDString, sSString, sValue = match.groups();
+        if (sClose):
+            break;
+        nPos = match.end();
+        sKey = sDKey or sSKey or sKey;
+        if (sDString is not None):
+            mData[sKey] = sDString if isRaw else decodeString(sDString);
+        elif (sSString is not None):
+            mData[sKey] = sSString if isRaw else decodeString(sSString);
+        else:
+            mData[sKey] = decodeValue(sValue, isRaw);
+    return mData;
+
+def findLiteral(data, marker, nStart=0):
+    # where the object or array literal right after marker in data begins, None if there is none
+    dataType = str if isinstance(data, str) else bytes;
+    while True:
+        nStart = data.find(marker, nStart);
+        if (nStart < 0):
+            return None;
+        nStart += len(marker);
+        match = mGapPattern[dataType].match(data, nStart);
+        if (match):
+            return match.end() - 1;
+
+def findObject(data, marker, nStart=0):
+    # (begin, end) of the first object or array literal right after marker in data, None if there is none
+    dataType = str if isinstance(data, str) else bytes;
+    nBegin = findLiteral(data, marker, nStart);
+    if (nBegin is None):
+        return None;
+    nEnd = nBegin + 1;
+    nDepth = 1;
+    bodyMatch = mBodyPattern[dataType].match;
+    sOpen, sClose = mBracket[dataType];
+    while True:
+        nEnd = bodyMatch(data, nEnd).end();
+        bracket = data[nEnd:nEnd+1];
+        if (not bracket):
+            return None;
+        elif (bracket in sOpen):
+            nDepth += 1;
+        elif (bracket in sClose):
+            nDepth -= 1;
+            if (nDepth == 0):
+                return nBegin, nEnd + 1;
+        else:
+            return None; # an unterminated string
+        nEnd += 1;
+
+def loadsObject(data, marker, sCharset=None, isRaw=False):
+    # the object or array literal after marker decoded as of scanObject, None if there is none; data and marker are both str or both bytes
+    # a literal looking like JSON goes to the codec as it is, and to scanObject only if the codec refuses it
+    if (isinstance(data, str)):
+        nBegin = findLiteral(data, marker);
+        if (nBegin is None):
+            return None;
+        if (isRaw or mJsPattern[str].match(data, nBegin)):
+            return scanObject(data, nBegin, isRaw)[0];
+    located = findObject(data, marker);
+    if (not located):
+        return None;
+    literal = data[located[0]:located[1]];
+    if (not isRaw and not mJsPattern[type(literal)].match(literal)):
+        try:
+            return codec.loads(literal, sCharset);
+        except ValueError:
+            pass;
+    if (not isinstance(literal, str)):
+        literal = bytes(literal).decode(sCharset or 'utf-8');
+    return scanObject(literal, 0, isRaw)[0];
@@ -3,6 +3,26 @@ import weakref
 from pprint import pprint
 import tracemalloc
 import pdb
+import logging
+import asyncio
+import os
+import sys
+import time
+import threading
+import bisect
+import sysconfig
+import traceback
+from collections import deque
+
+from . import asset
+from .configure import config
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
 
 class Stater():
     def __init__(self):
@@ -88,3 +108,124 @@ def setTrace():
 
 def pm():
     pdb.post_mortem();
+
+class LoopMonitor():
+    # how late the event loop gets to a timer due every nInterval seconds, as a histogram;
+    # a watchdog thread catches the loop lagging past nThreshold in the act, and records the stack it is stuck in
+    # along with the task running and the TaskArranger of mArrangers the task belongs to;
+    # idle, it costs a timer of the loop and a wake-up of the watchdog per interval
+    sLoopFile = os.path.join('asyncio', 'events.py');
+    aLibDirs = tuple({sysconfig.get_path(sName) + os.sep for sName in ('stdlib', 'platstdlib', 'purelib', 'platlib')});
+    aBounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float('inf')); # upper bounds of lag of the histogram buckets
+    def __init__(self, loop=None, nInterval=None, nThreshold=None, mArrangers=None, nReports=100):
+        self.loop = loop or asyncio.get_event_loop();
+        self.nInterval = nInterval or config.nLagInterval;
+        self.nThreshold = nThreshold or config.nLagThreshold;
+        self.mArrangers = mArrangers or {'asset': asset.arranger}; # name -> TaskArranger, e.g. also {'media': pipeline.arranger}
+        self.aCounts = [0] * len(self.aBounds);
+        self.nBeats = 0;
+        self.nTotalLag = 0;
+        self.nMaxLag = 0;
+        self.reports = deque(maxlen=nReports); # the latest stalls
+        self.mSpots = {}; # (file, line, function) the loop was stuck in -> [stalls, seconds]
+        self.nThreadId = None;
+        self.nDue = None; # when the pending beat is due, by time.monotonic
+        self.stall = None; # report of the stall the pending beat is late by
+        self.heartbeat = None;
+        self.watchdog = None;
+        self.stopEvent = threading.Event();
+    def start(self):
+        self.stopEvent.clear();
+        self.heartbeat = self.loop.create_task(self._beat());
+        self.watchdog = threading.Thread(target=self._watch, name='loop-monitor', daemon=True);
+        self.watchdog.start();
+        return self;
+    def stop(self):
+        self.stopEvent.set();
+        if (self.heartbeat):
+            self.heartbeat.cancel();
+            self.heartbeat = None;
+        self.nDue = None;
+        log.debug('loop monitor stopped: {}'.format(self.getStats()));
+    async def _beat(self):
+        self.nThreadId = threading.get_ident();
+        while True:
+            self.nDue = time.monotonic() + self.nInterval;
+            await asyncio.sleep(self.nInterval);
+            self.record(max(0, time.monotonic() - self.nDue));
+    def record(self, nLag):
+        self.aCounts[bisect.bisect_left(self.aBounds, nLag)] += 1;
+        self.nBeats += 1;
+        self.nTotalLag += nLag;
+        self.nMaxLag = max(self.nMaxLag, nLag);
+        report = self.stall;
+        if (report and report['due'] == self.nDue):
+            self.stall = None;
+            report['lag'] = nLag;
+            self.reports.append(report);
+            spot = self.mSpots.setdefault(report['spot'], [0, 0]);
+            spot[0] += 1;
+            spot[1] += nLag;
+            log.warning('event loop stalled for {:.3f}s in {} of task {} ({}){}'.format(
+                    nLag, '{}:{} {}'.format(*report['spot']), report['task'], report['arranger'] or 'no arranger',
+                    '\n' + report['stack'] if log.isEnabledFor(logging.DEBUG) else ''
+            ));
+    def _watch(self):
+        while not self.stopEvent.wait(self.nInterval):
+            nDue = self.nDue;
+            if (nDue and time.monotonic() - nDue > self.nThreshold and not (self.stall and self.stall['due'] == nDue)):
+                self.stall = self._capture(nDue);
+    def _capture(self, nDue):
+        # what the loop thread is doing while it has not come back to the loop for nThreshold
+        frame = sys._current_frames().get(self.nThreadId);
+        aFrames = traceback.extract_stack(frame) if frame else [];
+        del frame;
+        for nIndex in range(len(aFrames) - 1, -1, -1):
+            if (aFrames[nIndex].filename.endswith(self.sLoopFile)):
+                aFrames = aFrames[nIndex+1:]; # the loop running the callback is the same every time
+                break;
+        task = asyncio.current_task(self.loop);
+        sArranger = None;
+        if (task):
+            for sName, arranger in list(self.mArrangers.items()):
+                try:
+                    if (task in arranger.aliveTask):
+                        sArranger = sName;
+                        break;
+                except RuntimeError:
+                    pass; # its tasks changed as they were looked through, the loop moved on already
+        # the innermost frame out of the libraries points at the call to move off the loop rather than at the library doing the work
+        aOwn = [item for item in aFrames if item.filename.startswith(config.sDir + os.sep) or not item.filename.startswith(self.aLibDirs)];
+        spotFrame = (aOwn or aFrames or [None])[-1];
+        return {
+                'due': nDue,
+                'time': time.time(),
+                'lag': None, # till the loop comes back
+                'spot': (os.path.basename(spotFrame.filename), spotFrame.lineno, spotFrame.name) if spotFrame else ('?', 0, '?'),
+                'task': task.get_name() + ' ' + getattr(task.get_coro(), '__qualname__', '?') if task else None,
+                'arranger': sArranger,
+                'created': getattr(task, '_sCallStack', None), # where the task was made, by an arranger with isRecordStack
+                'stack': ''.join(traceback.format_list(aFrames))
+        };
+    def getStats(self, nSpots=10):
+        aBuckets = [];
+        nLower = 0;
+        for nBound, nCount in zip(self.aBounds, self.aCounts):
+            aBuckets.append(('{}-{}ms'.format(round(nLower * 1000), round(nBound * 1000)) if nBound != float('inf') else '>{}ms'.format(round(nLower * 1000)), nCount));
+            nLower = nBound;
+        return {
+                'beats': self.nBeats,
+                'mean': round(self.nTotalLag / self.nBeats, 4) if self.nBeats else 0,
+                'max': round(self.nMaxLag, 4),
+                'histogram': aBuckets,
+                'stalls': sum(spot[0] for spot in self.mSpots.values()),
+                'spots': [
+                        ('{}:{} {}'.format(*key), nStalls, round(nSeconds, 3))
+                        for key, (nStalls, nSeconds) in sorted(self.mSpots.items(), key=lambda item: item[1][1], reverse=True)[:nSpots]
+                ]
+        };
+    def output(self, nReports=3):
+        pprint(self.getStats());
+        for report in list(self.reports)[-nReports:] if nReports else ():
+            print('stalled for {}s in task {} ({}):'.format(report['lag'], report['task'], report['arranger']));
+            print(report['stack']);
@@ -10,6 +10,7 @@ import psycopg2.errorcodes
 from psycopg2.sql import SQL, Identifier, Placeholder, Literal
 
 from . import records
+from . import codec
 from .configure import config
 
 Data = namedtuple('Data', ('field', 'type', 'value'));
@@ -18,7 +19,8 @@ log = logging.getLogger(__name__);
 def prepare():
     global log;
     log.setLevel(config.nLogLevel);
-    psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+    # JSONB values are serialized by the codec in use
+    psycopg2.extensions.register_adapter(dict, lambda mData: psycopg2.extras.Json(mData, dumps=codec.dumps))
 prepare();
 
 def makeData(record):
@@ -192,6 +194,7 @@ class PostgresDisposer(SqlDisposer):
         self._save('createtable');
         try:
             self._execute(query);
+            self._addColumns(sTable, record);
         except Exception as e:
             self._back('createtable');
             log.error(e);
@@ -203,6 +206,22 @@ class PostgresDisposer(SqlDisposer):
             return True;
         finally:
             self._release('createtable');
+    def _addColumns(self, sTable, record):
+        # tables created by former versions get the columns added since; ADD COLUMN IF NOT EXISTS would take PostgreSQL 9.6
+        query = SQL('SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = {};').format(Literal(sTable));
+        with self.conn.cursor() as cursor:
+            self._execute(query, cursor=cursor);
+            columnSet = set(aRow[0] for aRow in cursor.fetchall());
+        aMissing = [(sName, sType) for sName, sType in sorted(record.mVarCast.values()) if sName not in columnSet];
+        if (not aMissing):
+            return False;
+        query = SQL('ALTER TABLE {} {};').format(
+                Identifier(sTable),
+                SQL(', ').join(SQL('ADD COLUMN {} {}').format(Identifier(sName), SQL(sType)) for sName, sType in aMissing)
+        );
+        self._execute(query);
+        log.info('columns {} added to "{}"'.format(', '.join(sName for sName, sType in aMissing), sTable));
+        return True;
     def dropTable(self, record, isRaise=True):
         if (type(record) is type):
             record = record();
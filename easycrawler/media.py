@@ -0,0 +1,93 @@
+import logging
+import asyncio
+import os
+import datetime
+import urllib.parse
+
+from . import asset
+from .configure import config
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
+
+class MediaPipeline():
+    # downloads attachments of posts apart from the API crawl: its own host slots, connections and tasks, so slow transfers never hold up API fetches
+    # every media is downloaded once per pipeline however many posts carry it
+    def __init__(self, sDir=None, loop=None, store=None, nLimit=None, nLimitPerHost=None, sUa=None):
+        self.loop = loop or asyncio.get_event_loop();
+        self.sDir = sDir or config.sFileDir;
+        self.store = store or None; # MediaStore, by default the one of config.sStoreDir if set
+        nLimit = nLimit or config.nMediaLimit;
+        nLimitPerHost = nLimitPerHost or config.nMediaLimitPerHost;
+        self.lock = asset.PerHostLock(self.loop, nLimit, nLimitPerHost);
+        self.connector = asset.newConnector(nLimit, nLimitPerHost);
+        self.session = asset.newSession({'User-Agent': sUa or asset.UA}, connector=self.connector);
+        self.arranger = asset.TaskArranger(self.loop);
+        self.mTask = {}; # (type, id) -> task
+        self.nDone = 0;
+        self.nFailed = 0;
+        self.nBytes = 0;
+    def _makeKey(self, media):
+        return (media.sType, media.sId or media.sUrl);
+    def feed(self, post):
+        for media in post.aAttach or ():
+            self.add(media);
+    def add(self, media):
+        if (not (media.sUrl or media.sPreview)):
+            return None;
+        key = self._makeKey(media);
+        task = self.mTask.get(key);
+        if (task is None):
+            task = self.mTask[key] = self.arranger.task(self.download(media));
+        else:
+            # another record of a media already scheduled shares its result
+            task.add_done_callback(lambda task: self._copy(task, media));
+        return task;
+    def _copy(self, task, media):
+        # a task failing past download, as when its arranger dies, has no result to share
+        if (not task.cancelled() and not task.exception() and task.result()):
+            source = task.result();
+            media.sPath = source.sPath;
+            media.nSize = source.nSize;
+            media.fetchTime = source.fetchTime;
+    def makeFileName(self, media):
+        sUrl = media.sUrl or media.sPreview;
+        sExt = os.path.splitext(urllib.parse.urlsplit(sUrl).path)[1];
+        return '{}{}'.format(media.sId, sExt) if media.sId else None;
+    async def download(self, media):
+        sUrl = media.sUrl or media.sPreview;
+        try:
+            isNew, sPath = await asset.fetchStream(
+                    sUrl, self.sDir, self.makeFileName(media), isDuplicate=False,
+                    session=self.session, store=self.store, lock=self.lock
+            );
+        except Exception as e:
+            self.nFailed += 1;
+            log.warning('failed to download {} from {}: {}'.format(media, sUrl, e));
+            return None;
+        media.sPath = sPath;
+        media.nSize = os.path.getsize(sPath);
+        media.fetchTime = datetime.datetime.now();
+        self.nDone += 1;
+        if (isNew):
+            self.nBytes += media.nSize;
+        return media;
+    async def join(self, nTimeout=None):
+        await self.arranger.join(nTimeout);
+    def getStats(self):
+        return {
+                'scheduled': len(self.mTask),
+                'pending': len(self.arranger.aliveTask),
+                'done': self.nDone,
+                'failed': self.nFailed,
+                'bytes': self.nBytes
+        };
+    async def cleanup(self):
+        await self.arranger.close();
+        await self.session.close();
+        await self.connector.close();
+        log.debug('media pipeline closed: {}'.format(self.getStats()));
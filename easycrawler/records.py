@@ -457,13 +457,17 @@ class Media(PostRecord):
             'date': ('date', 'TIMESTAMP'),
             'sAuthorId': ('authorid', 'TEXT'),
             'sAuthor': ('author', 'TEXT'),
-            'sPreview': ('preview', 'TEXT')
+            'sPreview': ('preview', 'TEXT'),
+            'sPath': ('path', 'TEXT'),
+            'nSize': ('size', 'BIGINT')
     };
     def __init__(self, sType=None, sPostId=None, sPreview=None, **karg):
         super().__init__(**karg);
         self.sType = sType or 'media';
         self.sPostId = sPostId;
         self.sPreview = sPreview;
+        self.sPath = None; # local copy, set once downloaded
+        self.nSize = None;
     def __repr__(self):
         return '< media "{}": "{}"-"{}" >'.format(type(self).__name__, self.sType, self.sName);
     def __eq__(self, media):
@@ -1,11 +1,12 @@
 import logging
 import re
-import json
 import asyncio
 import datetime
 import time
 import html
 import urllib.parse
+import mmap
+import functools
 
 import aiohttp
 import lxml
@@ -13,7 +14,9 @@ import lxml.etree, lxml.html
 
 from . import records
 from . import asset
-from .asset import fetchBytes, fetchJson, Response, mergeQuery, innerHtml, html2Unicode
+from . import codec
+from . import worker
+from .asset import fetchBytes, fetchJson, fetchTree, Response, mergeQuery, innerHtml, innerHtmls, html2Unicode
 from .configure import config
 
 
@@ -36,40 +39,128 @@ class ArticleNotFoundError(PostNotFoundError):
 class Url(str):
     isResolved = False;
 
+resolveCache = asset.TtlCache(config.nResolveCacheSize, config.nResolveCacheTtl);
+
+minutePattern = re.compile(r'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d)');
+
+@functools.lru_cache(maxsize=1024)
+def parseMinute(sDate):
+    # datetime.strptime(sDate, '%Y-%m-%d %H:%M') without strptime, once per distinct minute; the floors of a page mostly share their days
+    match = minutePattern.fullmatch(sDate);
+    if (not match):
+        return datetime.datetime.strptime(sDate, '%Y-%m-%d %H:%M');
+    return datetime.datetime(*map(int, match.groups()));
+noHeadHostSet = set(); # hosts known to answer HEAD requests wrongly
+headRetry = asset.RetryPolicy(nCount=2); # HEAD is only a shortcut for resolving, GET is tried after a single retry
+
 class Source():
-    def __init__(self, sName=None, sUa=None, loop=None, arranger=None):
+    isHeadResolve = True;
+    def __init__(self, sName=None, sUa=None, loop=None, arranger=None, retry=None, isCoalesce=False, cache=None, isHedge=False, nMaxSize=None, nSpillSize=None, media=None, sTransport=None, parsePool=None):
         self.sName = sName;
         self.UA = sUa or asset.UA;
         self.loop = loop or asyncio.get_event_loop();
         mHeaders = {'User-Agent': self.UA};
-        connector = aiohttp.TCPConnector(force_close=True, enable_cleanup_closed=True);
-        self.session = aiohttp.ClientSession(connector=connector, headers=mHeaders, trust_env=True, read_timeout=config.nReadTimeout);
+        self.session = asset.newSession(mHeaders, sTransport=sTransport); # sTransport: key of asset.mTransport, config.sTransport by default
         self.parser = lxml.html.HTMLParser(encoding='utf-8');
         self.arranger = arranger or asset.arranger;
+        self.retry = retry or asset.defaultRetry;
+        self.isCoalesce = isCoalesce or False;
+        self.cache = cache or None; # e.g. asset.httpCache to revalidate pages fetched by former runs
+        self.isHedge = isHedge or False;
+        self.nMaxSize = nMaxSize or None;
+        self.nSpillSize = nSpillSize or None;
+        self.media = media or None; # media.MediaPipeline attachments of parsed posts are handed to
+        self.parsePool = parsePool if parsePool is not None else worker.getDefaultPool(); # worker.ParsePool pages are parsed in, False to parse on the loop whatever config.sParseMode says
+        if (config.sResolveCacheFile and not resolveCache.sPath):
+            resolveCache.load(config.sResolveCacheFile);
     async def resolve(self, sUrl):
         assert isinstance(sUrl, str);
         if (getattr(sUrl, 'isResolved', None)):
             return sUrl;
         else:
-            async with Response(sUrl, session=self.session) as res:
-                sLastUrl = Url(res.url);
+            sLastUrl = resolveCache.get(sUrl);
+            if (sLastUrl is None):
+                sLastUrl = await self._resolve(sUrl);
+                resolveCache.set(sUrl, sLastUrl);
+            sLastUrl = Url(sLastUrl);
             sLastUrl.isResolved = True;
             return sLastUrl;
+    async def _resolve(self, sUrl):
+        sHost = urllib.parse.urlsplit(sUrl).netloc;
+        if (self.isHeadResolve and sHost not in noHeadHostSet):
+            try:
+                async with Response(sUrl, session=self.session, retry=headRetry, sMethod='HEAD') as res:
+                    return str(res.url);
+            except aiohttp.ClientResponseError as e:
+                if (e.status in (405, 501)):
+                    log.debug('HEAD request not supported by "{}" ({}), resolving with GET from now on'.format(sHost, e.status));
+                    noHeadHostSet.add(sHost);
+                    nHeadStatus = None;
+                else:
+                    log.debug('HEAD request to "{}" failed ({}), resolving with GET'.format(sHost, e.status));
+                    nHeadStatus = e.status;
+            async with Response(sUrl, session=self.session, retry=self.retry) as res:
+                if (nHeadStatus and 400 <= nHeadStatus < 500 and nHeadStatus not in (408, 429)):
+                    # refused to HEAD what GET serves, the host will be refused again
+                    log.debug('"{}" answers HEAD with {} but GET with {}, resolving with GET from now on'.format(sHost, nHeadStatus, res.status));
+                    noHeadHostSet.add(sHost);
+                await self._keepBody(res);
+                return str(res.url);
+        async with Response(sUrl, session=self.session, retry=self.retry) as res:
+            await self._keepBody(res);
+            return str(res.url);
+    async def _keepBody(self, res):
+        # a response is archived only once read to the end, a GET released unread would be missing when replayed
+        if (asset.getArchive()):
+            await res.read();
     async def queryJson(self, sUrl, mAssert=None, isTypeCheck=False):
-        return await fetchJson(sUrl, session=self.session, mAssert=mAssert, isTypeCheck=isTypeCheck);
+        return await fetchJson(sUrl, session=self.session, mAssert=mAssert, isTypeCheck=isTypeCheck, retry=self.retry, isCoalesce=self.isCoalesce, cache=self.cache, isHedge=self.isHedge, nMaxSize=self.nMaxSize);
     async def queryBytes(self, sUrl):
-        return await fetchBytes(sUrl, session=self.session);
+        # bodies over self.nSpillSize, if given, come back as mmap.mmap, which parse and the bytes patterns take as well
+        # either carries the charset of the response and the URL, with which parse decodes it
+        return await fetchBytes(sUrl, session=self.session, retry=self.retry, isCoalesce=self.isCoalesce, cache=self.cache, isHedge=self.isHedge, nMaxSize=self.nMaxSize, nSpillSize=self.nSpillSize, isBody=True);
+    async def queryTree(self, sUrl, aRewrite=None, sStopTag=None, sStopId=None):
+        return await fetchTree(sUrl, session=self.session, retry=self.retry, aRewrite=aRewrite, sStopTag=sStopTag, sStopId=sStopId, nMaxSize=self.nMaxSize, isCoalesce=self.isCoalesce, cache=self.cache, isHedge=self.isHedge);
+    async def queryPage(self, sUrl, aRewrite=None, sStopTag=None, sStopId=None):
+        # a page for runParse, rewritten by the (bytes pattern, replacement) pairs of aRewrite; both ways honour the options of the source
+        # without a parse pool its tree, parsed on the loop as it arrives and up to the stop element, as of queryTree;
+        # with one its whole body as of queryBytes, since trees do not go to worker processes
+        if (not self.parsePool):
+            return await self.queryTree(sUrl, aRewrite=aRewrite, sStopTag=sStopTag, sStopId=sStopId);
+        data = await self.queryBytes(sUrl);
+        if (aRewrite):
+            sCharset, sUrl = data.sCharset, data.sUrl;
+            for pattern, repl in aRewrite:
+                data = pattern.sub(repl, data);
+            data = asset.Body(data, sCharset, sUrl);
+        return data;
+    async def runParse(self, sMethod, *arg, **karg):
+        # self.sMethod(*arg, **karg), in a worker of the parse pool if there is one; what it returns has to be picklable for a process pool
+        if (self.parsePool):
+            return await self.parsePool.run(type(self), sMethod, *arg, **karg);
+        return getattr(self, sMethod)(*arg, **karg);
     def parse(self, html, *arg, parser=None, **karg):
         if (lxml.etree.iselement(html)):
             return html;
+        if (isinstance(html, mmap.mmap)):
+            # let lxml read the mapped file by itself instead of decoding a copy of it
+            # arg and karg as of lxml.html.fromstring, of which only base_url is positional
+            if (arg):
+                karg['base_url'] = arg[0];
+            if (parser is None):
+                parser = lxml.html.HTMLParser(encoding=asset.detectEncoding(html[:64*1024], getattr(html, 'sCharset', None), getattr(html, 'sUrl', None)) or 'utf-8');
+            html.seek(0);
+            return lxml.html.parse(html, parser=parser, **karg).getroot();
         if (isinstance(html, bytes)):
-            html = html2Unicode(html);
+            html = html2Unicode(html, getattr(html, 'sCharset', None), getattr(html, 'sUrl', None));
         parser = parser or self.parser;
         return lxml.html.fromstring(html, *arg, **karg, parser=parser);
     def grab(self):
         pass
     async def cleanup(self):
         await self.session.close();
+        if (resolveCache.sPath):
+            resolveCache.save();
         log.debug('{} closed'.format(type(self).__name__));
 
 class HtmlSource(Source):
@@ -99,15 +190,12 @@ class TiebaSource(Source):
     sApiMobileForum = 'https://tieba.baidu.com/mo/q----,sz@320_240-1-3---2/m?kw={}&pn={}'; #forum.sName, nPosts (20 * (nPage-1))
 
     postPattern = re.compile(r'^https?://tieba\.baidu\.com/p/(\d+)(?:\?|$)');
-    postPropPattern = re.compile(r'PageData\.thread\s*=\s*\{\s*author\s*:\s*"(.+?)"\s*,\s*thread_id\s*:\s*(\d+?)\s*,\s*title\s*:\s*"(.+?)"s*,\s*reply_num\s*:\s*(\d+?)\s*,');
     userPattern = re.compile(r'https?://tieba\.baidu\.com/home/main/?\?(?:[^#]+&)?un=([^&#]+)');
     forumPattern = re.compile(r'^https?://tieba\.baidu\.com/f\?(?:[^#]+&)?kw=([^&#]+)');
-    forumPropPattern = re.compile(r'PageData\.forum\s*=\s*(\{[\s\S]+?\})\s*;');
-    pagePropPattern = re.compile(r'PageData\.pager\s*=\s*(\{[\s\S]+?\})\s*;');
-    quotePattern = re.compile(r'(?<!\\)\''); # replace ' with " to make it valid JSON string, but keep ' which following \
     commentedForumPattern = re.compile(rb'<!--\s*<ul id="thread_list"'); # post list in tieba forum page is commented out in some case
 
-    commentPropPath = lxml.etree.XPath('//div[contains(@class, "l_post")]/@data-field');
+    commentFloorPath = lxml.etree.XPath('//div[contains(@class, "l_post")][@data-field]');
+    commentContentPath = lxml.etree.XPath('.//div[@id=$sId]');
     postPageDataPath = lxml.etree.XPath('.//div[@class="wrap1"]//script[1]');
     forumPageDataPath = lxml.etree.XPath('/html/head/script[contains(., "PageData.forum")][1]');
     titlePath = lxml.etree.XPath('/html/head/title/text()');
@@ -168,8 +256,8 @@ class TiebaSource(Source):
         aResult = []
         while nPage <= nMaxPage:
             sApi = self.sApiPost.format(sPostId, nPage);
-            bData = await self.queryBytes(sApi);
-            aComments = self.parseComments(data=bData, sPostId=sPostId, nPage=nPage);
+            data = await self.queryPage(sApi, sStopTag='div', sStopId='j_p_postlist');
+            aComments = await self.runParse('parseComments', data=data, sPostId=sPostId, nPage=nPage);
             if (aComments):
                 aResult.extend(aComments);
                 nPage += 1;
@@ -181,10 +269,11 @@ class TiebaSource(Source):
         sTitle, nComments, sForumId, sForum, nMaxPage = self.parsePageData(ele);
         if (nPage > nMaxPage):
             return [];
-        aDataFields = self.commentPropPath(ele);
         aComments = []
-        for sData in aDataFields:
-            mData = json.loads(html.unescape(sData));
+        aTargets = [];
+        for floor in self.commentFloorPath(ele):
+            # the content of a floor is looked for in the floor first, sparing a search of the whole document for each of them
+            mData = codec.loads(html.unescape(floor.get('data-field')));
             if not ('date' in mData['content']):
                 continue; # advertisement
             comment = records.TiebaComment();
@@ -194,11 +283,11 @@ class TiebaSource(Source):
             comment.sPostId = sPostId;
             sIdAttr = 'post_content_{}'.format(comment.sId);
             comment.sUrl = '{}#{}'.format(self.sApiPost.format(sPostId, nPage), sIdAttr);
-            target = ele.xpath('//div[@id="{}"]'.format(sIdAttr))[0];
+            target = (self.commentContentPath(floor, sId=sIdAttr) or self.commentContentPath(ele, sId=sIdAttr))[0];
             #comment.sText = target.text_content();
             comment.sText = lxml.etree.tostring(target, method='text', encoding='utf-8').decode(errors='replace');
-            comment.sContent = innerHtml(target);
-            comment.date = datetime.datetime.strptime(mData['content']['date'], '%Y-%m-%d %H:%M');
+            aTargets.append(target);
+            comment.date = parseMinute(mData['content']['date']);
             sAuthor = mData['author'].get('user_name');
             sAuthorId = str(mData['author'].get('user_id'));
             comment.author = records.TiebaUser(sId=sAuthorId, sName=sAuthor);
@@ -213,20 +302,22 @@ class TiebaSource(Source):
         if (nPage == 1):
             aComments[0].sName = sTitle or self.titlePath(ele)[0];
             aComments[0].nComments = nComments;
+        # the contents are cleaned in place only now that nothing more is looked for in the page, and only in a tree parsed here:
+        # one handed in belongs to the caller
+        isOwned = not lxml.etree.iselement(data);
+        for comment, target in zip(aComments, aTargets):
+            comment.sContent = innerHtml(target, isOwned=isOwned);
         return aComments;
     def parsePageData(self, data):
         ele = self.parse(data);
         sScript = self.postPageDataPath(ele)[0].text;
-        match = self.postPropPattern.search(sScript);
-        sAuthor, sPostId, sTitle, nComments = match.groups();
-        match = self.forumPropPattern.search(sScript);
-        #mData = json.loads(match.group(1).replace('\'', '"'));
-        mData = json.loads(self.quotePattern.sub('"', match.group(1)));
+        # the title and the reply count as written in the page, the way they always came
+        mData = codec.loadsFields(sScript, 'PageData.thread', ('title', 'reply_num'), isRaw=True);
+        sTitle, nComments = mData['title'], mData['reply_num'];
+        mData = codec.loadsFields(sScript, 'PageData.forum', ('true_forum_id', 'forum_id', 'forum_name'));
         sForumId = str(mData.get('true_forum_id') or mData['forum_id']);
         sForum = mData['forum_name'];
-        match = self.pagePropPattern.search(sScript);
-        #mData = json.loads(match.group(1).replace('\'', '"'));
-        mData = json.loads(self.quotePattern.sub('"', match.group(1)));
+        mData = codec.loadsFields(sScript, 'PageData.pager', ('total_page',));
         nMaxPage = mData['total_page']
         return sTitle, nComments, sForumId, sForum, nMaxPage;
     async def getSubComments(self, sPostId, nPage=1, nPageCount=1):
@@ -238,7 +329,7 @@ class TiebaSource(Source):
         while nPage <= nMaxPage:
             sApi = self.sApiComment.format(sPostId, nPage, int(time.time()*1000));
             mData = await self.queryJson(sApi, mAssert={'errno': 0});
-            aSubComments = self.parseSubComments(data=mData, sPostId=sPostId, nPage=nPage);
+            aSubComments = await self.runParse('parseSubComments', data=mData, sPostId=sPostId, nPage=nPage);
             if (aSubComments):
                 aResult.extend(aSubComments);
                 nPage += 1;
@@ -246,7 +337,7 @@ class TiebaSource(Source):
                 break;
         return aResult;
     def parseSubComments(self, data, sPostId, nPage):
-        mData = data if isinstance(data, dict) else json.loads(data);
+        mData = data if isinstance(data, dict) else codec.loads(data);
         aRawComments = mData['data']['comment_list'];
         if (not aRawComments):
             return [];
@@ -329,12 +420,12 @@ class TiebaSource(Source):
         while nPage <= nMaxPage:
             nPosts = (nPage-1)*50;
             sApi = mergeQuery(sApi, {'pn': nPosts});
-            bData = await self.queryBytes(sApi);
-            #bData = re.sub(rb'<!--\s*<ul id="thread_list"', b'<ul id="thread_list"', bData);
-            bData = self.commentedForumPattern.sub(b'<ul id="thread_list"', bData);
-            ele = self.parse(bData);
-            self.parseForum(ele, forum=forum);
-            aPosts = self.parsePosts(data=ele, idSet=forum.postIdSet);
+            data = await self.queryPage(sApi, aRewrite=[(self.commentedForumPattern, b'<ul id="thread_list"')], sStopTag='ul', sStopId='thread_list');
+            # the page is parsed along with a forum record without the posts got so far, which need not go to a worker
+            page = records.TiebaForum();
+            page.sId, page.sName, page.sUrl, page.postIdSet = forum.sId, forum.sName, forum.sUrl, forum.postIdSet;
+            page, aPosts = await self.runParse('parseForumPage', data=data, forum=page);
+            forum.sId, forum.sName, forum.sUrl, forum.postIdSet = page.sId, page.sName, page.sUrl, page.postIdSet;
             if (aPosts):
                 forum.aPosts.extend(aPosts);
                 nPage += 1;
@@ -351,20 +442,22 @@ class TiebaSource(Source):
         forum = forum or records.TiebaForum();
         if not (forum.sId and forum.sName and forum.sUrl):
             sScript = self.forumPageDataPath(ele)[0].text;
-            match = self.forumPropPattern.search(sScript);
-            #mData = json.loads(match.group(1).replace('\'', '"'));
-            mData = json.loads(self.quotePattern.sub('"', match.group(1)));
+            mData = codec.loadsFields(sScript, 'PageData.forum', ('id', 'name'));
             forum.sId = str(mData['id']);
             forum.sName = mData['name'];
             forum.sUrl = self.sApiForum.format(forum.sName, 0);
         if (isReturn):
             return forum
+    def parseForumPage(self, data, forum):
+        ele = self.parse(data);
+        self.parseForum(ele, forum=forum);
+        return forum, self.parsePosts(data=ele, idSet=forum.postIdSet);
     def parsePosts(self, data, idSet):
         ele = self.parse(data);
         aPosts = [];
         aLi = self.forumLiPath(ele);
         for li in aLi:
-            mData = json.loads(html.unescape(li.get('data-field')));
+            mData = codec.loads(html.unescape(li.get('data-field')));
             if (mData['id'] in idSet):
                 continue;
             post = records.TiebaPost();
@@ -387,7 +480,7 @@ class TiebaSource(Source):
             if (not user.fetchTime):
                 aTasks.append(self.arranger.task(self.getUser(user=user)));
         if (aTasks):
-            await asyncio.gather(*aTasks, loop=self.loop);
+            await asyncio.gather(*aTasks);
         log.debug('detail of forum {} got'.format(forum));
         return True;
 
@@ -402,7 +495,6 @@ class WeiboSource(Source):
 
     UA = 'Android / Chrome 40: Mozilla/5.0 (Linux; Android 5.1.1; Nexus 4 Build/LMY48T) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/40.0.2214.89 Mobile Safari/537.36';
 
-    postStatusPattern = re.compile(rb'<script>[^<>]+?var \$render_data = (\[\{[\s\S]+?\}\])\[0\] \|\| \{\};\s*</script>');
     userCidPattern = re.compile(r'^https?://m\.weibo\.cn/p/(\d+)');
     userUidPattern = re.compile(r'^https?://m\.weibo\.cn/u/(\d+)');
     postPattern = re.compile(r'^https?://m\.weibo\.cn/status/(\w+)');
@@ -460,7 +552,7 @@ class WeiboSource(Source):
         if (mUser):
             mUserInfo = mUser;
         else:
-            mData = data if isinstance(data, dict) else json.loads(data.decode());
+            mData = data if isinstance(data, dict) else codec.loads(data);
             assert mData['ok'] == 1;
             mData = mData['data'];
             mUserInfo = mData['userInfo'];
@@ -481,7 +573,7 @@ class WeiboSource(Source):
             return user;
     def parseInfo(self, data, user):
         assert isinstance(user, records.WeiboUser);
-        mData = data if isinstance(data, dict) else json.loads(data.decode());
+        mData = data if isinstance(data, dict) else codec.loads(data);
         assert mData['ok'] == 1;
         aCards = mData['data']['cards'];
         for mCard in aCards:
@@ -505,13 +597,13 @@ class WeiboSource(Source):
             sApi = sUrl;
         assert sApi;
         bData = await self.queryBytes(sApi);
-        match = self.postStatusPattern.search(bData);
-        if (not match):
+        aData = codec.loadsObject(bData, b'var $render_data');
+        if (not aData):
             if (isRaise):
                 raise PostNotFoundError(self);
             else:
                 return False;
-        mData = json.loads(match.group(1).decode())[0]['status'];
+        mData = aData[0]['status'];
         self.parsePost(data=mData, post=post);
         post.sUrl = sApi.split('?')[0];
         if (isWithComment):
@@ -522,7 +614,7 @@ class WeiboSource(Source):
     def parsePost(self, data, post=None):
         isReturn = False if post else True;
         post = post or records.WeiboPost();
-        mBlog = data if isinstance(data, dict) else json.loads(data.decode());
+        mBlog = data if isinstance(data, dict) else codec.loads(data);
         self.objectifyBlog(mBlog, post);
         if (isReturn):
             return post;
@@ -564,8 +656,18 @@ class WeiboSource(Source):
                         sPreview=mPic['url'],
                         sName='pic_{}'.format(i)
                 ));
+        if (self.media):
+            self.media.feed(post);
         if (isReturn):
             return post;
+    def feedMedia(self, aPosts):
+        # workers of a parse pool have no media pipeline, attachments of the posts they parsed are handed to it back on the loop
+        if (not (self.parsePool and self.media)):
+            return;
+        for post in aPosts:
+            self.media.feed(post);
+            if (post.repost):
+                self.media.feed(post.repost);
     async def getComments(self, post=None, sPostId=None, nPage=1, nPageCount=1, isHot=False):
         if (post):
             sPostId = post.sId;
@@ -574,7 +676,7 @@ class WeiboSource(Source):
         if (isHot):
             sApi = self.sApiComment.format(sPostId, 1)
             mData = await self.queryJson(sApi);
-            aComments = self.parseComments(data=mData, sPostId=sPostId, isHot=True);
+            aComments = await self.runParse('parseComments', data=mData, sPostId=sPostId, isHot=True);
         else:
             nPage = nPage or 1;
             nPageCount = float('inf') if nPageCount == 0 else nPageCount or 1;
@@ -582,26 +684,27 @@ class WeiboSource(Source):
             while True:
                 sApi = self.sApiComment.format(sPostId, nPage)
                 mData = await self.queryJson(sApi);
-                aResult = self.parseComments(mData, sPostId=sPostId);
+                aResult = await self.runParse('parseComments', mData, sPostId=sPostId);
                 aComments.extend(aResult);
                 nPage += 1;
                 if (nPage > nMaxPage):
                     break;
         return aComments;
     def parseComments(self, data, sPostId=None, isHot=False):
-        mData = data if isinstance(data, dict) else json.loads(data.decode());
+        mData = data if isinstance(data, dict) else codec.loads(data);
         if (mData['ok'] != 1):
             return [];
         aComments = [];
         mData = mData['data'];
         if (isHot and mData.get('hot_data')):
-            for mComment in mData['hot_data']:
+            aRawComments = mData['hot_data'];
+            for mComment, sContent in zip(aRawComments, innerHtmls([mComment['text'] for mComment in aRawComments])):
                 comment = records.WeiboComment();
                 comment.fetchTime = datetime.datetime.now();
                 comment.sId = str(mComment['id']);
                 comment.sType = 'hot';
                 comment.sSource = mComment['source'];
-                comment.sContent = innerHtml(mComment['text'], isAggregate=True);
+                comment.sContent = sContent;
                 comment.sName = comment.sContent[:9];
                 comment.nLike = mComment['like_counts'];
                 comment.author = self.parseUser(mUser=mComment['user']);
@@ -609,12 +712,13 @@ class WeiboSource(Source):
                 aComments.append(comment);
             return aComments;
         else:
-            for mComment in mData['data']:
+            aRawComments = mData['data'];
+            for mComment, sContent in zip(aRawComments, innerHtmls([mComment['text'] for mComment in aRawComments])):
                 comment = records.WeiboComment();
                 comment.fetchTime = datetime.datetime.now();
                 comment.sId = str(mComment['id']);
                 comment.sSource = mComment['source'];
-                comment.sContent = innerHtml(mComment['text'], isAggregate=True);
+                comment.sContent = sContent;
                 comment.sName = comment.sContent[:9];
                 comment.nLike = mComment['like_counts'];
                 comment.author = self.parseUser(mUser=mComment['user']);
@@ -635,7 +739,8 @@ class WeiboSource(Source):
         while True:
             sApi = self.sApiUserWeibo.format(sWeiboCid, nPage);
             mData = await self.queryJson(sApi, mAssert={});
-            aResult = self.parseWeibo(mData);
+            aResult = await self.runParse('parseWeibo', mData);
+            self.feedMedia(aResult);
             if (isFull):
                 for post in aResult:
                     aTasks.append(self.arranger.task(self.getPost(post=post, isWithComment=isWithComment, isRaise=False)));
@@ -647,7 +752,7 @@ class WeiboSource(Source):
             await asyncio.gather(*aTasks);
         return aWeibo;
     def parseWeibo(self, data):
-        mData = data if isinstance(data, dict) else json.loads(data.decode());
+        mData = data if isinstance(data, dict) else codec.loads(data);
         if (mData['ok'] != 1):
             return [];
         aCards = mData['data']['cards']
@@ -678,13 +783,13 @@ class WeiboSource(Source):
                 raise UrlUnmatchError(sUrl, type(article));
             sApi = sUrl;
         bData = await self.queryBytes(sApi);
-        match = self.postStatusPattern.search(bData);
-        if (not match):
+        aData = codec.loadsObject(bData, b'var $render_data');
+        if (not aData):
             if (isRaise):
                 raise ArticleNotFoundError(self);
             else:
                 return False;
-        mData = json.loads(match.group(1).decode())[0];
+        mData = aData[0];
         self.parseArticle(mData=mData, article=article);
         article.sUrl = self.sApiArticle.format(article.sPageId);
         if (isWithComment):
@@ -0,0 +1,101 @@
+import logging
+import asyncio
+import os
+import hashlib
+import sqlite3
+import threading
+
+from .configure import config
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
+
+class MediaStore():
+    # content addressed files: every distinct content is kept once as <root>/ab/cd/<sha256><ext>
+    # urls and names are only keys of an index pointing to those blobs, so neither colliding names nor huge directories cost anything
+    nBuffer = 1024*1024;
+    def __init__(self, sRoot=None):
+        self.sRoot = sRoot or config.sStoreDir;
+        self.sTmpDir = os.path.join(self.sRoot, 'tmp');
+        os.makedirs(self.sTmpDir, exist_ok=True);
+        self.lock = threading.Lock(); # blobs are put from executor threads
+        self.db = sqlite3.connect(os.path.join(self.sRoot, 'index.sqlite'), check_same_thread=False);
+        self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS blob (hash TEXT PRIMARY KEY, size INTEGER, ext TEXT);
+                CREATE TABLE IF NOT EXISTS link (key TEXT PRIMARY KEY, hash TEXT NOT NULL);
+        ''');
+        self.nStored = 0;
+        self.nDeduped = 0;
+        self.tmpPathSet = set(); # temporary paths downloads are running into
+    def getBlobPath(self, sHash, sExt=''):
+        return os.path.join(self.sRoot, sHash[:2], sHash[2:4], sHash + sExt);
+    def claimTmpPath(self, sUrl):
+        # a url downloads to the same place every time, so that an interrupted download is resumed,
+        # unless a download of it is running there already: another one at the same time goes to a place of its own
+        sBase = os.path.join(self.sTmpDir, hashlib.sha1(sUrl.encode('utf-8')).hexdigest());
+        sPath = sBase;
+        nIndex = 0;
+        with self.lock:
+            while sPath in self.tmpPathSet:
+                nIndex += 1;
+                sPath = '{}.{}'.format(sBase, nIndex);
+            self.tmpPathSet.add(sPath);
+        return sPath;
+    def releaseTmpPath(self, sPath):
+        with self.lock:
+            self.tmpPathSet.discard(sPath);
+    def _makeKeys(self, sUrl=None, sName=None):
+        aKeys = [];
+        if (sUrl):
+            aKeys.append('url:' + sUrl);
+        if (sName):
+            aKeys.append('name:' + sName);
+        return aKeys;
+    def _lookup(self, sUrl=None, sName=None):
+        for sKey in self._makeKeys(sUrl, sName):
+            with self.lock:
+                aRow = self.db.execute('SELECT blob.hash, blob.ext FROM link JOIN blob ON link.hash = blob.hash WHERE link.key = ?', (sKey,)).fetchone();
+            if (aRow):
+                return self.getBlobPath(*aRow);
+        return None;
+    async def lookup(self, sUrl=None, sName=None):
+        # path of the blob a url or name is linked to, None if there is none; the index is read off the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, self._lookup, sUrl, sName);
+    def _put(self, sPath, sExt, aKeys):
+        digest = hashlib.sha256();
+        with open(sPath, 'rb') as file:
+            for bData in iter(lambda: file.read(self.nBuffer), b''):
+                digest.update(bData);
+        sHash = digest.hexdigest();
+        with self.lock:
+            aRow = self.db.execute('SELECT ext FROM blob WHERE hash = ?', (sHash,)).fetchone();
+            if (aRow and os.path.exists(self.getBlobPath(sHash, aRow[0]))):
+                sExt = aRow[0];
+                os.remove(sPath);
+                self.nDeduped += 1;
+            else:
+                sBlob = self.getBlobPath(sHash, sExt);
+                os.makedirs(os.path.dirname(sBlob), exist_ok=True);
+                nSize = os.path.getsize(sPath);
+                os.replace(sPath, sBlob);
+                self.db.execute('INSERT OR REPLACE INTO blob VALUES (?, ?, ?)', (sHash, nSize, sExt));
+                self.nStored += 1;
+            self.db.executemany('INSERT OR REPLACE INTO link VALUES (?, ?)', [(sKey, sHash) for sKey in aKeys]);
+            self.db.commit();
+        return self.getBlobPath(sHash, sExt);
+    async def put(self, sPath, sUrl=None, sName=None):
+        # moves the finished file at sPath into the store, hashing and writing off the event loop; identical content is kept only once
+        sExt = os.path.splitext(sName or '')[1][:16];
+        return await asyncio.get_event_loop().run_in_executor(None, self._put, sPath, sExt, self._makeKeys(sUrl, sName));
+    def getStats(self):
+        with self.lock:
+            nBlobs, nSize = self.db.execute('SELECT count(*), total(size) FROM blob').fetchone();
+            nLinks, = self.db.execute('SELECT count(*) FROM link').fetchone();
+        return {'blobs': nBlobs, 'bytes': int(nSize), 'links': nLinks, 'stored': self.nStored, 'deduped': self.nDeduped};
+    def close(self):
+        with self.lock:
+            self.db.close();
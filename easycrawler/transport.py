@@ -0,0 +1,145 @@
+import logging
+import asyncio
+from collections import namedtuple
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from .configure import config
+
+try:
+    import httpx
+except ImportError:
+    httpx = None;
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
+
+# the fetch layer talks to sessions the way it talks to aiohttp.ClientSession: `await session.request(method, url, headers=...)`,
+# `session.close()` and `session.closed`; responses expose the part of aiohttp.ClientResponse used by asset
+# (status, reason, url, headers, content_type, charset, content.read, read, raise_for_status, release, async with)
+
+RequestInfo = namedtuple('RequestInfo', ('url', 'method', 'headers', 'real_url'));
+
+def translateError(e):
+    # httpx errors as the aiohttp ones the retry policy and the circuit breaker understand
+    if (isinstance(e, httpx.TimeoutException)):
+        return asyncio.TimeoutError(str(e));
+    elif (isinstance(e, (httpx.RemoteProtocolError, httpx.ReadError))):
+        return aiohttp.ClientPayloadError(str(e));
+    elif (isinstance(e, httpx.TransportError)):
+        return aiohttp.ClientConnectionError(str(e));
+    return e;
+
+class Http2Content():
+    def __init__(self, response):
+        self.iterator = response.aiter_bytes();
+        self.buffer = bytearray();
+        self.isEof = False;
+    async def _fill(self):
+        try:
+            self.buffer += await self.iterator.__anext__();
+        except StopAsyncIteration:
+            self.isEof = True;
+        except httpx.HTTPError as e:
+            raise translateError(e) from e;
+    async def read(self, n=-1):
+        # like aiohttp.StreamReader.read, whatever is available up to n bytes, b'' only at the end
+        if (n < 0):
+            while not self.isEof:
+                await self._fill();
+            n = len(self.buffer);
+        while not self.buffer and not self.isEof:
+            await self._fill();
+        bData = bytes(self.buffer[:n]);
+        del self.buffer[:n];
+        return bData;
+    async def readany(self):
+        while not self.buffer and not self.isEof:
+            await self._fill();
+        bData = bytes(self.buffer);
+        self.buffer.clear();
+        return bData;
+
+class Http2Response():
+    def __init__(self, response):
+        self.response = response;
+        self.method = response.request.method;
+        self.url = str(response.url);
+        self.status = response.status_code;
+        self.reason = response.reason_phrase;
+        self.version = response.http_version;
+        self.headers = CIMultiDictProxy(CIMultiDict(response.headers.multi_items()));
+        self.history = tuple(response.history);
+        self.request_info = RequestInfo(str(response.request.url), self.method, CIMultiDictProxy(CIMultiDict(response.request.headers.multi_items())), str(response.request.url));
+        self.content = Http2Content(response);
+        sType, _, sParams = self.headers.get('Content-Type', 'application/octet-stream').partition(';');
+        self.content_type = sType.strip().lower();
+        self.charset = response.charset_encoding;
+        self._released = False;
+    async def __aenter__(self):
+        return self;
+    async def __aexit__(self, *arg, **karg):
+        self.release();
+    def raise_for_status(self):
+        if (self.status >= 400):
+            raise aiohttp.ClientResponseError(self.request_info, self.history, status=self.status, message=self.reason, headers=self.headers);
+    async def read(self):
+        return await self.content.read();
+    def release(self):
+        # an unread body resets just its own stream, the connection stays for the others
+        if (not self._released):
+            self._released = True;
+            asyncio.ensure_future(self.response.aclose());
+    close = release;
+
+class Http2Session():
+    # an aiohttp.ClientSession look-alike on httpx, multiplexing the requests to a host as streams of one HTTP/2 connection
+    # isPriorKnowledge: speak HTTP/2 over plain TCP right away instead of negotiating it in TLS
+    def __init__(self, mHeaders=None, nLimit=None, nTimeout=None, ssl=None, isPriorKnowledge=False):
+        if (httpx is None):
+            raise ImportError('the http2 transport requires httpx with HTTP/2 support: pip install httpx[http2]');
+        self.mClientArg = {
+                'http1': not isPriorKnowledge,
+                'http2': True,
+                'headers': mHeaders,
+                'limits': httpx.Limits(max_connections=nLimit, max_keepalive_connections=nLimit, keepalive_expiry=config.nKeepAlive),
+                'timeout': httpx.Timeout(nTimeout),
+                'verify': ssl if ssl is not None else True,
+                'follow_redirects': True,
+                'trust_env': True
+        };
+        self.client = httpx.AsyncClient(**self.mClientArg);
+        self.mProxyClient = {}; # httpx binds proxies to clients, so there is one more client per proxy in use
+    @property
+    def closed(self):
+        return self.client.is_closed;
+    def _getClient(self, sProxy=None):
+        if (not sProxy):
+            return self.client;
+        client = self.mProxyClient.get(sProxy);
+        if (client is None):
+            client = self.mProxyClient[sProxy] = httpx.AsyncClient(proxy=sProxy, **self.mClientArg);
+            client.cookies.jar = self.client.cookies.jar; # one cookie jar for the session, whatever the proxy
+        return client;
+    def getCookies(self, sUrl):
+        # the Cookie header this session would send to sUrl
+        request = httpx.Request('GET', sUrl);
+        self.client.cookies.set_cookie_header(request);
+        return request.headers.get('Cookie', '');
+    async def request(self, sMethod, sUrl, headers=None, proxy=None):
+        client = self._getClient(proxy);
+        request = client.build_request(sMethod, sUrl, headers=headers);
+        try:
+            response = await client.send(request, stream=True);
+        except httpx.HTTPError as e:
+            raise translateError(e) from e;
+        return Http2Response(response);
+    async def close(self):
+        for client in self.mProxyClient.values():
+            await client.aclose();
+        await self.client.aclose();
@@ -0,0 +1,114 @@
+import logging
+import asyncio
+import os
+import time
+import mmap
+import threading
+import concurrent.futures
+
+import lxml.html
+import lxml.etree
+
+from .configure import config
+
+log = logging.getLogger(__name__);
+
+def prepare():
+    global log;
+    log.setLevel(config.nLogLevel);
+prepare();
+
+local = threading.local(); # what a worker thread, or the one thread of a worker process, keeps for itself
+
+def getParser():
+    # lxml parsers are not to be shared between threads, every worker parses with its own
+    parser = getattr(local, 'parser', None);
+    if (parser is None):
+        parser = local.parser = lxml.html.HTMLParser(encoding='utf-8');
+    return parser;
+
+def getSource(sourceClass):
+    # the instance of sourceClass a worker parses with: no session nor media pipeline, and its own parser and copies of the compiled XPaths
+    mSource = getattr(local, 'mSource', None);
+    if (mSource is None):
+        mSource = local.mSource = {};
+    source = mSource.get(sourceClass);
+    if (source is None):
+        source = object.__new__(sourceClass);
+        source.parser = getParser();
+        source.media = None;
+        source.parsePool = None;
+        for sName in dir(sourceClass):
+            xpath = getattr(sourceClass, sName, None);
+            if (isinstance(xpath, lxml.etree.XPath)):
+                setattr(source, sName, lxml.etree.XPath(xpath.path));
+        mSource[sourceClass] = source;
+    return source;
+
+def call(sourceClass, sMethod, arg, karg):
+    return getattr(getSource(sourceClass), sMethod)(*arg, **karg);
+
+def toBytes(data):
+    # a mapping as bytes, an asset.SpilledBody as an asset.Body keeping how to decode it
+    if (not isinstance(data, mmap.mmap)):
+        return data;
+    toBody = getattr(data, 'toBody', None);
+    return toBody() if toBody else data[:];
+
+class ParsePool():
+    # parses pages apart from the event loop so that a big page no longer holds up every fetch in flight
+    # sMode: 'thread', workers sharing the memory while lxml lets go of the GIL for much of its parsing and serializing,
+    # or 'process', workers taking bytes, text or decoded JSON and giving records back, both pickled on the way
+    def __init__(self, sMode=None, nWorkers=None, loop=None):
+        self.sMode = sMode or config.sParseMode;
+        self.nWorkers = nWorkers or config.nParseWorkers or os.cpu_count() or 1;
+        self.loop = loop or asyncio.get_event_loop();
+        if (self.sMode == 'thread'):
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.nWorkers, thread_name_prefix='parse');
+        elif (self.sMode == 'process'):
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.nWorkers);
+        else:
+            raise ValueError('unknown parse mode {}'.format(self.sMode));
+        self.nPending = 0;
+        self.nDone = 0;
+        self.nSeconds = 0;
+    async def run(self, sourceClass, sMethod, *arg, **karg):
+        # sMethod of a worker's own sourceClass on arg and karg
+        if (self.sMode == 'process'):
+            # mappings are not pickled, their bytes are, whether passed by position or by keyword
+            arg = tuple(toBytes(data) for data in arg);
+            karg = {sName: toBytes(data) for sName, data in karg.items()};
+        self.nPending += 1;
+        nStart = time.perf_counter();
+        try:
+            return await self.loop.run_in_executor(self.executor, call, sourceClass, sMethod, arg, karg);
+        finally:
+            self.nPending -= 1;
+            self.nDone += 1;
+            self.nSeconds += time.perf_counter() - nStart;
+    def getStats(self):
+        return {
+                'mode': self.sMode,
+                'workers': self.nWorkers,
+                'pending': self.nPending,
+                'done': self.nDone,
+                'seconds': round(self.nSeconds, 3)
+        };
+    def close(self):
+        self.executor.shutdown(wait=True);
+        log.debug('parse pool closed: {}'.format(self.getStats()));
+
+defaultPool = None;
+
+def getDefaultPool():
+    # the pool of config.sParseMode shared by the sources given none, None to parse on the event loop
+    global defaultPool;
+    if (defaultPool is None and config.sParseMode != 'inline'):
+        defaultPool = ParsePool();
+    return defaultPool;
+
+def cleanup():
+    global defaultPool;
+    if (defaultPool):
+        defaultPool.close();
+        defaultPool = None;
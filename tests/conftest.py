@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+# the fetch layer keeps module level locks and budgets bound to the loop current when easycrawler is imported,
+# so every test runs on this one loop
+loop = asyncio.new_event_loop();
+asyncio.set_event_loop(loop);
+
+from easycrawler.configure import config
+
+@pytest.fixture
+def run():
+    return loop.run_until_complete;
+
+@pytest.fixture
+def serve():
+    # serve(app) starts an aiohttp application on a free local port and returns its base url
+    aRunners = [];
+    def start(app):
+        runner = web.AppRunner(app);
+        loop.run_until_complete(runner.setup());
+        site = web.TCPSite(runner, '127.0.0.1', 0);
+        loop.run_until_complete(site.start());
+        aRunners.append(runner);
+        return 'http://127.0.0.1:{}'.format(runner.addresses[0][1]);
+    yield start;
+    for runner in aRunners:
+        loop.run_until_complete(runner.cleanup());
+
+@pytest.fixture
+def setConfig():
+    # setConfig(name=value, ...) for the duration of a test
+    mSaved = {};
+    def set(**karg):
+        for sName, value in karg.items():
+            mSaved.setdefault(sName, getattr(config, sName));
+            setattr(config, sName, value);
+    yield set;
+    for sName, value in mSaved.items():
+        setattr(config, sName, value);
+
+@pytest.fixture(scope='session', autouse=True)
+def cleanup():
+    yield;
+    from easycrawler import asset
+    loop.run_until_complete(asset.cleanup());
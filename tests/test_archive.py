@@ -0,0 +1,61 @@
+import os
+
+from aiohttp import web
+
+from easycrawler import asset
+from easycrawler.archive import ResponseArchive
+
+def makeApp(bMedia):
+    async def page(request):
+        return web.Response(text='<html><body>page</body></html>', content_type='text/html');
+    async def media(request):
+        response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream', 'Content-Length': str(len(bMedia))});
+        await response.prepare(request);
+        for n in range(0, len(bMedia), 65536):
+            await response.write(bMedia[n:n + 65536]);
+        return response;
+    app = web.Application();
+    app.router.add_get('/page', page);
+    app.router.add_get('/media.bin', media);
+    return app;
+
+def test_streamed_bodies_are_recorded_within_the_caps_and_replayed(run, serve, setConfig, tmp_path):
+    bMedia = os.urandom(1024*1024);
+    sBase = serve(makeApp(bMedia));
+    sArchive = str(tmp_path / 'archive.bin');
+    setConfig(nSpillSize=64*1024, sSpillDir=str(tmp_path), nSegmentSize=0);
+    async def main():
+        asset.openArchive(sArchive, 'record');
+        try:
+            bPage = await asset.fetchBytes(sBase + '/page');
+            isNew, sPath = await asset.fetchStream(sBase + '/media.bin', sDir=str(tmp_path / 'files'), store=False);
+            await asset.responseArchive.join();
+        finally:
+            asset.closeArchive();
+        return bPage, sPath;
+    bPage, sPath = run(main());
+    assert b'page' in bPage;
+    with open(sPath, 'rb') as file:
+        assert file.read() == bMedia;
+    archive = ResponseArchive(sArchive, 'replay');
+    try:
+        mBodies = {mMeta['url'][len(sBase):]: bData for mMeta, bData in archive.items()};
+        assert mBodies['/page'] == bPage;
+        assert mBodies['/media.bin'] == bMedia;
+    finally:
+        archive.close();
+
+def test_bodies_read_in_part_are_not_recorded(run, serve, tmp_path):
+    sBase = serve(makeApp(b'x' * 1024*1024));
+    sArchive = str(tmp_path / 'archive.bin');
+    async def main():
+        archive = asset.openArchive(sArchive, 'record');
+        try:
+            res = await asset._send(asset.getDefaultSession(), sBase + '/media.bin');
+            await res.content.read(1024);
+            res.close();
+            await archive.join();
+            return archive.nRecords;
+        finally:
+            asset.closeArchive();
+    assert run(main()) == 0;
@@ -0,0 +1,52 @@
+import asyncio
+import mmap
+
+import lxml.html
+from aiohttp import web
+
+from easycrawler import asset
+from easycrawler.source import Source
+
+bPage = b'<html><head><title>big</title></head><body>' + b'<p>row</p>' * 50000 + b'<a href="next">next</a></body></html>';
+
+def makeApp(mHits):
+    async def handle(request):
+        mHits['n'] = mHits.get('n', 0) + 1;
+        await asyncio.sleep(0.01);
+        return web.Response(body=bPage, content_type='text/html');
+    app = web.Application();
+    app.router.add_get('/page', handle);
+    return app;
+
+def test_bodies_are_bytes_unless_spilling_is_asked_for(run, serve, setConfig):
+    sBase = serve(makeApp({}));
+    setConfig(nSpillSize=1024);
+    async def main():
+        return await asset.fetchBytes(sBase + '/page'), await asset.fetchBytes(sBase + '/page', nSpillSize=1024);
+    bData, spilled = run(main());
+    assert type(bData) is bytes and bData == bPage;
+    assert isinstance(spilled, mmap.mmap) and spilled[:] == bPage;
+
+def test_coalesced_waiters_get_mappings_of_their_own(run, serve):
+    mHits = {};
+    sBase = serve(makeApp(mHits));
+    async def main():
+        return await asyncio.gather(*(asset.fetchBytes(sBase + '/page', isCoalesce=True, nSpillSize=1024) for n in range(3)));
+    aBodies = run(main());
+    assert mHits['n'] == 1;
+    assert len(set(map(id, aBodies))) == 3;
+    aBodies[0].read(100);
+    assert aBodies[1].tell() == 0 and aBodies[1].read(6) == b'<html>';
+    aBodies[0].close();
+    assert aBodies[2][:] == bPage;
+
+def test_parse_of_a_mapping_takes_the_parser_and_base_url():
+    source = object.__new__(Source);
+    source.parser = lxml.html.HTMLParser(encoding='utf-8');
+    body = mmap.mmap(-1, len(bPage));
+    body.write(bPage);
+    parser = lxml.html.HTMLParser(encoding='utf-8', remove_blank_text=True);
+    root = source.parse(body, 'http://a.test/dir/', parser=parser);
+    assert root.xpath('string(//title)') == 'big';
+    root.make_links_absolute();
+    assert root.xpath('//a/@href') == ['http://a.test/dir/next'];
@@ -0,0 +1,70 @@
+import aiohttp
+import pytest
+from aiohttp import web
+
+from easycrawler import asset
+
+sUrl = 'http://breaker.test/x';
+
+def openCircuit(breaker):
+    for n in range(10):
+        breaker.record(sUrl, n % 2 == 0);
+
+def test_opens_at_threshold_and_fails_fast(setConfig):
+    setConfig(nBreakerMinRequests=10, nBreakerThreshold=0.5, nBreakerCooldown=30);
+    breaker = asset.CircuitBreaker();
+    for n in range(9):
+        breaker.record(sUrl, n % 2 == 0);
+    breaker.check(sUrl);
+    breaker.record(sUrl, False);
+    assert breaker.getHealth()['breaker.test']['state'] == 'open';
+    with pytest.raises(asset.CircuitOpenError):
+        breaker.check(sUrl);
+    with pytest.raises(asset.CircuitOpenError):
+        breaker.check(sUrl, isProbe=False);
+
+def test_half_open_lets_one_probe_through(setConfig):
+    setConfig(nBreakerMinRequests=10, nBreakerThreshold=0.5, nBreakerCooldown=0);
+    breaker = asset.CircuitBreaker();
+    openCircuit(breaker);
+    breaker.check(sUrl, isProbe=False); # a request only queueing for its turn is no probe
+    assert breaker.getHealth()['breaker.test']['state'] == 'open';
+    breaker.check(sUrl);
+    assert breaker.getHealth()['breaker.test']['state'] == 'half-open';
+    with pytest.raises(asset.CircuitOpenError):
+        breaker.check(sUrl);
+
+def test_probe_outcome_decides(setConfig):
+    setConfig(nBreakerMinRequests=10, nBreakerThreshold=0.5, nBreakerCooldown=0);
+    breaker = asset.CircuitBreaker();
+    openCircuit(breaker);
+    breaker.check(sUrl);
+    breaker.record(sUrl, False);
+    assert breaker.getHealth()['breaker.test']['state'] == 'open';
+    breaker.check(sUrl);
+    breaker.record(sUrl, True);
+    assert breaker.getHealth()['breaker.test']['state'] == 'closed';
+    breaker.check(sUrl);
+    breaker.record(sUrl, False); # the window starts over once closed
+    assert breaker.getHealth()['breaker.test']['state'] == 'closed';
+
+def test_a_body_broken_off_after_its_headers_is_one_failure(run, serve):
+    async def handle(request):
+        response = web.StreamResponse(headers={'Content-Length': '1000'});
+        await response.prepare(request);
+        await response.write(b'x' * 10);
+        if (request.path == '/broken'):
+            request.transport.close();
+        else:
+            await response.write(b'x' * 990);
+        return response;
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    sBase = serve(app);
+    breaker = asset.circuitBreaker;
+    breaker.mHost.clear();
+    run(asset.fetchBytes(sBase + '/whole', retry=asset.RetryPolicy(nCount=1)));
+    with pytest.raises(aiohttp.ClientPayloadError):
+        run(asset.fetchBytes(sBase + '/broken', retry=asset.RetryPolicy(nCount=1)));
+    health = breaker.getHealth()[sBase.split('/')[2]];
+    assert (health['requests'], health['errors']) == (2, 1);
@@ -0,0 +1,75 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from easycrawler import asset
+
+class FakeResponse():
+    def __init__(self, nLength):
+        self.headers = {'Content-Length': str(nLength)};
+
+@pytest.fixture
+def budget(monkeypatch, setConfig):
+    setConfig(nByteBudget=1000);
+    budget = asset.ByteBudget();
+    monkeypatch.setattr(asset, 'byteBudget', budget);
+    return budget;
+
+def test_reads_over_the_budget_wait_their_turn(run, budget):
+    async def main():
+        first = await budget.reserve('http://budget.test/a', FakeResponse(600));
+        aTasks = [asyncio.ensure_future(budget.reserve('http://budget.test/' + sPath, FakeResponse(nSize))) for sPath, nSize in (('b', 600), ('c', 100))];
+        await asyncio.sleep(0.01);
+        # the small one fits but queues behind the one that came first
+        aWaiting = [task.done() for task in aTasks], budget.getStats();
+        async with first:
+            pass
+        await asyncio.sleep(0);
+        return aWaiting, [task.done() for task in aTasks], budget.getStats();
+    aWaiting, aDone, mStats = run(main());
+    assert aWaiting == ([False, False], {'used': 600, 'total': 1000, 'waiting': 2});
+    assert aDone == [True, True];
+    assert mStats == {'used': 700, 'total': 1000, 'waiting': 0};
+
+def test_a_body_larger_than_the_budget_is_read_alone(run, budget):
+    async def main():
+        other = await budget.reserve('http://budget.test/a', FakeResponse(10));
+        task = asyncio.ensure_future(budget.reserve('http://budget.test/big', FakeResponse(5000)));
+        await asyncio.sleep(0.01);
+        isWaiting = not task.done();
+        async with other:
+            pass
+        async with await task as reservation:
+            reservation.update(5000);
+            mStats = budget.getStats();
+        return isWaiting, mStats;
+    isWaiting, mStats = run(main());
+    assert isWaiting;
+    assert mStats == {'used': 5000, 'total': 1000, 'waiting': 0};
+    assert budget.getStats()['used'] == 0;
+
+def test_reservations_are_released_on_errors(run, serve, budget):
+    async def handle(request):
+        # without a length the cap is only found out halfway through the body
+        response = web.StreamResponse(headers={} if request.path == '/large' else {'Content-Length': '4000'});
+        await response.prepare(request);
+        await response.write(b'x' * 2000);
+        if (request.path == '/broken'):
+            request.transport.close();
+        else:
+            await response.write(b'x' * 2000);
+        return response;
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    sBase = serve(app);
+    async def main():
+        bData = await asset.fetchBytes(sBase + '/whole', retry=asset.RetryPolicy(nCount=1));
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await asset.fetchBytes(sBase + '/broken', retry=asset.RetryPolicy(nCount=1));
+        with pytest.raises(asset.ResponseTooLargeError):
+            await asset.fetchBytes(sBase + '/large', retry=asset.RetryPolicy(nCount=1), nMaxSize=3000);
+        return len(bData);
+    assert run(main()) == 4000;
+    assert budget.getStats() == {'used': 0, 'total': 1000, 'waiting': 0};
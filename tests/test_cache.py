@@ -0,0 +1,77 @@
+import pytest
+from aiohttp import web
+
+from easycrawler import asset
+
+def makeApp(mHits):
+    async def handle(request):
+        sUser = request.cookies.get('user', '');
+        mHits[request.path] = mHits.get(request.path, 0) + 1;
+        sETag = '"{}-{}"'.format(request.path, sUser);
+        if (request.headers.get('If-None-Match') == sETag):
+            return web.Response(status=304, headers={'ETag': sETag});
+        sType = 'application/vnd.api+json' if request.path == '/vnd' else 'application/json';
+        return web.Response(body='{{"path": "{}", "user": "{}"}}'.format(request.path, sUser).encode(), content_type=sType, headers={'ETag': sETag});
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    return app;
+
+@pytest.fixture
+def cache(tmp_path):
+    return asset.HttpCache(str(tmp_path / 'http'));
+
+def test_revalidated_body_is_served_from_disk(run, serve, cache):
+    mHits = {};
+    sBase = serve(makeApp(mHits));
+    async def main():
+        session = asset.newSession();
+        try:
+            aResults = [];
+            for n in range(3):
+                aResults.append(await asset.fetchJson(sBase + '/page?t={}'.format(n), session=session, cache=cache));
+            return aResults;
+        finally:
+            await session.close();
+    aResults = run(main());
+    assert aResults == [{'path': '/page', 'user': ''}] * 3;
+    assert mHits == {'/page': 3};
+    assert cache.nHit == 2; # the cache busting parameter is no part of the key
+    assert len(cache.mIndex) == 1;
+
+def test_entries_vary_with_cookies(run, serve, cache):
+    mHits = {};
+    sBase = serve(makeApp(mHits));
+    async def fetch(sUser):
+        session = asset.newSession();
+        session.cookie_jar.update_cookies({'user': sUser});
+        try:
+            return await asset.fetchJson(sBase + '/me', session=session, cache=cache);
+        finally:
+            await session.close();
+    assert run(fetch('a'))['user'] == 'a';
+    assert run(fetch('b'))['user'] == 'b';
+    assert run(fetch('a'))['user'] == 'a';
+    assert cache.nHit == 1 and len(cache.mIndex) == 2;
+
+def test_json_subtypes_pass_the_type_check(run, serve):
+    sBase = serve(makeApp({}));
+    async def main():
+        session = asset.newSession();
+        try:
+            return await asset.fetchJson(sBase + '/vnd', session=session);
+        finally:
+            await session.close();
+    assert run(main())['path'] == '/vnd';
+
+def test_index_survives_a_new_instance(run, serve, cache):
+    sBase = serve(makeApp({}));
+    async def main(cache):
+        session = asset.newSession();
+        try:
+            return await asset.fetchBytes(sBase + '/bytes', session=session, cache=cache);
+        finally:
+            await session.close();
+    run(main(cache));
+    other = asset.HttpCache(cache.sDir);
+    assert run(main(other)) == b'{"path": "/bytes", "user": ""}';
+    assert other.nHit == 1;
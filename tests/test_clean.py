@@ -0,0 +1,71 @@
+import copy
+
+import lxml.html
+import lxml.etree
+from lxml.html.clean import Cleaner
+
+from easycrawler import asset
+from easycrawler.source import TiebaSource
+
+# SinglePassCleaner mirrors what lxml's Cleaner drops for the crawler's settings, _remove_javascript_link included;
+# every fragment here is cleaned by both and must come out the same
+aCorpus = [
+        '<div>plain <b>bold</b> and <i>italic</i> text<br>with a break</div>',
+        '<div><script>alert(1)</script><p onclick="x()" style="color: red" class="c" id="i">p</p><style>p {}</style></div>',
+        '<div><a href="javascript:alert(1)">js</a><a href=" JaVaScRiPt:void(0)">spaced</a><a href="/ok" target="_blank">ok</a>'
+        '<img src="jscript:x" alt="a"><img src="data:text/html;base64,PHNjcmlwdD4=" alt="d"></div>',
+        '<div><!-- a comment --><?php echo 1; ?>text<!--[if IE]><p>ie</p><![endif]--></div>',
+        '<div><form action="/f"><input name="q"><button>go</button><select><option>1</option></select><textarea>t</textarea></form></div>',
+        '<div><iframe src="https://example.com/"></iframe><embed src="x.swf"><object data="y"><param name="a" value="b">fallback</object>'
+        '<param name="loose"><applet code="A"><param name="p"></applet></div>',
+        '<div><blink>blink</blink><marquee>marquee</marquee><layer>layer</layer>tail</div>',
+        '<div><custom-tag>unknown <em>kept</em></custom-tag><foo bar="1">foo</foo> after</div>',
+        '<div><image src="a.png">pic</image><frame src="f"><frameset><frame src="g"></frameset><noframes>nf</noframes></div>',
+        '<div><link rel="stylesheet" href="s.css"><meta http-equiv="refresh" content="0;url=/"><base href="/b/"><title>t</title>'
+        '<p>body</p></div>',
+        '<div><table><tr><td colspan="2" style="x" onmouseover="y">cell</td></tr></table><ul><li>one<li>two</ul></div>',
+        '<div>text <span>in <a href="http://example.com/a?b=1&amp;c=2" title="t" rel="nofollow">link</a></span> tail &amp; more</div>',
+        '<div class="d_post_content j_d_post_content" id="post_content_1">  回复 <img class="BDE_Image" src="https://imgsrc.baidu.com/a.jpg" '
+        'size="1" changedsize="false" width="560" height="315"><br><embed class="BDE_Flash" src="v.swf"><br>  文字<script>var a = 1;</script></div>'
+];
+
+def clean(cleaner, sData):
+    ele = lxml.html.fragment_fromstring(sData, parser=asset.utf8Parser);
+    cleaner(ele);
+    return lxml.etree.tostring(ele, encoding='unicode');
+
+def test_single_pass_cleaner_matches_lxml():
+    former = Cleaner(style=True, forms=False);
+    latter = asset.SinglePassCleaner(style=True, forms=False);
+    for sData in aCorpus:
+        assert clean(latter, sData) == clean(former, sData), sData;
+
+def test_inner_html_of_an_owned_element_matches_a_copy():
+    for sData in aCorpus:
+        ele = lxml.html.fragment_fromstring(sData, parser=asset.utf8Parser);
+        assert asset.innerHtml(copy.deepcopy(ele), isOwned=True) == asset.innerHtml(ele);
+
+def test_comments_clean_only_trees_parsed_for_them(run):
+    sFloors = ''.join(
+            '<div class="l_post" data-field=\'{{"author": {{"user_name": "u{0}", "user_id": {0}}}, "content": {{"post_id": {0}, "post_no": {0}, "date": "2024-01-0{0} 12:00"}}}}\'>'
+            '<div id="post_content_{0}">floor {0}<script>x()</script><a href="javascript:y()" onclick="z()">a</a></div></div>'.format(n) for n in range(1, 4)
+    );
+    sPage = (
+            '<html><head><title>t</title></head><body><div class="wrap1"><script>'
+            'PageData.thread = {title: "t", reply_num: 3}; PageData.forum = {forum_id: 1, forum_name: "f"}; PageData.pager = {total_page: 1};'
+            '</script>' + sFloors + '</div></body></html>'
+    );
+    async def main():
+        source = TiebaSource(parsePool=False);
+        try:
+            ele = source.parse(sPage.encode());
+            sBefore = lxml.etree.tostring(ele);
+            aHanded = [comment.sContent for comment in source.parseComments(ele, '1', 1)];
+            isKept = lxml.etree.tostring(ele) == sBefore;
+            return aHanded, isKept, [comment.sContent for comment in source.parseComments(sPage.encode(), '1', 1)];
+        finally:
+            await source.cleanup();
+    aHanded, isKept, aParsed = run(main());
+    assert isKept;
+    assert aHanded == aParsed and len(aParsed) == 3;
+    assert 'script' not in aParsed[0] and 'javascript' not in aParsed[0] and 'floor 1' in aParsed[0];
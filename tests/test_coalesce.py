@@ -0,0 +1,52 @@
+import asyncio
+
+from easycrawler import asset
+
+def test_identical_requests_share_one_fetch(run):
+    coalescer = asset.Coalescer();
+    nFetch = 0;
+    async def fetch():
+        nonlocal nFetch;
+        nFetch += 1;
+        nThis = nFetch;
+        await asyncio.sleep(0.01);
+        return nThis;
+    async def main():
+        key = coalescer.makeKey('GET', 'http://a.test/', {'X': '1'}, None);
+        other = coalescer.makeKey('GET', 'http://a.test/', {'X': '2'}, None);
+        return await asyncio.gather(*([coalescer.run(key, fetch) for n in range(5)] + [coalescer.run(other, fetch)]));
+    aResults = run(main());
+    assert nFetch == 2;
+    assert len(set(aResults[:5])) == 1 and aResults[5] != aResults[0];
+    assert coalescer.getStats() == {'hit': 4, 'miss': 2, 'in flight': 0};
+
+def test_cancelled_waiter_leaves_the_fetch_to_the_others(run):
+    coalescer = asset.Coalescer();
+    async def fetch():
+        await asyncio.sleep(0.01);
+        return 'done';
+    async def main():
+        first = asyncio.ensure_future(coalescer.run('key', fetch));
+        second = asyncio.ensure_future(coalescer.run('key', fetch));
+        await asyncio.sleep(0);
+        first.cancel();
+        return await second;
+    assert run(main()) == 'done';
+
+def test_last_waiter_cancels_the_fetch(run):
+    coalescer = asset.Coalescer();
+    isCancelled = False;
+    async def fetch():
+        nonlocal isCancelled;
+        try:
+            await asyncio.sleep(1);
+        except asyncio.CancelledError:
+            isCancelled = True;
+            raise;
+    async def main():
+        waiter = asyncio.ensure_future(coalescer.run('key', fetch));
+        await asyncio.sleep(0.001);
+        waiter.cancel();
+        await asyncio.sleep(0.001);
+    run(main());
+    assert isCancelled and not coalescer.mFlight;
@@ -0,0 +1,50 @@
+from easycrawler import codec, bench
+
+sScript = (
+        'var PageData = PageData || {}; PageData.tbs = "0f";\n'
+        'PageData.thread = { author: "用户", thread_id: 5000000001, title: "a \\"quoted\\" \\u6807\\u9898", reply_num: 42, '
+        'onShare: function(a, b){ return {title: "not this", reply_num: 0}; }, topic: {is_lpost: 0, title: "nor this"}, };\n'
+        "PageData.forum = { 'id': 52, 'forum_id': 52, 'true_forum_id': 52, 'name': \"吧\", 'forum_name': \"吧\", 'first_class': 'a, \\'forum_name\\': 1' };\n"
+        "PageData.pager = { 'cur_page': 1, 'total_page': 7, 'total_num': 130 };\n"
+        'PageData.user = { is_login: 0, name: "", total_page: 99 };'
+);
+
+def test_scan_object_takes_functions_trailing_commas_and_escapes():
+    mData = codec.loadsObject(sScript, 'PageData.thread');
+    assert mData['onShare'] is None;
+    assert mData['title'] == 'a "quoted" 标题';
+    assert mData['reply_num'] == 42 and mData['topic'] == {'is_lpost': 0, 'title': 'nor this'};
+    sData = '[1, -2.5e1, true, null, undefined, "\\ud83d\\ude00", \'\\x41\', a + b, [], {},];';
+    assert codec.scanObject(sData) == ([1, -25.0, True, None, None, '😀', 'A', 'a + b', [], {}], len(sData) - 1);
+
+def test_raw_scalars_stay_as_written():
+    mData = codec.loadsObject(sScript, 'PageData.thread', isRaw=True);
+    assert mData['title'] == 'a \\"quoted\\" \\u6807\\u9898';
+    assert mData['reply_num'] == '42';
+    assert mData['onShare'].startswith('function(a, b){');
+
+def test_fields_are_read_at_the_top_level_only():
+    mData = codec.loadsFields(sScript, 'PageData.thread', ('title', 'reply_num'), isRaw=True);
+    assert mData == {'title': 'a \\"quoted\\" \\u6807\\u9898', 'reply_num': '42'};
+    mData = codec.loadsFields(sScript, 'PageData.forum', ('true_forum_id', 'forum_id', 'forum_name', 'avatar'));
+    assert mData == {'forum_id': 52, 'true_forum_id': 52, 'forum_name': '吧'};
+    assert codec.loadsFields(sScript, 'PageData.pager', ('total_page', 'name')) == {'total_page': 7};
+    assert codec.loadsFields(sScript, 'PageData.none', ('id',)) is None;
+
+def test_fields_fall_back_to_scanning_all_of_a_literal():
+    # nesting deeper than the regex reaches
+    sData = 'P = {a: [[[[[[[[[[1]]]]]]]]]], b: {c: 1}, title: "x"};';
+    assert codec.loadsFields(sData, 'P', ('title', 'b')) == {'b': {'c': 1}, 'title': 'x'};
+
+def test_json_goes_to_the_codec_in_str_and_bytes():
+    bData = b'<script>var $render_data = [{"status": {"id": "1", "text": "\\u4e2d"}}][0] || {};</script>';
+    assert codec.loadsObject(bData, b'var $render_data') == [{'status': {'id': '1', 'text': '中'}}];
+    assert codec.loadsObject(bData.decode(), 'var $render_data') == [{'status': {'id': '1', 'text': '中'}}];
+    assert codec.loadsObject(b'var x = {a: 1};', b'var x') == {'a': 1};
+
+def test_fields_agree_with_the_former_regexes():
+    aWeibo, aTieba = bench.makePages(5);
+    for sData in aTieba:
+        assert bench.loadsTieba(sData) == bench.extractTieba(sData);
+    for bData in aWeibo:
+        assert codec.loadsObject(bData, b'var $render_data') == bench.extractWeibo(bData);
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import re
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from easycrawler import asset, codec
+
+nSegment = 64*1024;
+bFile = os.urandom(4 * nSegment);
+
+def makeApp(mServer):
+    # serves bFile by ranges; mServer['gate'], if set, holds back the last segment, mServer['abort'] breaks it off halfway
+    async def handle(request):
+        mServer['ranges'].append(request.headers.get('Range'));
+        mHeaders = {'ETag': mServer.get('etag', '"v1"'), 'Accept-Ranges': 'bytes', 'Content-Type': 'application/octet-stream'};
+        if (mServer.get('modified')):
+            mHeaders['Last-Modified'] = mServer['modified'];
+        if (mServer.get('refuse') and 'Range' in request.headers):
+            return web.Response(status=416, headers=mHeaders);
+        sRange = request.headers.get('Range', '');
+        sValidator = request.headers.get('If-Range');
+        if (sValidator and (sValidator.startswith('W/') or sValidator not in (mHeaders['ETag'], mHeaders.get('Last-Modified')))):
+            # If-Range compares strongly, a weak ETag never matches and the whole file is sent
+            sRange = '';
+        match = re.match(r'bytes=(\d+)-(\d*)', sRange);
+        nStart, nEnd = (int(match.group(1)), int(match.group(2) or len(bFile) - 1) + 1) if match else (0, len(bFile));
+        if (nStart >= 3 * nSegment and mServer.get('gate')):
+            await mServer['gate'].wait();
+        if (match):
+            mHeaders['Content-Range'] = 'bytes {}-{}/{}'.format(nStart, nEnd - 1, len(bFile));
+        mHeaders['Content-Length'] = str(nEnd - nStart);
+        response = web.StreamResponse(status=206 if match else 200, headers=mHeaders);
+        await response.prepare(request);
+        if (nStart >= 3 * nSegment and mServer.get('abort')):
+            await response.write(bFile[nStart:nStart + nSegment // 2]);
+            request.transport.close();
+            return response;
+        await response.write(bFile[nStart:nEnd]);
+        return response;
+    app = web.Application();
+    app.router.add_get('/file.bin', handle);
+    return app;
+
+def test_completed_segments_are_saved_and_resumed(run, serve, setConfig, tmp_path):
+    mServer = {'ranges': [], 'gate': asyncio.Event(), 'abort': True};
+    sUrl = serve(makeApp(mServer)) + '/file.bin';
+    setConfig(nSegmentSize=nSegment, nSegments=4);
+    sDir = str(tmp_path);
+    sState = os.path.join(sDir, 'file.bin.part.json');
+    lock = asset.PerHostLock(nPerHostLimit=4);
+    async def first():
+        task = asyncio.ensure_future(asset.fetchStream(sUrl, sDir=sDir, store=False, lock=lock, retry=asset.RetryPolicy(nCount=1)));
+        for n in range(200):
+            await asyncio.sleep(0.01);
+            if (os.path.exists(sState)):
+                with open(sState, 'rb') as file:
+                    aSegments = codec.loads(file.read())['segments'];
+                if (sum(aSegment[2] == aSegment[1] - aSegment[0] for aSegment in aSegments) == 3):
+                    break;
+        else:
+            raise AssertionError('completed segments were not saved while the download ran');
+        mServer['gate'].set();
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await task;
+    run(first());
+    mServer['ranges'].clear();
+    mServer['gate'] = None;
+    mServer['abort'] = False;
+    isNew, sPath = run(asset.fetchStream(sUrl, sDir=sDir, store=False, lock=lock));
+    assert mServer['ranges'] == ['bytes={}-{}'.format(3 * nSegment + nSegment // 2, len(bFile) - 1)];
+    with open(sPath, 'rb') as file:
+        assert file.read() == bFile;
+    assert not os.path.exists(sState);
+
+def test_refused_ranges_reset_the_download_without_blaming_the_host(run, serve, tmp_path):
+    mServer = {'ranges': [], 'refuse': True};
+    sUrl = serve(makeApp(mServer)) + '/file.bin';
+    download = asset.PartialDownload(sUrl, str(tmp_path / 'file.bin'));
+    download.nSize = len(bFile);
+    download.sValidator = '"v1"';
+    download.aSegments = [[0, len(bFile), 1000]];
+    download.open();
+    breaker = asset.circuitBreaker;
+    breaker.mHost.clear();
+    async def main():
+        session = asset.newSession();
+        try:
+            await asset.RetryPolicy(nCount=1).run(sUrl, lambda: download.fetchSegment(session, {}, download.aSegments[0]));
+        finally:
+            download.close();
+            await session.close();
+    with pytest.raises(asset.ResumeError):
+        run(main());
+    assert download.aSegments == [] and not os.path.exists(download.sPart);
+    health = breaker.getHealth()[sUrl.split('/')[2]];
+    assert health['errors'] == 0;
+
+@pytest.mark.parametrize('sModified', [None, 'Wed, 01 Jan 2025 00:00:00 GMT'])
+def test_weak_etags_are_not_sent_as_if_range(run, serve, setConfig, tmp_path, sModified):
+    mServer = {'ranges': [], 'etag': 'W/"v1"', 'modified': sModified};
+    sUrl = serve(makeApp(mServer)) + '/file.bin';
+    setConfig(nSegmentSize=nSegment, nSegments=4);
+    isNew, sPath = run(asset.fetchStream(sUrl, sDir=str(tmp_path), store=False, lock=asset.PerHostLock(nPerHostLimit=4), retry=asset.RetryPolicy(nCount=1)));
+    with open(sPath, 'rb') as file:
+        assert file.read() == bFile;
+    if (sModified):
+        # Last-Modified validates the segments instead
+        assert len(mServer['ranges']) == 4;
+    else:
+        assert mServer['ranges'] == [None];
@@ -0,0 +1,56 @@
+import pickle
+
+import pytest
+from aiohttp import web
+
+from easycrawler import asset, worker
+from easycrawler.source import Source
+
+sText = '百度贴吧是以兴趣主题聚合志同道合者的互动平台，同好网友聚集在这里交流话题、展示自我、结交朋友。今天我们来讨论一下这个帖子的标题和内容，欢迎大家回复。' * 20;
+
+def makePage(sEncoding, sMeta='', nPadding=0):
+    return ('<html><head>' + sMeta + '<title>t</title></head><body>' + '<p>ascii</p>' * nPadding + '<p>' + sText + '</p></body></html>').encode(sEncoding);
+
+@pytest.fixture
+def detector(monkeypatch):
+    detector = asset.EncodingDetector();
+    monkeypatch.setattr(asset, 'encodingDetector', detector);
+    return detector;
+
+def test_a_long_ascii_head_leaves_the_page_to_utf8_and_the_endpoint_undecided(detector):
+    pytest.importorskip('chardet');
+    bData = makePage('utf-8', nPadding=8000); # the sample is ASCII only
+    assert len(bData) > 88*1024;
+    assert sText in asset.html2Unicode(bData, sUrl='http://tieba.example/p/1');
+    assert detector.mCache == {};
+    bData = makePage('gb18030');
+    assert sText in asset.html2Unicode(bData, sUrl='http://tieba.example/p/2');
+    assert detector.mCache == {'tieba.example/p/#': 'gb18030'};
+
+def test_tiers_in_order(detector):
+    bData = makePage('gb18030', '<meta charset="gbk">');
+    assert detector.detect(bData, 'GBK') == ('gb18030', 'transport');
+    assert detector.detect(b'\xef\xbb\xbf' + bData) == ('utf-8', 'bom');
+    assert detector.detect(bData, sUrl='http://a.example/f/1') == ('gb18030', 'meta');
+    assert detector.detect(makePage('gb18030'), sUrl='http://a.example/f/2') == ('gb18030', 'cache');
+    assert detector.detect(bData, 'us-ascii') == ('utf-8', 'transport');
+
+def test_sources_decode_with_the_charset_of_the_transport(run, serve, detector):
+    async def handle(request):
+        return web.Response(body=makePage('gb18030'), headers={'Content-Type': 'text/html; charset=gbk'});
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    sBase = serve(app);
+    async def main(nSpillSize, isPickled):
+        source = Source(parsePool=False, nSpillSize=nSpillSize);
+        try:
+            data = await source.queryBytes(sBase + '/p/1');
+            if (isPickled):
+                # as a process pool hands it to a worker
+                data = pickle.loads(pickle.dumps(worker.toBytes(data)));
+            return data.sUrl, source.parse(data).xpath('string(//body)');
+        finally:
+            await source.cleanup();
+    for nSpillSize, isPickled in ((None, False), (1024, False), (1024, True)):
+        assert run(main(nSpillSize, isPickled)) == (sBase + '/p/1', sText);
+    assert detector.mTier == {'transport': 3};
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from easycrawler import asset
+
+sUrl = 'http://hedge.test/page';
+
+@pytest.fixture
+def hedger(setConfig):
+    setConfig(nHedgeMinSamples=5, nHedgeQuantile=50, nHedgeRatio=1);
+    hedger = asset.Hedger();
+    hedger._getHost(sUrl)[0].extend([0.05] * 5);
+    return hedger;
+
+def makeFetch(aDelays):
+    # the n-th call answers after aDelays[n]; mCalls tells what became of each call
+    mCalls = {};
+    async def fetch(nCall):
+        mCalls[nCall] = 'running';
+        try:
+            await asyncio.sleep(aDelays[nCall]);
+        except asyncio.CancelledError:
+            mCalls[nCall] = 'cancelled';
+            raise;
+        mCalls[nCall] = 'done';
+        return 'response {}'.format(nCall);
+    return lambda: fetch(len(mCalls)), mCalls;
+
+def test_a_slow_request_is_hedged_and_loses(run, hedger):
+    fetch, mCalls = makeFetch([5, 0.01]);
+    nStart = asset.time.time();
+    assert run(hedger.run(sUrl, fetch)) == 'response 1';
+    assert asset.time.time() - nStart < 1;
+    run(asyncio.sleep(0));
+    assert mCalls == {0: 'cancelled', 1: 'done'};
+    assert hedger.getStats() == {'requests': 1, 'hedged': 1, 'won by hedge': 1};
+
+def test_no_hedge_before_the_delay(run, hedger):
+    fetch, mCalls = makeFetch([0.001, 0.001]);
+    assert run(hedger.run(sUrl, fetch)) == 'response 0';
+    assert mCalls == {0: 'done'};
+    assert hedger.getStats() == {'requests': 1, 'hedged': 0, 'won by hedge': 0};
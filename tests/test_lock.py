@@ -0,0 +1,82 @@
+import asyncio
+
+from easycrawler import asset
+
+def test_fifo_per_host(run):
+    lock = asset.PerHostLock(nTotalLimit=10, nPerHostLimit=1);
+    aOrder = [];
+    async def hold(n):
+        await lock.acquire('http://a.test/{}'.format(n));
+        aOrder.append(n);
+        await asyncio.sleep(0);
+        lock.release('http://a.test/{}'.format(n));
+    async def main():
+        await asyncio.gather(*(hold(n) for n in range(20)));
+    run(main());
+    assert aOrder == list(range(20));
+    assert lock.nFree == 10 and lock.mHost['a.test'] == 1;
+
+def test_release_hands_off_to_one_waiter(run):
+    lock = asset.PerHostLock(nTotalLimit=1, nPerHostLimit=1);
+    async def main():
+        await lock.acquire('http://a.test/');
+        aTasks = [asyncio.ensure_future(lock.acquire('http://a.test/')) for n in range(3)];
+        await asyncio.sleep(0);
+        assert not any(task.done() for task in aTasks);
+        lock.release('http://a.test/');
+        await asyncio.sleep(0);
+        assert [task.done() for task in aTasks] == [True, False, False];
+        for n in range(3):
+            lock.release('http://a.test/');
+            await asyncio.sleep(0);
+        assert all(task.done() for task in aTasks);
+    run(main());
+    assert lock.nFree == 1 and lock.mHost['a.test'] == 1;
+
+def test_global_limit_across_hosts(run):
+    lock = asset.PerHostLock(nTotalLimit=2, nPerHostLimit=2);
+    nActive = 0;
+    nPeak = 0;
+    async def hold(sUrl):
+        nonlocal nActive, nPeak;
+        await lock.acquire(sUrl);
+        nActive += 1;
+        nPeak = max(nPeak, nActive);
+        await asyncio.sleep(0.001);
+        nActive -= 1;
+        lock.release(sUrl);
+    async def main():
+        await asyncio.gather(*(hold('http://{}.test/'.format(n % 5)) for n in range(50)));
+    run(main());
+    assert nPeak == 2;
+    assert lock.nFree == 2;
+
+def test_cancelled_waiter_passes_its_slot_on(run):
+    lock = asset.PerHostLock(nTotalLimit=1, nPerHostLimit=1);
+    async def main():
+        await lock.acquire('http://a.test/');
+        first = asyncio.ensure_future(lock.acquire('http://a.test/'));
+        second = asyncio.ensure_future(lock.acquire('http://a.test/'));
+        await asyncio.sleep(0);
+        first.cancel();
+        await asyncio.sleep(0);
+        lock.release('http://a.test/');
+        await asyncio.wait_for(second, 1);
+        lock.release('http://a.test/');
+    run(main());
+    assert lock.nFree == 1 and lock.mHost['a.test'] == 1 and not lock.mHostQueue;
+
+def test_try_acquire_respects_waiters(run):
+    lock = asset.PerHostLock(nTotalLimit=2, nPerHostLimit=1);
+    async def main():
+        await lock.acquire('http://a.test/');
+        waiter = asyncio.ensure_future(lock.acquire('http://a.test/'));
+        await asyncio.sleep(0);
+        assert not lock.tryAcquire('http://a.test/');
+        assert lock.tryAcquire('http://b.test/');
+        lock.release('http://b.test/');
+        lock.release('http://a.test/');
+        await waiter;
+        lock.release('http://a.test/');
+    run(main());
+    assert lock.nFree == 2;
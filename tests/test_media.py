@@ -0,0 +1,53 @@
+import asyncio
+import os
+
+from aiohttp import web
+
+from easycrawler import asset
+from easycrawler.media import MediaPipeline
+from easycrawler.records import Media
+
+def test_failed_downloads_are_not_shared(run):
+    pipeline = object.__new__(MediaPipeline);
+    async def main():
+        failed = asyncio.get_event_loop().create_future();
+        failed.set_exception(asset.DeadArrangerError('arranger died'));
+        done = asyncio.get_event_loop().create_future();
+        done.set_result(Media(sId='1', sPreview='http://a.test/1.jpg'));
+        done.result().sPath = '/store/1.jpg';
+        return failed, done;
+    failed, done = run(main());
+    media = Media(sId='1');
+    pipeline._copy(failed, media);
+    assert media.sPath is None;
+    pipeline._copy(done, media);
+    assert media.sPath == '/store/1.jpg';
+
+def makeApp():
+    async def handle(request):
+        if (request.path.startswith('/slow')):
+            await asyncio.sleep(1);
+        return web.Response(body=b'\x89PNG' + request.path.encode() * 100, content_type='image/png');
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    return app;
+
+def test_join_waits_for_downloads_and_cleanup_stops_pending_ones(run, serve, tmp_path):
+    sBase = serve(makeApp());
+    async def main():
+        pipeline = MediaPipeline(sDir=str(tmp_path));
+        try:
+            aMedia = [Media(sId='1', sUrl=sBase + '/1.png'), Media(sId='1', sUrl=sBase + '/1.png'), Media(sId='2', sUrl=sBase + '/2.png')];
+            for media in aMedia:
+                pipeline.add(media);
+            await pipeline.join(5);
+            aPaths = [media.sPath for media in aMedia];
+            pipeline.add(Media(sId='3', sUrl=sBase + '/slow.png'));
+            await asyncio.sleep(0.1);
+            return aPaths, pipeline.getStats();
+        finally:
+            await pipeline.cleanup();
+    aPaths, mStats = run(main());
+    assert aPaths[0] == aPaths[1] != aPaths[2];
+    assert all(os.path.getsize(sPath) == 4 + 6 * 100 for sPath in aPaths);
+    assert mStats['done'] == 2 and mStats['pending'] == 1;
@@ -0,0 +1,58 @@
+from aiohttp import web
+
+from easycrawler import asset
+
+def makeProxy(sName, aSeen, isBroken=False):
+    # a stub proxy answering every request itself; a broken one drops the connection
+    async def handle(request):
+        if (isBroken):
+            request.transport.close();
+            return web.Response();
+        aSeen.append((sName, request.url.host));
+        return web.Response(text=sName);
+    app = web.Application();
+    app.router.add_route('*', '/{path:.*}', handle);
+    return app;
+
+def fetchAll(run, aUrls):
+    async def main():
+        session = asset.newSession();
+        try:
+            aResults = [];
+            for sUrl in aUrls:
+                try:
+                    aResults.append((await asset.fetchBytes(sUrl, session=session, retry=asset.RetryPolicy(nCount=1))).decode());
+                except Exception as e:
+                    aResults.append(e);
+            return aResults;
+        finally:
+            await session.close();
+    return run(main());
+
+def test_sticky_hosts_keep_their_proxy(run, serve, setConfig, monkeypatch):
+    aSeen = [];
+    aProxies = [serve(makeProxy('a', aSeen)), serve(makeProxy('b', aSeen))];
+    setConfig(aStickyHosts=('sticky.test',));
+    pool = asset.ProxyPool(aProxies);
+    monkeypatch.setattr(asset, 'proxyPool', pool);
+    aResults = fetchAll(run, ['http://sticky.test/{}'.format(n) for n in range(8)]);
+    assert len(set(aResults)) == 1;
+    assert pool.mSticky['sticky.test'] == aProxies['ab'.index(aResults[0])];
+    assert all(sHost == 'sticky.test' for sName, sHost in aSeen);
+
+def test_failing_proxy_is_ejected_and_the_host_is_not_slowed_down(run, serve, setConfig, monkeypatch):
+    aSeen = [];
+    sGood, sBroken = serve(makeProxy('good', aSeen)), serve(makeProxy('broken', aSeen, isBroken=True));
+    setConfig(nProxyMinRequests=1, nProxyThreshold=0.5, nProxyCooldown=60, mRateLimit={'eject.test': (1, 1000)});
+    pool = asset.ProxyPool([sGood, sBroken]);
+    pool.mProxy[sGood].nLatency = 10; # a stale estimate makes the broken proxy look better at first
+    monkeypatch.setattr(asset, 'proxyPool', pool);
+    aResults = fetchAll(run, ['http://eject.test/{}'.format(n) for n in range(5)]);
+    assert isinstance(aResults[0], Exception);
+    assert aResults[1:] == ['good'] * 4;
+    mStats = pool.getStats();
+    assert not mStats[sBroken]['up'] and mStats[sBroken]['errors'] == 1;
+    assert mStats[sGood]['up'] and mStats[sGood]['requests'] == 4;
+    # only the bucket of the host via the broken proxy was slowed down
+    assert asset.rateLimiter.getBucket('http://eject.test/', sBroken).nRate < 500;
+    assert asset.rateLimiter.getBucket('http://eject.test/').nRate == 500;
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from easycrawler import asset
+
+class FakeLoop():
+    # the clock of the buckets, moved on by the sleeps they ask for
+    def __init__(self):
+        self.nNow = 1000.0;
+        self.aSleeps = [];
+    def time(self):
+        return self.nNow;
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeLoop();
+    async def sleep(nDelay):
+        clock.aSleeps.append(round(nDelay, 6));
+        clock.nNow += nDelay;
+    monkeypatch.setattr(asset.asyncio, 'sleep', sleep);
+    return clock;
+
+def test_tokens_refill_at_the_rate_and_burst_one_at_most(run, clock):
+    bucket = asset.TokenBucket(2, 2, loop=clock);
+    async def take(nCount):
+        for n in range(nCount):
+            await bucket.take();
+    run(take(3));
+    assert clock.aSleeps == [0.5, 0.5];
+    clock.aSleeps.clear();
+    clock.nNow += 0.25;
+    assert bucket.getWait() == pytest.approx(0.25);
+    clock.nNow += 60; # a long idle time still leaves a single token
+    run(take(3));
+    assert clock.aSleeps == [0.5, 0.5];
+
+def test_rates_adapt_per_host_and_per_proxy(run, clock, setConfig):
+    setConfig(mRateLimit={'slow.test': (1, 1)}, aDefaultRateLimit=(2, 8));
+    limiter = asset.RateLimiter(loop=clock);
+    async def acquire(*aUrls):
+        for sUrl in aUrls:
+            await limiter.acquire(sUrl);
+    run(acquire('http://slow.test/1', 'http://fast.test/1', 'http://slow.test/2'));
+    assert clock.aSleeps == [1.0];
+    assert limiter.getBucket('http://slow.test/').nRate == 1;
+    assert limiter.getBucket('http://fast.test/').nRate == 4;
+    clock.nNow += 10;
+    limiter.feedback('http://fast.test/', 429);
+    assert limiter.getBucket('http://fast.test/').nRate == 2;
+    assert limiter.getBucket('http://fast.test/', 'http://proxy.test:8080').nRate == 4;
+    assert limiter.getBucket('http://other.test/').nRate == 4;
+    limiter.feedback('http://fast.test/', 503); # within the interval of the former decrease
+    assert limiter.getBucket('http://fast.test/').nRate == 2;
@@ -0,0 +1,69 @@
+from aiohttp import web
+
+from easycrawler import asset, source
+
+def makeApp(nHeadStatus, mHits):
+    async def handle(request):
+        mHits[request.method] = mHits.get(request.method, 0) + 1;
+        if (request.method == 'HEAD' and nHeadStatus != 200):
+            return web.Response(status=nHeadStatus);
+        return web.Response(text='page');
+    app = web.Application();
+    app.router.add_route('*', '/{path:.*}', handle);
+    return app;
+
+def resolve(run, sUrl):
+    async def main():
+        src = source.Source(parsePool=False);
+        try:
+            return await src.resolve(sUrl);
+        finally:
+            await src.cleanup();
+    return run(main());
+
+def getHost(sBase):
+    return sBase.split('//')[1];
+
+def test_head_is_used_when_it_works(run, serve):
+    mHits = {};
+    sBase = serve(makeApp(200, mHits));
+    assert resolve(run, sBase + '/ok') == sBase + '/ok';
+    assert mHits == {'HEAD': 1};
+
+def test_transient_head_failure_is_retried_once_and_forgotten(run, serve, setConfig):
+    setConfig(nBreakerMinRequests=100);
+    mHits = {};
+    sBase = serve(makeApp(503, mHits));
+    assert resolve(run, sBase + '/busy') == sBase + '/busy';
+    assert mHits == {'HEAD': 2, 'GET': 1};
+    assert getHost(sBase) not in source.noHeadHostSet;
+
+def test_head_not_allowed_is_remembered(run, serve):
+    mHits = {};
+    sBase = serve(makeApp(405, mHits));
+    resolve(run, sBase + '/a');
+    resolve(run, sBase + '/b');
+    assert mHits == {'HEAD': 1, 'GET': 2};
+    assert getHost(sBase) in source.noHeadHostSet;
+
+def test_head_refused_while_get_works_is_remembered(run, serve):
+    mHits = {};
+    sBase = serve(makeApp(403, mHits));
+    resolve(run, sBase + '/a');
+    assert getHost(sBase) in source.noHeadHostSet;
+
+def test_urls_resolved_with_get_are_replayed(run, serve, tmp_path):
+    mHits = {};
+    sBase = serve(makeApp(405, mHits));
+    sArchive = str(tmp_path / 'archive.bin');
+    for sMode in ('record', 'replay'):
+        asset.openArchive(sArchive, sMode);
+        try:
+            # the first GET follows the refused HEAD, the second is sent at once for a host in noHeadHostSet
+            for sPath in ('/a', '/b'):
+                source.resolveCache.discard(sBase + sPath);
+                assert resolve(run, sBase + sPath) == sBase + sPath;
+            run(asset.responseArchive.join());
+        finally:
+            asset.closeArchive();
+    assert mHits == {'HEAD': 1, 'GET': 2};
@@ -0,0 +1,88 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from yarl import URL
+
+from easycrawler import asset
+
+def makeError(nStatus, mHeaders=None):
+    info = aiohttp.RequestInfo(URL('http://retry.test/'), 'GET', {}, URL('http://retry.test/'));
+    return aiohttp.ClientResponseError(info, (), status=nStatus, headers=mHeaders or {});
+
+def test_retries_until_success(run):
+    retry = asset.RetryPolicy(nCount=5, nBase=0.001);
+    aCalls = [];
+    async def attempt():
+        aCalls.append(1);
+        if (len(aCalls) < 3):
+            raise makeError(503);
+        return 'ok';
+    assert run(retry.run('http://retry-ok.test/', attempt)) == 'ok';
+    assert len(aCalls) == 3;
+
+def test_client_errors_are_not_retried(run):
+    retry = asset.RetryPolicy(nCount=5, nBase=0.001);
+    aCalls = [];
+    async def attempt():
+        aCalls.append(1);
+        raise makeError(404);
+    with pytest.raises(aiohttp.ClientResponseError):
+        run(retry.run('http://retry-404.test/', attempt));
+    assert len(aCalls) == 1;
+
+def test_gives_up_after_count(run):
+    retry = asset.RetryPolicy(nCount=3, nBase=0.001, nBudgetMin=100);
+    aCalls = [];
+    async def attempt():
+        aCalls.append(1);
+        raise asyncio.TimeoutError();
+    with pytest.raises(asyncio.TimeoutError):
+        run(retry.run('http://retry-count.test/', attempt));
+    assert len(aCalls) == 3;
+
+def test_budget_caps_retries_of_a_host(run):
+    # at most nBudgetMin + nBudgetRatio * requests retries per window, however many requests fail
+    retry = asset.RetryPolicy(nCount=10, nBase=0.001, nBudgetRatio=0.1, nBudgetMin=2, nBudgetWindow=60);
+    nCalls = 0;
+    async def attempt():
+        nonlocal nCalls;
+        nCalls += 1;
+        raise makeError(500);
+    async def main():
+        for n in range(10):
+            with pytest.raises(aiohttp.ClientResponseError):
+                await retry.run('http://retry-budget.test/{}'.format(n), attempt);
+    run(main());
+    nStarted, nRetries = retry.mBudget['retry-budget.test'][1:];
+    assert nRetries < 2 + 0.1 * nStarted + 1;
+    assert nCalls == nStarted < 20;
+
+def test_retry_after_is_honoured():
+    retry = asset.RetryPolicy(nBase=0.001, nMaxRetryAfter=300);
+    assert retry.getDelay(1, makeError(429, {'Retry-After': '7'})) == 7;
+    assert retry.getDelay(1, makeError(429, {'Retry-After': '1000'})) == 300;
+    assert retry.getDelay(1, makeError(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) < 1;
+    assert retry.classify(makeError(429)) == 'throttle';
+    assert retry.classify(makeError(502)) == 'server';
+
+def test_a_response_closed_between_attempts_is_not_retried(run, serve):
+    mHits = {};
+    async def handle(request):
+        mHits['GET'] = mHits.get('GET', 0) + 1;
+        return web.Response(status=503);
+    app = web.Application();
+    app.router.add_get('/', handle);
+    sUrl = serve(app) + '/';
+    async def main():
+        response = asset.Response(sUrl, retry=asset.RetryPolicy(nCount=5, nBase=0.2, nBudgetMin=100));
+        task = asyncio.ensure_future(response._get());
+        while not mHits:
+            await asyncio.sleep(0.01);
+        response.close();
+        with pytest.raises(asset.ResponseClosedError) as info:
+            await task;
+        return asset.defaultRetry.classify(info.value);
+    assert run(main()) not in asset.RetryPolicy.aDefaultRetryOn;
+    assert mHits == {'GET': 1};
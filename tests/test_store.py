@@ -0,0 +1,65 @@
+import asyncio
+import os
+
+from aiohttp import web
+
+from easycrawler import asset
+from easycrawler.store import MediaStore
+
+bImage = bytes(range(256)) * 4096;
+
+def writeFile(sPath, bData):
+    with open(sPath, 'wb') as file:
+        file.write(bData);
+    return sPath;
+
+def test_put_links_urls_and_names_to_one_blob(run, tmp_path):
+    store = MediaStore(str(tmp_path / 'store'));
+    async def main():
+        sFirst = await store.put(writeFile(str(tmp_path / 'a'), bImage), 'http://a.test/1.jpg', 'post/1.jpg');
+        sSecond = await store.put(writeFile(str(tmp_path / 'b'), bImage), 'http://b.test/2.jpg', 'post/2.jpg');
+        sOther = await store.put(writeFile(str(tmp_path / 'c'), b'other'), 'http://a.test/3.png', 'post/3.png');
+        return sFirst, sSecond, sOther, [await store.lookup(*aKey) for aKey in (('http://b.test/2.jpg',), (None, 'post/1.jpg'), ('http://none.test/',))];
+    try:
+        sFirst, sSecond, sOther, aFound = run(main());
+    finally:
+        store.close();
+    assert sFirst == sSecond != sOther;
+    assert sFirst.endswith('.jpg') and sOther.endswith('.png');
+    assert aFound == [sFirst, sFirst, None];
+    with open(sFirst, 'rb') as file:
+        assert file.read() == bImage;
+    assert not os.path.exists(str(tmp_path / 'b'));
+    assert (store.nStored, store.nDeduped) == (2, 1);
+
+def test_concurrent_downloads_of_one_url_keep_apart(run, serve, tmp_path):
+    async def handle(request):
+        res = web.StreamResponse(headers={'Content-Type': 'image/jpeg', 'Content-Length': str(len(bImage))});
+        await res.prepare(request);
+        for nStart in range(0, len(bImage), 64*1024):
+            await res.write(bImage[nStart:nStart+64*1024]);
+            await asyncio.sleep(0.005);
+        return res;
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    sBase = serve(app);
+    store = MediaStore(str(tmp_path / 'store'));
+    async def main():
+        aPaths = [store.claimTmpPath(sBase + '/1.jpg') for n in range(2)];
+        for sPath in aPaths:
+            store.releaseTmpPath(sPath);
+        aResults = await asyncio.gather(*(
+                asset.fetchStream(sBase + '/1.jpg', sFile='{}.jpg'.format(n), store=store, retry=asset.RetryPolicy(nCount=1)) for n in range(3)
+        ));
+        return aPaths, aResults;
+    try:
+        aPaths, aResults = run(main());
+    finally:
+        store.close();
+    assert aPaths[0] != aPaths[1];
+    assert [isNew for isNew, sPath in aResults] == [True, True, True];
+    assert len(set(sPath for isNew, sPath in aResults)) == 1;
+    with open(aResults[0][1], 'rb') as file:
+        assert file.read() == bImage;
+    assert os.listdir(store.sTmpDir) == [] and store.tmpPathSet == set();
+    assert (store.nStored, store.nDeduped) == (1, 2);
@@ -0,0 +1,33 @@
+import ssl
+
+import pytest
+from aiohttp import web
+
+from easycrawler import asset
+
+class SpyContext(ssl.SSLContext):
+    # a context telling which ALPN protocols were set on it
+    def set_alpn_protocols(self, aProtocols):
+        self.aAlpn = list(aProtocols);
+        super().set_alpn_protocols(aProtocols);
+
+def test_http2_sessions_leave_the_aiohttp_context_alone(run, serve, monkeypatch):
+    pytest.importorskip('h2');
+    monkeypatch.setattr(asset, 'sslContext', SpyContext(ssl.PROTOCOL_TLS_CLIENT));
+    monkeypatch.setattr(asset, 'http2SslContext', SpyContext(ssl.PROTOCOL_TLS_CLIENT));
+    sBase = serve(web.Application());
+    async def main():
+        session = asset.newSession(sTransport='http2');
+        try:
+            # plain TCP answers the TLS handshake, which fails after httpx has set ALPN up
+            with pytest.raises(Exception):
+                await session.request('GET', sBase.replace('http:', 'https:') + '/');
+            connector = asset.newConnector();
+            await connector.close();
+            return connector;
+        finally:
+            await session.close();
+    connector = run(main());
+    assert asset.http2SslContext.aAlpn == ['http/1.1', 'h2'];
+    assert not hasattr(asset.sslContext, 'aAlpn');
+    assert connector._ssl is asset.sslContext;
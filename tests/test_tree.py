@@ -0,0 +1,48 @@
+from aiohttp import web
+
+from easycrawler import asset
+
+def makeApp(aPorts, mHits):
+    bSmall = b'<html><body><div id="main">small</div><p>tail</p></body></html>';
+    bLarge = b'<html><body><div id="main">large</div>' + b'<p>filler</p>' * 100000 + b'</body></html>';
+    async def handle(request):
+        aPorts.append(request.transport.get_extra_info('peername')[1]);
+        mHits[request.path] = mHits.get(request.path, 0) + 1;
+        if (request.headers.get('If-None-Match') == '"v1"'):
+            return web.Response(status=304, headers={'ETag': '"v1"'});
+        bData = bLarge if request.path == '/large' else bSmall;
+        return web.Response(body=bData, content_type='text/html', headers={'ETag': '"v1"'});
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    return app;
+
+def test_early_stop_drains_small_rests_and_closes_large_ones(run, serve):
+    aPorts = [];
+    sBase = serve(makeApp(aPorts, {}));
+    async def main():
+        session = asset.newSession();
+        try:
+            aTexts = [];
+            for sPath in ('/small', '/small', '/large', '/small'):
+                root = await asset.fetchTree(sBase + sPath, session=session, sStopTag='div', sStopId='main', nBuffer=4096);
+                aTexts.append(root.xpath('string(//div[@id="main"])'));
+            return aTexts;
+        finally:
+            await session.close();
+    assert run(main()) == ['small', 'small', 'large', 'small'];
+    assert aPorts[0] == aPorts[1] == aPorts[2]; # drained, the connection went back to the pool
+    assert aPorts[3] != aPorts[2]; # the large rest was not read, its connection was closed
+
+def test_cache_is_honoured(run, serve, tmp_path):
+    mHits = {};
+    sBase = serve(makeApp([], mHits));
+    cache = asset.HttpCache(str(tmp_path / 'http'));
+    async def main():
+        session = asset.newSession();
+        try:
+            return [(await asset.fetchTree(sBase + '/small', session=session, cache=cache, sStopTag='div')).xpath('string(//p)') for n in range(2)];
+        finally:
+            await session.close();
+    assert run(main()) == ['tail', 'tail']; # the whole document, not cut at the stop element
+    assert mHits == {'/small': 2};
+    assert cache.nHit == 1;
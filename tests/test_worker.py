@@ -0,0 +1,69 @@
+import os
+import re
+import mmap
+import tempfile
+
+import lxml.etree
+import pytest
+from aiohttp import web
+
+from easycrawler import worker
+from easycrawler.source import Source
+
+bPage = b'<html><head><title>old title</title></head><body>' + b'<p>row</p>' * 20000 + b'</body></html>';
+
+class PageSource(Source):
+    titlePath = lxml.etree.XPath('//title/text()');
+    def parseTitle(self, data, sSuffix=''):
+        # the title, the process it was parsed in, and whether the XPath was the worker's own copy
+        return self.titlePath(self.parse(data))[0] + sSuffix, os.getpid(), self.titlePath is not PageSource.titlePath;
+
+def mapBytes(bData):
+    file = tempfile.TemporaryFile();
+    file.write(bData);
+    file.flush();
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ);
+
+@pytest.mark.parametrize('sMode', ['thread', 'process'])
+def test_pools_take_mappings_by_position_and_by_keyword(run, sMode):
+    pool = worker.ParsePool(sMode, 2);
+    mapped = mapBytes(bPage);
+    try:
+        aResults = [
+                run(pool.run(PageSource, 'parseTitle', mapped, sSuffix='!')),
+                run(pool.run(PageSource, 'parseTitle', data=mapped, sSuffix='?'))
+        ];
+    finally:
+        pool.close();
+        mapped.close();
+    assert [sTitle for sTitle, nPid, isOwn in aResults] == ['old title!', 'old title?'];
+    for sTitle, nPid, isOwn in aResults:
+        assert isOwn;
+        assert (nPid != os.getpid()) if sMode == 'process' else (nPid == os.getpid());
+    assert pool.getStats()['done'] == 2 and pool.getStats()['pending'] == 0;
+
+def test_query_page_streams_inline_and_hands_bytes_to_a_pool(run, serve):
+    mHits = {};
+    async def handle(request):
+        mHits[request.path] = mHits.get(request.path, 0) + 1;
+        return web.Response(body=bPage.replace(b'<body>', b'<body><div id="stop">stop</div>'), content_type='text/html');
+    app = web.Application();
+    app.router.add_get('/{path:.*}', handle);
+    sBase = serve(app);
+    aRewrite = [(re.compile(rb'<title>old'), b'<title>new')];
+    async def main(parsePool):
+        source = PageSource(nSpillSize=1024, parsePool=parsePool);
+        try:
+            data = await source.queryPage(sBase + '/page', aRewrite=aRewrite, sStopTag='div', sStopId='stop');
+            sTitle = (await source.runParse('parseTitle', data=data))[0];
+            return type(data).__name__, sTitle, len(source.parse(data).xpath('//p')) < 20000;
+        finally:
+            await source.cleanup();
+    pool = worker.ParsePool('process', 1);
+    try:
+        aResults = [run(main(parsePool)) for parsePool in (False, pool)];
+    finally:
+        pool.close();
+    # on the loop the tree is parsed as the page arrives and stops with the chunk holding the stop element, a pool gets the whole page
+    assert aResults == [('HtmlElement', 'new title', True), ('Body', 'new title', False)];
+    assert mHits == {'/page': 2};